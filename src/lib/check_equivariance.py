@@ -0,0 +1,64 @@
+import torch
+from nbody_model.modules.transformer import NBodyTransformer
+from nbody_model.algebra import CliffordAlgebra
+from nbody_model.data.nbody import random_batch
+from nbody_model.profiling.equivariance import check_equivariance, format_equivariance
+from nbody_model.serving.server import load_model
+import argparse
+import sys
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Check and benchmark the O(3) equivariance of NBodyTransformer.")
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Full checkpoint or best_model.pth, a freshly initialized model without')
+    parser.add_argument('--d_model', type=int, default=128, help='Dimension of the nbody_model')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--num_layers', type=int, default=5, help='Number of layers')
+    parser.add_argument('--num_edges', type=int, default=20, help='Number of edges')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
+    parser.add_argument('--horizons', type=int, nargs='+', default=None,
+                        help='Frames after frame_0 predicted by a multi-horizon model')
+    parser.add_argument('--num_systems', type=int, default=256, help='Number of random systems')
+    parser.add_argument('--num_transforms', type=int, default=64, help='Random rotations and reflections per system')
+    parser.add_argument('--rotations_only', action='store_true', help='Flag to leave out the reflections')
+    parser.add_argument('--max_batch_size', type=int, default=4096, help='Maximum number of systems per forward')
+    parser.add_argument('--max_error', type=float, default=None,
+                        help='Exit with an error when the max relative output error exceeds this')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the systems and transformations')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads of the model')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = NBodyTransformer(
+        input_dim=3,
+        d_model=args.d_model,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers,
+        clifford_algebra=CliffordAlgebra([1, 1, 1]),
+        num_edges=args.num_edges,
+        zero_edges=args.zero_edges,
+        n_nodes=args.n_nodes,
+        horizons=args.horizons
+    )
+    if args.checkpoint is not None:
+        load_model(model, args.checkpoint)
+
+    generator = torch.Generator().manual_seed(args.seed)
+    batch = random_batch(args.num_systems, n_nodes=args.n_nodes, generator=generator)
+    report = check_equivariance(model, batch, num_transforms=args.num_transforms,
+                                reflections=not args.rotations_only, max_batch_size=args.max_batch_size,
+                                generator=generator)
+    print(format_equivariance(report))
+    if args.max_error is not None and report['output']['max'] > args.max_error:
+        print(f"Max relative output error {report['output']['max']:.2e} exceeds {args.max_error:.2e}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import torch.nn as nn
+import torch.optim as optim
+from nbody_model.modules.transformer import NBodyTransformer
+from nbody_model.algebra import CliffordAlgebra
+from nbody_model.data.nbody import NBody
+from nbody_model.training.engine import Engine, format_stats
+from nbody_model.training.checkpoint import atomic_save, clone_state_dict, embedder_state_dict
+from nbody_model.training.distillation import Distiller
+from nbody_model.profiling.measure import measure_latency
+from nbody_model.serving.server import load_model
+from torch.optim.lr_scheduler import CosineAnnealingLR
+import argparse
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Distill a trained NBodyTransformer into a smaller student.")
+    parser.add_argument('--teacher_checkpoint', type=str, required=True,
+                        help='Full checkpoint from --checkpoint_dir, or a best_model.pth of main.py')
+    parser.add_argument('--teacher_d_model', type=int, default=128, help='Dimension of the teacher')
+    parser.add_argument('--teacher_num_heads', type=int, default=4, help='Number of attention heads of the teacher')
+    parser.add_argument('--teacher_num_layers', type=int, default=5, help='Number of layers of the teacher')
+    parser.add_argument('--teacher_num_edges', type=int, default=10, help='Number of edges of the teacher')
+    parser.add_argument('--teacher_zero_edges', action='store_true', help='Flag to indicate zero edges in the teacher')
+    parser.add_argument('--d_model', type=int, default=32, help='Dimension of the student')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads of the student')
+    parser.add_argument('--num_layers', type=int, default=2, help='Number of layers of the student')
+    parser.add_argument('--num_edges', type=int, default=0, help='Number of edges of the student')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges in the student')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--horizons', type=int, nargs='+', default=None,
+                        help='Frames after frame_0 predicted by a multi-horizon teacher')
+    parser.add_argument('--alpha', type=float, default=0.5, help='Weight of the error to the teacher prediction')
+    parser.add_argument('--beta', type=float, default=0.1, help='Weight of the intermediate feature error')
+    parser.add_argument('--lr', type=float, default=0.000248, help='Learning rate')
+    parser.add_argument('--weight_decay', type=float, default=0.00001, help='Weight decay')
+    parser.add_argument('--batch_size', type=int, default=50, help='Batch size')
+    parser.add_argument('--epochs', type=int, default=1000, help='Number of epochs')
+    parser.add_argument('--early_stopping_limit', type=int, default=50, help='Early stopping limit')
+    parser.add_argument('--num_samples', type=int, default=3000, help='Number of samples')
+    parser.add_argument('--cache_root', type=str, default=None, help='Preprocessed dataset cache to load from')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader workers')
+    parser.add_argument('--suffix', type=str, default='_charged5_initvel1small', help='Dataset suffix')
+    parser.add_argument('--frame_0', type=int, default=None, help='Input frame, defaults to the dataset default')
+    parser.add_argument('--frame_T', type=int, default=None, help='Target frame, defaults to the dataset default')
+    parser.add_argument('--out', type=str, default='./student.pth', help='Full checkpoint of the student')
+    args = parser.parse_args()
+    if args.horizons is not None and args.cache_root is not None:
+        parser.error('--horizons needs the raw dataset, it does not work with --cache_root')
+    return args
+
+
+def tradeoff(name, model, test_loader, batch):
+    test_loss, _ = Engine(model, nn.MSELoss()).evaluate(test_loader)
+    single = [value[:1] for value in batch]
+    return (f"{name:<8} {sum(p.numel() for p in model.parameters()):>10} {test_loss:>12.6f} "
+            f"{measure_latency(model, single):>12.2f} {measure_latency(model, batch):>14.2f}")
+
+
+def main():
+    args = parse_arguments()
+    clifford_algebra = CliffordAlgebra([1, 1, 1])
+    teacher = NBodyTransformer(
+        input_dim=3,
+        d_model=args.teacher_d_model,
+        num_heads=args.teacher_num_heads,
+        num_layers=args.teacher_num_layers,
+        clifford_algebra=clifford_algebra,
+        num_edges=args.teacher_num_edges,
+        zero_edges=args.teacher_zero_edges,
+        n_nodes=args.n_nodes,
+        horizons=args.horizons
+    )
+    load_model(teacher, args.teacher_checkpoint)
+    student = NBodyTransformer(
+        input_dim=3,
+        d_model=args.d_model,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers,
+        clifford_algebra=clifford_algebra,
+        num_edges=args.num_edges,
+        zero_edges=args.zero_edges,
+        n_nodes=args.n_nodes,
+        horizons=args.horizons
+    )
+
+    nbody_data = NBody(num_samples=args.num_samples, batch_size=args.batch_size, cache_root=args.cache_root,
+                       num_workers=args.num_workers, suffix=args.suffix, frame_0=args.frame_0,
+                       frame_T=args.frame_T, horizons=args.horizons)
+    train_loader = nbody_data.train_loader()
+    val_loader = nbody_data.val_loader()
+    test_loader = nbody_data.test_loader()
+
+    distiller = Distiller(student, teacher, alpha=args.alpha, beta=args.beta)
+    optimizer = optim.Adam(distiller.trainable_parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    scheduler = CosineAnnealingLR(optimizer, args.epochs * len(train_loader))
+    engine = Engine(distiller, distiller.loss, optimizer, scheduler)
+
+    best_val_loss = float('inf')
+    best_state = None
+    early_stopping_counter = 0
+    for epoch in range(args.epochs):
+        train_loss, train_stats = engine.train_epoch(train_loader)
+        # Validation and test losses are the student's error to the target
+        val_loss, val_stats = engine.evaluate(val_loader)
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            best_state = clone_state_dict(student.state_dict())
+            early_stopping_counter = 0
+        else:
+            early_stopping_counter += 1
+        print(f'Epoch {epoch + 1}, Distillation Loss: {train_loss}, Validation Loss: {val_loss}')
+        print(f'Train: {format_stats(train_stats)} | Validation: {format_stats(val_stats)}')
+        if early_stopping_counter >= args.early_stopping_limit:
+            print('Early stopping...')
+            break
+
+    student.load_state_dict(best_state)
+    atomic_save({'model': student.state_dict(), 'embedder': embedder_state_dict(student)}, args.out)
+    print(f'Student saved to {args.out}')
+
+    batch = next(iter(test_loader))
+    print(f"{'':<8} {'parameters':>10} {'test loss':>12} {'latency 1 ms':>12} "
+          f"{f'latency {len(batch[0])} ms':>14}")
+    print(tradeoff('teacher', teacher, test_loader, batch))
+    print(tradeoff('student', student, test_loader, batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+from nbody_model.profiling.cost_model import estimate_cost
+from nbody_model.profiling.batch_size import calibrate, find_batch_size
+import argparse
+import itertools
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Estimate step FLOPs and peak memory of NBodyTransformer configs.")
+    parser.add_argument('--d_model', type=int, default=128, help='Dimension of the nbody_model')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--num_layers', type=int, default=5, help='Number of layers')
+    parser.add_argument('--num_edges', type=int, default=10, help='Number of edges')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
+    parser.add_argument('--batch_size', type=int, default=50, help='Batch size')
+    parser.add_argument('--validate', action='store_true',
+                        help='Calibrate the cost model on measured runs of a small grid and print its errors')
+    parser.add_argument('--memory_cap_mb', type=float, default=None,
+                        help='Find the highest throughput batch size under this peak memory')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    config = dict(d_model=args.d_model, num_heads=args.num_heads, num_layers=args.num_layers,
+                  num_edges=args.num_edges, n_nodes=args.n_nodes, zero_edges=args.zero_edges)
+    cost = estimate_cost(batch_size=args.batch_size, **config)
+    print(f"{cost['parameters']} parameters, {cost['train_flops'] / 1e9:.2f} GFLOP per training step, "
+          f"{cost['peak_memory_bytes'] / 2 ** 20:.1f}MB peak memory")
+    for name, (flops, activations, parameters) in cost['layers'].items():
+        print(f"  {name:<20} {flops / 1e9:>8.3f} GFLOP {4 * activations / 2 ** 20:>9.1f}MB saved {parameters:>9}")
+
+    cost_model = None
+    if args.validate:
+        grid = [dict(config, d_model=d_model, num_layers=num_layers, batch_size=batch_size)
+                for d_model, num_layers, batch_size in itertools.product([16, 64], [1, 4], [25, 100])]
+        cost_model, errors = calibrate(grid)
+        print(f"Calibrated: {cost_model.flops_per_sec / 1e9:.2f} GFLOP/s, {1e3 * cost_model.overhead:.2f}ms "
+              f"overhead, memory scale {cost_model.memory_scale:.2f}")
+        for error in errors:
+            print(f"  d_model {error['config']['d_model']}, {error['config']['num_layers']} layers, batch "
+                  f"{error['config']['batch_size']}: throughput {100 * error['samples_per_sec_error']:+.1f}%, "
+                  f"memory {100 * error['peak_memory_error']:+.1f}%")
+
+    if args.memory_cap_mb is not None:
+        batch_size, costs = find_batch_size(config, args.memory_cap_mb, cost_model=cost_model)
+        print(f"Batch size {batch_size} under {args.memory_cap_mb}MB")
+
+
+if __name__ == '__main__':
+    main()
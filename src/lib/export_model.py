@@ -0,0 +1,43 @@
+from nbody_model.modules.transformer import NBodyTransformer
+from nbody_model.algebra import CliffordAlgebra
+from nbody_model.serving.export import export_numpy
+from nbody_model.serving.server import load_model
+import argparse
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Export NBodyTransformer weights for nbody_numpy.py.")
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Full checkpoint from --checkpoint_dir, or a best_model.pth of main.py')
+    parser.add_argument('--out', type=str, default='./model.npz', help='Path of the exported .npz')
+    parser.add_argument('--d_model', type=int, default=128, help='Dimension of the nbody_model')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--num_layers', type=int, default=5, help='Number of layers')
+    parser.add_argument('--num_edges', type=int, default=10, help='Number of edges')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
+    parser.add_argument('--horizons', type=int, nargs='+', default=None,
+                        help='Frames after frame_0 predicted by a multi-horizon model')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    model = NBodyTransformer(
+        input_dim=3,
+        d_model=args.d_model,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers,
+        clifford_algebra=CliffordAlgebra([1, 1, 1]),
+        num_edges=args.num_edges,
+        zero_edges=args.zero_edges,
+        n_nodes=args.n_nodes,
+        horizons=args.horizons
+    )
+    load_model(model, args.checkpoint)
+    export_numpy(model, args.out)
+    print(f'Exported to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+import torch.nn as nn
+import torch.optim as optim
+from nbody_model.modules.transformer import NBodyTransformer
+from nbody_model.algebra import CliffordAlgebra
+from nbody_model.data.nbody import NBody
+from nbody_model.data.cache import DTYPES
+from nbody_model.training.engine import Engine, format_stats
+from nbody_model.training.checkpoint import atomic_save, clone_state_dict, embedder_state_dict
+from nbody_model.training.feature_cache import MANIFEST, CachedFeatureDataset, CachedHead, build_feature_cache
+from nbody_model.serving.server import load_model
+from torch.optim.lr_scheduler import CosineAnnealingLR
+import argparse
+import json
+import os
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Fine-tune the last layers of a trained NBodyTransformer on cached "
+                                                 "features of its frozen prefix.")
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Full checkpoint from --checkpoint_dir, or a best_model.pth of main.py')
+    parser.add_argument('--out', type=str, default='./finetuned.pth', help='Full checkpoint of the fine-tuned model')
+    parser.add_argument('--train_from', type=str, default='combined_projection',
+                        help="First trained part, 'combined_projection' or the index of a transformer block")
+    parser.add_argument('--feature_cache_dir', type=str, default='./feature_cache/',
+                        help='Directory of the cached features, reused when the frozen weights match')
+    parser.add_argument('--feature_dtype', type=str, choices=list(DTYPES), default='fp32',
+                        help='Storage dtype of the cached features')
+    parser.add_argument('--d_model', type=int, default=128, help='Dimension of the nbody_model')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--num_layers', type=int, default=5, help='Number of layers')
+    parser.add_argument('--num_edges', type=int, default=10, help='Number of edges')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
+    parser.add_argument('--lr', type=float, default=0.0001, help='Learning rate')
+    parser.add_argument('--weight_decay', type=float, default=0.00001, help='Weight decay')
+    parser.add_argument('--batch_size', type=int, default=50, help='Batch size')
+    parser.add_argument('--epochs', type=int, default=100, help='Number of epochs')
+    parser.add_argument('--early_stopping_limit', type=int, default=20, help='Early stopping limit')
+    parser.add_argument('--num_samples', type=int, default=3000, help='Number of samples')
+    parser.add_argument('--data_root', type=str, default='./nbody_dataset/', help='Directory of the dataset')
+    parser.add_argument('--suffix', type=str, default='_charged5_initvel1small', help='Dataset suffix')
+    parser.add_argument('--frame_0', type=int, default=None, help='Input frame, defaults to the dataset default')
+    parser.add_argument('--frame_T', type=int, default=None, help='Target frame, defaults to the dataset default')
+    parser.add_argument('--horizons', type=int, nargs='+', default=None,
+                        help='Frames after frame_0 predicted by a multi-horizon model')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader workers')
+    args = parser.parse_args()
+    if args.train_from != 'combined_projection':
+        if not args.train_from.isdigit() or int(args.train_from) >= args.num_layers:
+            parser.error(f"--train_from has to be 'combined_projection' or a block index below {args.num_layers}")
+        args.train_from = int(args.train_from)
+    return args
+
+
+def feature_dataset(model, dataset, directory, args):
+    # A cache of the same prefix weights, dtype and samples is reused, anything else is rebuilt
+    manifest_path = os.path.join(directory, MANIFEST)
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+        if manifest['train_from'] == args.train_from and manifest['dtype'] == args.feature_dtype:
+            try:
+                return CachedFeatureDataset(directory, model, dataset)
+            except Exception as error:
+                print(f'Rebuilding {directory}: {error}')
+        os.remove(manifest_path)
+    build_feature_cache(model, dataset, directory, args.train_from, batch_size=max(args.batch_size, 500),
+                        dtype=args.feature_dtype)
+    return CachedFeatureDataset(directory, model, dataset)
+
+
+def main():
+    args = parse_arguments()
+    model = NBodyTransformer(
+        input_dim=3,
+        d_model=args.d_model,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers,
+        clifford_algebra=CliffordAlgebra([1, 1, 1]),
+        num_edges=args.num_edges,
+        zero_edges=args.zero_edges,
+        n_nodes=args.n_nodes,
+        horizons=args.horizons
+    )
+    load_model(model, args.checkpoint)
+
+    nbody_data = NBody(data_root=args.data_root, num_samples=args.num_samples, batch_size=args.batch_size,
+                       num_workers=args.num_workers, suffix=args.suffix, frame_0=args.frame_0, frame_T=args.frame_T,
+                       horizons=args.horizons)
+    datasets = {partition: feature_dataset(model, dataset, os.path.join(args.feature_cache_dir, partition), args)
+                for partition, dataset in (('train', nbody_data.train_dataset), ('valid', nbody_data.valid_dataset),
+                                           ('test', nbody_data.test_dataset))}
+    train_loader = nbody_data.get_loader(datasets['train'], shuffle=True, drop_last=True)
+    val_loader = nbody_data.get_loader(datasets['valid'])
+    test_loader = nbody_data.get_loader(datasets['test'])
+
+    head = CachedHead(model, args.train_from, datasets['train'].attention_mask)
+    optimizer = optim.Adam(head.trainable_parameters(), lr=args.lr, weight_decay=args.weight_decay)
+    scheduler = CosineAnnealingLR(optimizer, args.epochs * len(train_loader))
+    engine = Engine(head, nn.MSELoss(), optimizer, scheduler)
+
+    best_val_loss, _ = engine.evaluate(val_loader)
+    print(f'Validation Loss before fine-tuning: {best_val_loss}')
+    best_state = clone_state_dict(model.state_dict())
+    early_stopping_counter = 0
+    for epoch in range(args.epochs):
+        train_loss, train_stats = engine.train_epoch(train_loader)
+        val_loss, val_stats = engine.evaluate(val_loader)
+        if val_loss < best_val_loss:
+            best_val_loss = val_loss
+            best_state = clone_state_dict(model.state_dict())
+            early_stopping_counter = 0
+        else:
+            early_stopping_counter += 1
+        print(f'Epoch {epoch + 1}, Training Loss: {train_loss}, Validation Loss: {val_loss}')
+        print(f'Train: {format_stats(train_stats)} | Validation: {format_stats(val_stats)}')
+        if early_stopping_counter >= args.early_stopping_limit:
+            print('Early stopping...')
+            break
+
+    model.load_state_dict(best_state)
+    test_loss, test_stats = engine.evaluate(test_loader)
+    print(f'Test Loss: {test_loss}, {format_stats(test_stats)}')
+    # Same layout as the full checkpoints, the fine-tuned model loads wherever a checkpoint is accepted
+    atomic_save({'model': model.state_dict(), 'embedder': embedder_state_dict(model)}, args.out)
+    print(f'Fine-tuned model saved to {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+from nbody_model.data.simulate import generate_partition
+import numpy as np
+import argparse
+import time
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Generate a charged nbody dataset with the vectorized simulator.")
+    parser.add_argument('--data_root', type=str, default='./nbody_dataset/', help='Directory to write the .npy files to')
+    parser.add_argument('--n_balls', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--num_train', type=int, default=10000, help='Number of training simulations')
+    parser.add_argument('--num_valid', type=int, default=2000, help='Number of validation simulations')
+    parser.add_argument('--num_test', type=int, default=2000, help='Number of test simulations')
+    parser.add_argument('--length', type=int, default=5000, help='Length of the training trajectories')
+    parser.add_argument('--length_test', type=int, default=5000, help='Length of the valid and test trajectories')
+    parser.add_argument('--sample_freq', type=int, default=100, help='How often to sample the trajectory')
+    parser.add_argument('--initial_vel', type=float, default=1., help='Norm of the initial velocities')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--chunk_size', type=int, default=500, help='Simulations integrated together per worker')
+    parser.add_argument('--num_workers', type=int, default=None, help='Number of worker processes, all cores by default')
+    parser.add_argument('--dtype', type=str, choices=['float32', 'float64'], default='float64', help='Storage dtype')
+    parser.add_argument('--suffix', type=str, default=None, help='Dataset suffix, derived from the settings by default')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    # Same naming scheme as the EGNN generator, e.g. '_charged5_initvel1small'
+    suffix = args.suffix or f'_charged{args.n_balls}_initvel{args.initial_vel:g}small'
+    partitions = [('train', args.num_train, args.length),
+                  ('valid', args.num_valid, args.length_test),
+                  ('test', args.num_test, args.length_test)]
+
+    for i, (partition, num_sims, length) in enumerate(partitions):
+        start = time.perf_counter()
+        shapes = generate_partition(args.data_root, partition, suffix, num_sims, T=length, sample_freq=args.sample_freq,
+                                    seed=[args.seed, i], chunk_size=args.chunk_size, num_workers=args.num_workers,
+                                    dtype=np.dtype(args.dtype), n_balls=args.n_balls, vel_norm=args.initial_vel)
+        elapsed = time.perf_counter() - start
+        print(f'{partition}: {num_sims} simulations in {elapsed:.1f}s, loc {shapes["loc"]}')
+    print(f'Dataset written to {args.data_root} with suffix {suffix}')
+
+
+if __name__ == '__main__':
+    main()
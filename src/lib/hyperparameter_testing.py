@@ -1,14 +1,34 @@
 import torch
 import torch.nn as nn
 import torch.optim as optim
+import torch.multiprocessing as mp
 from tqdm import tqdm
 from src.lib.nbody_model.modules.transformer import NBodyTransformer
 from src.lib.nbody_model.algebra import CliffordAlgebra
-from src.lib.nbody_model.data import NBody
+from src.lib.nbody_model.data.nbody import NBody
+from src.lib.nbody_model.training.engine import Engine
+from src.lib.nbody_model.search.fidelity import FidelitySchedule, compute_savings, rung_summary
+from src.lib.nbody_model.search.cost import measure_cost, over_budget
+from src.lib.nbody_model.profiling.batch_size import find_batch_size
+from src.lib.nbody_model.search.warm_start import suggest, load_prior_trials, narrow_space, warm_start
 import optuna
+from optuna.distributions import CategoricalDistribution, FloatDistribution, IntDistribution
+from optuna.storages import RDBStorage, RetryFailedTrialCallback
+from optuna.study import MaxTrialsCallback
+from optuna.trial import TrialState
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import joblib
 import argparse
+import os
+
+SEARCH_SPACE = {
+    'd_model': CategoricalDistribution([16, 32, 64, 128]),
+    'num_heads': CategoricalDistribution([4, 8, 16]),
+    'num_layers': IntDistribution(1, 8),
+    'lr': FloatDistribution(1e-5, 1e-3, log=True),
+    'batch_size': CategoricalDistribution([50, 100, 150, 200]),
+    'wd': FloatDistribution(1e-6, 1e-2, log=True),
+}
 
 
 def parse_arguments():
@@ -18,18 +38,94 @@ def parse_arguments():
     parser.add_argument('--num_edges', type=int, choices=[0, 10, 20], default=10, help='Number of edges')
     parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
     parser.add_argument('--n_trials', type=int, default=100, help='Number of trials for hyperparameter optimization')
-    return parser.parse_args()
+    parser.add_argument('--cache_root', type=str, default=None, help='Preprocessed dataset cache to load from')
+    parser.add_argument('--n_workers', type=int, default=1, help='Number of parallel trial processes')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='CPU threads per trial process')
+    parser.add_argument('--storage', type=str, default=None,
+                        help='Optuna storage url, defaults to a sqlite file next to the study pickle')
+    parser.add_argument('--study_name', type=str, default=None, help='Name of the study in the storage')
+    parser.add_argument('--pruner', type=str, choices=['median', 'asha', 'hyperband'], default='median',
+                        help='median prunes per epoch, asha and hyperband prune over training set size and epochs')
+    parser.add_argument('--reduction_factor', type=int, default=3, help='Successive halving reduction factor')
+    parser.add_argument('--num_rungs', type=int, default=4, help='Number of successive halving rungs')
+    parser.add_argument('--data_share', type=float, default=0.5,
+                        help='Share of each rung budget spent on training set size instead of epochs')
+    parser.add_argument('--multi_objective', action='store_true',
+                        help='Search the Pareto front of validation loss, inference latency and peak memory')
+    parser.add_argument('--max_latency_ms', type=float, default=None,
+                        help='Reject configurations with a larger inference latency per batch before training')
+    parser.add_argument('--min_train_throughput', type=float, default=None,
+                        help='Reject configurations training fewer samples per second before training')
+    parser.add_argument('--max_memory_mb', type=float, default=None,
+                        help='Reject configurations with a larger peak training memory before training')
+    parser.add_argument('--warm_start', type=str, nargs='+', default=[],
+                        help='Pickled studies to start from, e.g. the ones in results/hyperparameter_search')
+    parser.add_argument('--warm_start_mode', type=str, choices=['transfer', 'enqueue', 'both'], default='both',
+                        help='transfer adds the prior trials with their results, enqueue evaluates the top-k again')
+    parser.add_argument('--top_k', type=int, default=5, help='Number of best prior trials to enqueue and narrow to')
+    parser.add_argument('--narrow_space', action='store_true',
+                        help='Narrow the numeric search ranges around the top-k prior trials')
+    parser.add_argument('--narrow_margin', type=float, default=2.0,
+                        help='Factor by which the narrowed ranges are widened around the top-k prior trials')
+    parser.add_argument('--auto_batch_size', action='store_true',
+                        help='Pick the highest throughput batch size under --max_memory_mb instead of searching it')
+    args = parser.parse_args()
+    if args.auto_batch_size and args.max_memory_mb is None:
+        parser.error('--auto_batch_size requires --max_memory_mb')
+    if args.multi_objective and args.pruner != 'median':
+        parser.error('--multi_objective does not support pruning, use the default --pruner median')
+    if args.multi_objective and args.warm_start and args.warm_start_mode != 'enqueue':
+        parser.error('--multi_objective can only warm start with --warm_start_mode enqueue')
+    study_name = f"{args.num_edges}_{args.zero_edges}_nbody_study"
+    if args.multi_objective:
+        # A study keeps its directions, the multi-objective search gets its own study
+        study_name += "_cost"
+    args.study_name = args.study_name or study_name
+    args.storage = args.storage or f"sqlite:///{study_name}.db"
+    return args
+
+
+def get_budget(args):
+    return {'max_latency_ms': args.max_latency_ms, 'min_train_samples_per_sec': args.min_train_throughput,
+            'max_memory_mb': args.max_memory_mb}
+
+
+def get_directions(args):
+    # Validation loss, inference latency per batch and peak training memory
+    return ['minimize'] * 3 if args.multi_objective else ['minimize']
 
 
-def objective(trial, num_samples, epochs, num_edges, zero_edges):
+def check_cost(trial, model, criterion, val_loader, budget):
+    # A quick measured pass on one batch of the trial's size, before any training is spent on it
+    cost = measure_cost(model, next(iter(val_loader)), criterion)
+    for key, value in cost.items():
+        trial.set_user_attr(key, value)
+    reason = over_budget(cost, **(budget or {}))
+    if reason is not None:
+        trial.set_user_attr('sample_epochs', 0)
+        trial.set_user_attr('rejected', reason)
+        raise optuna.exceptions.TrialPruned(f"Over budget: {reason}")
+    return cost
+
+
+def objective(trial, nbody_data, epochs, num_edges, zero_edges, schedule=None, budget=None, multi_objective=False,
+              space=None):
     # Define search space for hyperparameters
     input_dim = 3
-    d_model = trial.suggest_categorical('d_model', [16, 32, 64, 128])
-    num_heads = trial.suggest_categorical('num_heads', [4, 8, 16])
-    num_layers = trial.suggest_int('num_layers', 1, 8)
-    lr = trial.suggest_float('lr', 1e-5, 1e-3, log=True)
-    batch_size = trial.suggest_categorical('batch_size', [50, 100, 150, 200])
-    wd = trial.suggest_float('wd', 1e-6, 1e-2, log=True)
+    params = suggest(trial, space or SEARCH_SPACE)
+    d_model = params['d_model']
+    num_heads = params['num_heads']
+    num_layers = params['num_layers']
+    lr = params['lr']
+    wd = params['wd']
+    if 'batch_size' in params:
+        batch_size = params['batch_size']
+    else:
+        # --auto_batch_size, the fastest batch size of this architecture that fits in the memory budget
+        config = dict(d_model=d_model, num_heads=num_heads, num_layers=num_layers, num_edges=num_edges,
+                      zero_edges=zero_edges)
+        batch_size, _ = find_batch_size(config, budget['max_memory_mb'], max_measured=2)
+        trial.set_user_attr('batch_size', batch_size)
 
     clifford_algebra = CliffordAlgebra([1, 1, 1])
 
@@ -38,9 +134,9 @@ def objective(trial, num_samples, epochs, num_edges, zero_edges):
                              zero_edges=zero_edges)
     criterion = nn.MSELoss()
     optimizer = optim.Adam(model.parameters(), lr=lr, weight_decay=wd)
-    nbody_data = NBody(num_samples=num_samples, batch_size=batch_size)
-    train_loader = nbody_data.train_loader()
-    val_loader = nbody_data.val_loader()
+    # The datasets are shared by all trials, only the loaders depend on the trial
+    train_loader = nbody_data.train_loader(batch_size=batch_size)
+    val_loader = nbody_data.val_loader(batch_size=batch_size)
     steps_per_epoch = len(train_loader)  # number of batches per epoch
     steps = epochs * steps_per_epoch
 
@@ -49,33 +145,27 @@ def objective(trial, num_samples, epochs, num_edges, zero_edges):
         steps
     )
 
-    def train_epoch(model, train_loader, criterion, optimizer):
-        model.train()
-        running_loss = 0.0
-        for i, batch in enumerate(train_loader):
-            optimizer.zero_grad()
-            output, tgt = model(batch)
-            loss = criterion(output, tgt)
-            loss.backward()
-            nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
-            optimizer.step()
-            running_loss += loss.item()
-        return running_loss / len(train_loader)
-
-    def validate_epoch(model, val_loader, criterion):
-        model.eval()
-        running_loss = 0.0
-        with torch.no_grad():
-            for i, batch in enumerate(val_loader):
-                output, tgt = model(batch)
-                loss = criterion(output, tgt)
-                running_loss += loss.item()
-        return running_loss / len(val_loader)
+    cost = check_cost(trial, model, criterion, val_loader, budget)
+
+    # The scheduler keeps being stepped once per epoch here
+    engine = Engine(model, criterion, optimizer)
+
+    if schedule is not None:
+        return train_multi_fidelity(trial, engine, scheduler, nbody_data, val_loader, batch_size, schedule)
 
+    sample_epochs = 0
     for epoch in tqdm(range(epochs)):
-        train_loss = train_epoch(model, train_loader, criterion, optimizer)
-        val_loss = validate_epoch(model, val_loader, criterion)
+        train_loss, train_stats = engine.train_epoch(train_loader)
+        val_loss, val_stats = engine.evaluate(val_loader)
         scheduler.step()
+        sample_epochs += train_stats['samples']
+        trial.set_user_attr('sample_epochs', sample_epochs)
+        trial.set_user_attr('train_samples_per_sec', train_stats['samples_per_sec'])
+        trial.set_user_attr('val_samples_per_sec', val_stats['samples_per_sec'])
+
+        # Optuna does not support intermediate values for multi-objective studies
+        if multi_objective:
+            continue
 
         trial.report(val_loss, epoch)
 
@@ -83,20 +173,138 @@ def objective(trial, num_samples, epochs, num_edges, zero_edges):
         if trial.should_prune():
             raise optuna.exceptions.TrialPruned()
 
+    if multi_objective:
+        return val_loss, cost['inference_latency_ms'], cost['peak_memory_mb']
+    return val_loss
+
+
+def train_multi_fidelity(trial, engine, scheduler, nbody_data, val_loader, batch_size, schedule):
+    # Every rung trains on a larger prefix of the training set for more epochs, and is only reached when the
+    # trial is in the best 1 / reduction_factor of the trials that reported at the previous rung
+    epoch = 0
+    sample_epochs = 0
+    for rung, (rung_samples, rung_epochs) in enumerate(schedule.rungs):
+        train_loader = nbody_data.train_loader(batch_size=batch_size, num_samples=rung_samples)
+        for epoch in tqdm(range(epoch, rung_epochs)):
+            train_loss, train_stats = engine.train_epoch(train_loader)
+            scheduler.step()
+            sample_epochs += train_stats['samples']
+            trial.set_user_attr('train_samples_per_sec', train_stats['samples_per_sec'])
+        epoch = rung_epochs
+        val_loss, val_stats = engine.evaluate(val_loader)
+        trial.set_user_attr('sample_epochs', sample_epochs)
+        trial.set_user_attr('rung', rung)
+        trial.set_user_attr('val_samples_per_sec', val_stats['samples_per_sec'])
+
+        trial.report(val_loss, schedule.step(rung))
+        # A trial that reached the last rung is fully trained and completes
+        if rung < len(schedule.rungs) - 1 and trial.should_prune():
+            raise optuna.exceptions.TrialPruned()
+
     return val_loss
 
 
+def get_storage(url):
+    # Trials of crashed workers stop sending heartbeats, they are marked failed and retried on resume
+    return RDBStorage(url, heartbeat_interval=60, grace_period=180,
+                      failed_trial_callback=RetryFailedTrialCallback(max_retry=1),
+                      engine_kwargs={'connect_args': {'timeout': 60}})
+
+
+def get_schedule(args):
+    if args.pruner == 'median':
+        return None
+    return FidelitySchedule(args.num_samples, args.epochs, reduction_factor=args.reduction_factor,
+                            num_rungs=args.num_rungs, data_share=args.data_share)
+
+
+def get_pruner(args):
+    schedule = get_schedule(args)
+    return optuna.pruners.MedianPruner() if schedule is None else schedule.make_pruner(args.pruner)
+
+
+def get_base_space(args):
+    if args.auto_batch_size:
+        return {name: distribution for name, distribution in SEARCH_SPACE.items() if name != 'batch_size'}
+    return SEARCH_SPACE
+
+
+def get_space(args, prior_trials):
+    if not args.narrow_space or not prior_trials:
+        return get_base_space(args)
+    return narrow_space(get_base_space(args), prior_trials, top_k=args.top_k, margin=args.narrow_margin)
+
+
+def run_worker(worker, args, nbody_data, threads, space):
+    torch.set_num_threads(threads)
+    study = optuna.load_study(study_name=args.study_name, storage=get_storage(args.storage), pruner=get_pruner(args))
+    schedule = get_schedule(args)
+    # Workers stop once the study as a whole, including earlier runs, has n_trials finished trials. Transferred
+    # prior trials were not run here and do not count
+    transferred = sum('transferred_from' in trial.user_attrs for trial in study.get_trials(deepcopy=False))
+    study.optimize(lambda trial: objective(trial, nbody_data, args.epochs, args.num_edges, args.zero_edges, schedule,
+                                           get_budget(args), args.multi_objective, space),
+                   callbacks=[MaxTrialsCallback(args.n_trials + transferred,
+                                                states=(TrialState.COMPLETE, TrialState.PRUNED))])
+
+
+def run_search(args):
+    study = optuna.create_study(study_name=args.study_name, storage=get_storage(args.storage),
+                                directions=get_directions(args), pruner=get_pruner(args), load_if_exists=True)
+    if get_schedule(args) is not None:
+        print(f"Multi-fidelity search, {rung_summary(get_schedule(args))}")
+
+    prior_trials = load_prior_trials(args.warm_start)
+    if prior_trials:
+        transferred, enqueued = warm_start(study, prior_trials, get_base_space(args), top_k=args.top_k,
+                                           mode=args.warm_start_mode)
+        print(f"Warm start from {len(prior_trials)} prior trials, {transferred} transferred, {enqueued} enqueued")
+    space = get_space(args, prior_trials)
+    if args.narrow_space and prior_trials:
+        print(f"Narrowed search space: {space}")
+
+    # Read and preprocess the datasets once, the workers share them through shared memory
+    nbody_data = NBody(num_samples=args.num_samples, cache_root=args.cache_root)
+    nbody_data.share_memory(partitions=("train", "valid"))
+
+    threads = args.threads_per_worker or max(1, os.cpu_count() // args.n_workers)
+    if args.n_workers == 1:
+        run_worker(0, args, nbody_data, threads, space)
+    else:
+        context = mp.get_context('fork')
+        workers = [context.Process(target=run_worker, args=(worker, args, nbody_data, threads, space))
+                   for worker in range(args.n_workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+
+    return optuna.load_study(study_name=args.study_name, storage=get_storage(args.storage))
+
+
 if __name__ == "__main__":
     args = parse_arguments()
 
-    study = optuna.create_study(direction='minimize')
-    study.optimize(lambda trial: objective(trial, args.num_samples, args.epochs, args.num_edges, args.zero_edges),
-                   n_trials=args.n_trials)
+    study = run_search(args)
     print(args.num_edges, args.zero_edges)
     print("Number of finished trials: ", len(study.trials))
-    print("Best hyperparameters: ", study.best_params)
-    print("Best validation loss: ", study.best_value)
+    if args.multi_objective:
+        print("Pareto front of validation loss, inference latency (ms) and peak memory (MB):")
+        for trial in sorted(study.best_trials, key=lambda trial: trial.values[0]):
+            print(f"  trial {trial.number}: {trial.values[0]:.6f}, {trial.values[1]:.2f}ms, {trial.values[2]:.1f}MB, "
+                  f"{trial.user_attrs['train_samples_per_sec']:.1f} train samples/s, {trial.params}")
+    else:
+        print("Best hyperparameters: ", study.best_params)
+        print("Best validation loss: ", study.best_value)
+    rejected = [trial for trial in study.trials if 'rejected' in trial.user_attrs]
+    if rejected:
+        print(f"Rejected {len(rejected)} configurations over budget before training")
+    savings = compute_savings(study, args.num_samples * args.epochs)
+    print(f"Trained {savings['sample_epochs']} of {savings['full_sample_epochs']} sample-epochs "
+          f"({savings['pruned']} of {savings['trials']} trials pruned), "
+          f"{100 * savings['saved_fraction']:.1f}% of the compute saved")
 
-    # Save study to file
-    study_name = "nbody_study"
-    joblib.dump(study, f"{args.num_edges}_{args.zero_edges}_{study_name}.pkl")
+    # Save study to file, as a self-contained in-memory study like before
+    in_memory = optuna.storages.InMemoryStorage()
+    optuna.copy_study(from_study_name=args.study_name, from_storage=args.storage, to_storage=in_memory)
+    joblib.dump(optuna.load_study(study_name=args.study_name, storage=in_memory), f"{args.study_name}.pkl")
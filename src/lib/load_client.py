@@ -0,0 +1,72 @@
+import numpy as np
+import argparse
+import json
+import threading
+import time
+import urllib.request
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Generate load against a running serve.py.")
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8000', help='Address of the server')
+    parser.add_argument('--concurrency', type=int, default=16, help='Number of concurrent clients')
+    parser.add_argument('--duration', type=float, default=10.0, help='Seconds to send requests for')
+    parser.add_argument('--systems_per_request', type=int, default=1, help='Systems in every request')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the random systems')
+    return parser.parse_args()
+
+
+def random_request(rng, systems, n_nodes):
+    return {
+        'loc': rng.standard_normal((systems, n_nodes, 3)).tolist(),
+        'vel': rng.standard_normal((systems, n_nodes, 3)).tolist(),
+        'charges': rng.choice([-1.0, 1.0], size=(systems, n_nodes, 1)).tolist(),
+    }
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode(), headers={'Content-Type': 'application/json'})
+    with urllib.request.urlopen(request) as response:
+        return json.loads(response.read())
+
+
+def client(args, seed, stop, latencies, errors):
+    rng = np.random.default_rng([args.seed, seed])
+    # A few distinct payloads, so encoding the request does not limit the request rate
+    bodies = [random_request(rng, args.systems_per_request, args.n_nodes) for _ in range(8)]
+    i = 0
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        try:
+            post(args.url + '/predict', bodies[i % len(bodies)])
+            latencies.append(time.perf_counter() - start)
+        except Exception as error:
+            errors.append(str(error))
+        i += 1
+
+
+def main():
+    args = parse_arguments()
+    latencies, errors = [], []
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(args, seed, start + args.duration, latencies, errors))
+               for seed in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    p50, p90, p99 = np.percentile(latencies or [0.0], [50, 90, 99])
+    print(f'{len(latencies)} requests, {len(errors)} errors in {elapsed:.1f}s: '
+          f'{len(latencies) * args.systems_per_request / elapsed:.1f} systems/s, '
+          f'latency p50 {p50 * 1e3:.1f}ms p90 {p90 * 1e3:.1f}ms p99 {p99 * 1e3:.1f}ms')
+    if errors:
+        print(f'First error: {errors[0]}')
+    with urllib.request.urlopen(args.url + '/metrics') as response:
+        print(f'Server: {json.loads(response.read())}')
+
+
+if __name__ == '__main__':
+    main()
@@ -4,36 +4,22 @@ import torch.optim as optim
 from nbody_model.modules.transformer import NBodyTransformer
 from nbody_model.algebra import CliffordAlgebra
 from nbody_model.data.nbody import NBody
+from nbody_model.data.online import OnlineNBodyDataset
+from nbody_model.training.engine import Engine, format_stats
+from nbody_model.training.checkpoint import CheckpointManager, snapshot, restore
+from nbody_model.serving.server import load_model
+from nbody_model.profiling.modules import profile_training
+from nbody_model.profiling.batch_size import find_batch_size
+from nbody_model.training.distributed import setup_distributed, cleanup_distributed, is_main_process, barrier, \
+    wrap_model
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
 # from .data.nbody import NBody
 from torch.optim.lr_scheduler import CosineAnnealingLR
 import argparse
+import contextlib
 import csv
-
-
-def train_epoch(model, train_loader, criterion, optimizer, scheduler):
-    model.train()
-    running_loss = 0.0
-    for i, batch in enumerate(train_loader):
-        optimizer.zero_grad()
-        output, tgt = model(batch)
-        loss = criterion(output, tgt)
-        loss.backward()
-        nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)  # Gradient clipping
-        optimizer.step()
-        scheduler.step()
-        running_loss += loss.item()
-    return running_loss / len(train_loader)
-
-
-def validate_epoch(model, val_loader, criterion):
-    model.eval()
-    running_loss = 0.0
-    with torch.no_grad():
-        for i, batch in enumerate(val_loader):
-            output, tgt = model(batch)
-            loss = criterion(output, tgt)
-            running_loss += loss.item()
-    return running_loss / len(val_loader)
+import math
 
 
 def parse_arguments():
@@ -45,15 +31,63 @@ def parse_arguments():
     parser.add_argument('--batch_size', type=int, default=50, help='Batch size')
     parser.add_argument('--num_samples', type=int, default=3000, help='Number of samples')
     parser.add_argument('--epochs', type=int, default=1000, help='Number of epochs')
-    parser.add_argument('--num_edges', type=int, choices=[0, 10, 20], default=10, help='Number of edges')
+    parser.add_argument('--num_edges', type=int, default=10,
+                        help='Number of edges, 0, n_nodes * (n_nodes - 1) / 2 or n_nodes * (n_nodes - 1)')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
     parser.add_argument('--weight_decay', type=float, default=0.00001, help='Weight decay')
+    parser.add_argument('--accumulation_steps', type=int, default=1, help='Batches per optimizer step')
     parser.add_argument('--early_stopping_limit', type=int, default=50, help='Early stopping limit')
     parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
     parser.add_argument('--test_only', action='store_true', help='Flag to indicate find test loss')
-    return parser.parse_args()
+    parser.add_argument('--cache_root', type=str, default=None, help='Preprocessed dataset cache to load from')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader workers')
+    parser.add_argument('--pin_memory', action='store_true', help='Flag to pin data loader memory')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches prefetched per data loader worker')
+    parser.add_argument('--sliding_window', action='store_true', help='Flag to train on every (t, t + delta) window')
+    parser.add_argument('--delta', type=int, default=10, help='Frames between input and target for sliding windows')
+    parser.add_argument('--stride', type=int, default=1, help='Frames between consecutive sliding window starts')
+    parser.add_argument('--suffix', type=str, default='_charged5_initvel1small', help='Dataset suffix')
+    parser.add_argument('--frame_0', type=int, default=None, help='Input frame, defaults to the dataset default')
+    parser.add_argument('--frame_T', type=int, default=None, help='Target frame, defaults to the dataset default')
+    parser.add_argument('--online', action='store_true', help='Flag to train on systems simulated during training')
+    parser.add_argument('--num_producers', type=int, default=2, help='Number of simulator processes for --online')
+    parser.add_argument('--queue_size', type=int, default=4, help='Simulated chunks buffered per producer')
+    parser.add_argument('--seed', type=int, default=42, help='Seed of the simulated systems for --online')
+    parser.add_argument('--initial_vel', type=float, default=1.,
+                        help='Norm of the initial velocities for --online, as used by generate_dataset.py')
+    parser.add_argument('--checkpoint_dir', type=str, default='./checkpoints/', help='Directory for full checkpoints')
+    parser.add_argument('--save_every', type=int, default=10, help='Epochs between periodic checkpoints')
+    parser.add_argument('--keep_last', type=int, default=3, help='Number of periodic checkpoints to keep')
+    parser.add_argument('--resume', action='store_true', help='Flag to resume from the latest checkpoint')
+    parser.add_argument('--world_size', type=int, default=1,
+                        help='Number of local data parallel processes, --batch_size is per process')
+    parser.add_argument('--threads_per_rank', type=int, default=None, help='CPU threads per process')
+    parser.add_argument('--bucket_cap_mb', type=int, default=25, help='Gradient all-reduce bucket size in MB')
+    parser.add_argument('--master_port', type=int, default=29500, help='Port of the process group')
+    parser.add_argument('--profile_steps', type=int, default=0,
+                        help='Profile this many training steps per module before training, 0 disables profiling')
+    parser.add_argument('--profile_trace', type=str, default='./profile_trace.json',
+                        help='Chrome trace written by --profile_steps')
+    parser.add_argument('--profile_algebra', action='store_true',
+                        help='Also count and time the CliffordAlgebra operations during --profile_steps')
+    parser.add_argument('--auto_batch_size', action='store_true',
+                        help='Replace --batch_size by the highest throughput batch size under --memory_cap_mb')
+    parser.add_argument('--memory_cap_mb', type=float, default=None, help='Peak training memory per process')
+    parser.add_argument('--horizons', type=int, nargs='+', default=None,
+                        help='Frames after frame_0 to predict in one pass, replaces --frame_T')
+    args = parser.parse_args()
+    if args.auto_batch_size and args.memory_cap_mb is None:
+        parser.error('--auto_batch_size requires --memory_cap_mb')
+    if args.sliding_window and args.cache_root is not None:
+        parser.error('--sliding_window reads the raw trajectories, it does not work with --cache_root')
+    if args.horizons is not None and (args.online or args.cache_root is not None):
+        parser.error('--horizons needs the raw dataset, it does not work with --online or --cache_root')
+    if args.num_edges not in (0, args.n_nodes * (args.n_nodes - 1) // 2, args.n_nodes * (args.n_nodes - 1)):
+        parser.error(f'--num_edges {args.num_edges} does not match --n_nodes {args.n_nodes}')
+    return args
 
 
-def save_losses_to_csv(args, train_losses, val_losses, test_loss, filename='losses.csv'):
+def save_losses_to_csv(args, train_losses, val_losses, test_loss, filename='losses.csv', horizon_losses=None):
     filename = f'../../results/{args.num_edges}_{args.zero_edges}_{filename}'
     with open(filename, mode='w', newline='') as file:
         writer = csv.writer(file)
@@ -65,17 +99,9 @@ def save_losses_to_csv(args, train_losses, val_losses, test_loss, filename='loss
             writer.writerow([epoch, train_loss, val_loss])
         writer.writerow(['Test Loss'])
         writer.writerow([test_loss])
-
-
-def test_model(model, test_loader, criterion):
-    model.eval()
-    running_loss = 0.0
-    with torch.no_grad():
-        for i, batch in enumerate(test_loader):
-            output, tgt = model(batch)
-            loss = criterion(output, tgt)
-            running_loss += loss.item()
-    return running_loss / len(test_loader)
+        if horizon_losses is not None:
+            writer.writerow(['Horizon'] + args.horizons)
+            writer.writerow(['Test Loss'] + horizon_losses)
 
 
 def main():
@@ -88,16 +114,40 @@ def main():
             num_layers=args.num_layers,
             clifford_algebra=CliffordAlgebra([1, 1, 1]),
             num_edges=args.num_edges,
-            zero_edges=args.zero_edges
+            zero_edges=args.zero_edges,
+            n_nodes=args.n_nodes,
+            horizons=args.horizons
         )
-        model.load_state_dict(torch.load(f'../../results/trained_models/{args.num_edges}_{args.zero_edges}_best_model.pth'))
-        nbody_data = NBody(num_samples=args.num_samples, batch_size=args.batch_size)
+        load_model(model, f'../../results/trained_models/{args.num_edges}_{args.zero_edges}_best_model.pth')
+        nbody_data = NBody(num_samples=args.num_samples, batch_size=args.batch_size, cache_root=args.cache_root,
+                           num_workers=args.num_workers, pin_memory=args.pin_memory,
+                           prefetch_factor=args.prefetch_factor, suffix=args.suffix, frame_0=args.frame_0,
+                           frame_T=args.frame_T, horizons=args.horizons)
         test_loader = nbody_data.test_loader()
-        criterion = nn.MSELoss()
-        test_loss = test_model(model, test_loader, criterion)
-        print(f'Test Loss: {test_loss}')
+        engine = Engine(model, nn.MSELoss())
+        test_loss, test_stats = engine.evaluate(test_loader)
+        print(f'Test Loss: {test_loss}, {format_stats(test_stats)}')
         return
 
+    if args.auto_batch_size:
+        config = dict(d_model=args.d_model, num_heads=args.num_heads, num_layers=args.num_layers,
+                      num_edges=args.num_edges, n_nodes=args.n_nodes, zero_edges=args.zero_edges)
+        args.batch_size, costs = find_batch_size(config, args.memory_cap_mb)
+        print(f'Batch size {args.batch_size}: ' + ', '.join(
+            f"{batch_size}: {cost['train_samples_per_sec']:.1f} samples/s {cost['peak_memory_mb']:.1f}MB"
+            for batch_size, cost in costs.items()))
+
+    if args.world_size > 1:
+        mp.spawn(train, args=(args,), nprocs=args.world_size)
+    else:
+        train(0, args)
+
+
+def train(rank, args):
+    if args.world_size > 1:
+        setup_distributed(rank, args.world_size, master_port=args.master_port,
+                          threads_per_rank=args.threads_per_rank)
+
     metric = [1, 1, 1]
     clifford_algebra = CliffordAlgebra(metric)
 
@@ -109,20 +159,43 @@ def main():
         num_layers=args.num_layers,
         clifford_algebra=clifford_algebra,
         num_edges=args.num_edges,
-        zero_edges=args.zero_edges
+        zero_edges=args.zero_edges,
+        n_nodes=args.n_nodes,
+        horizons=args.horizons
     )
     criterion = nn.MSELoss()
     optimizer = optim.Adam(model.parameters(), lr=args.lr, weight_decay=args.weight_decay)
 
-    nbody_data = NBody(num_samples=args.num_samples, batch_size=args.batch_size)
-    train_loader = nbody_data.train_loader()
+    nbody_data = NBody(num_samples=args.num_samples, batch_size=args.batch_size, cache_root=args.cache_root,
+                       num_workers=args.num_workers, pin_memory=args.pin_memory,
+                       prefetch_factor=args.prefetch_factor, sliding_window=args.sliding_window,
+                       delta=args.delta, stride=args.stride, suffix=args.suffix, frame_0=args.frame_0,
+                       frame_T=args.frame_T, num_replicas=args.world_size, rank=rank, horizons=args.horizons)
+    if args.online:
+        # Fresh systems from simulator processes, as many steps per epoch as the file dataset would give
+        online_data = OnlineNBodyDataset(
+            batch_size=args.batch_size,
+            steps_per_epoch=args.num_samples // args.batch_size,
+            n_balls=args.n_nodes,
+            frame_0=nbody_data.valid_dataset.frame_0,
+            frame_T=nbody_data.valid_dataset.frame_T,
+            num_producers=args.num_producers,
+            queue_size=args.queue_size,
+            seed=args.seed + rank,
+            vel_norm=args.initial_vel
+        )
+        train_loader = DataLoader(online_data, batch_size=None)
+    else:
+        train_loader = nbody_data.train_loader()
     val_loader = nbody_data.val_loader()
     test_loader = nbody_data.test_loader()  # Assuming you have a test loader
 
     steps_per_epoch = len(train_loader)
-    steps = args.epochs * steps_per_epoch
+    steps = args.epochs * math.ceil(steps_per_epoch / args.accumulation_steps)
 
     scheduler = CosineAnnealingLR(optimizer, steps)
+    train_model = wrap_model(model, bucket_cap_mb=args.bucket_cap_mb) if args.world_size > 1 else model
+    engine = Engine(train_model, criterion, optimizer, scheduler, accumulation_steps=args.accumulation_steps)
 
     best_val_loss = float('inf')
     early_stopping_counter = 0
@@ -130,34 +203,84 @@ def main():
     train_losses = []
     val_losses = []
 
-    for epoch in range(args.epochs):
-        train_loss = train_epoch(model, train_loader, criterion, optimizer, scheduler)
-        val_loss = validate_epoch(model, val_loader, criterion)
+    best_model_path = f'./{args.num_edges}_{args.zero_edges}_best_model.pth'
+    checkpoints = CheckpointManager(args.checkpoint_dir, f'{args.num_edges}_{args.zero_edges}',
+                                    save_every=args.save_every, keep_last=args.keep_last)
+    start_epoch = 0
+    checkpoint = checkpoints.latest() if args.resume else None
+    if checkpoint is not None:
+        last_epoch, training_state = restore(checkpoint, model, optimizer, scheduler)
+        start_epoch = last_epoch + 1
+        best_val_loss = training_state['best_val_loss']
+        early_stopping_counter = training_state['early_stopping_counter']
+        train_losses = training_state['train_losses']
+        val_losses = training_state['val_losses']
+        if args.online:
+            # Continue the simulated stream after the systems already trained on instead of replaying them
+            online_data.start_chunk = training_state.get('online_chunk', 0)
+        if is_main_process():
+            print(f'Resuming from epoch {start_epoch + 1}')
+
+    if args.profile_steps and is_main_process():
+        # Forward and backward passes only, the model and optimizer are left untouched
+        telemetry = clifford_algebra.telemetry() if args.profile_algebra else None
+        with telemetry or contextlib.nullcontext():
+            profiler = profile_training(model, criterion, train_loader, args.profile_steps, telemetry=telemetry)
+        print(profiler.table())
+        profiler.export_chrome_trace(args.profile_trace)
+        if telemetry is not None:
+            print(telemetry.summary())
+
+    for epoch in range(start_epoch, args.epochs):
+        if hasattr(train_loader.sampler, 'set_epoch'):
+            train_loader.sampler.set_epoch(epoch)
+        train_loss, train_stats = engine.train_epoch(train_loader)
+        val_loss, val_stats = engine.evaluate(val_loader)
 
         train_losses.append(train_loss)
         val_losses.append(val_loss)
 
-        # Save nbody_model if validation loss improved
-        if val_loss < best_val_loss:
+        # Save nbody_model if validation loss improved, losses are reduced over ranks so all ranks agree
+        is_best = val_loss < best_val_loss
+        if is_best:
             best_val_loss = val_loss
-            torch.save(model.state_dict(), f'./{args.num_edges}_{args.zero_edges}_best_model.pth')
+            if is_main_process():
+                checkpoints.save_model(model, best_model_path)
             early_stopping_counter = 0
         else:
             early_stopping_counter += 1
 
+        # Snapshot the full training state, it is written to disk in the background
+        if (is_best or checkpoints.is_periodic(epoch)) and is_main_process():
+            state = snapshot(model, optimizer, scheduler, epoch, best_val_loss=best_val_loss,
+                             early_stopping_counter=early_stopping_counter, train_losses=train_losses,
+                             val_losses=val_losses, online_chunk=online_data.next_chunk if args.online else 0)
+            checkpoints.save(state, is_best=is_best)
+
         # Stop training if validation loss has not improved for early_stopping_limit epochs
         if early_stopping_counter >= args.early_stopping_limit:
-            print('Early stopping...')
+            if is_main_process():
+                print('Early stopping...')
             break
 
-        print(f'Epoch {epoch + 1}, Training Loss: {train_loss}, Validation Loss: {val_loss}')
+        if is_main_process():
+            print(f'Epoch {epoch + 1}, Training Loss: {train_loss}, Validation Loss: {val_loss}')
+            print(f'Train: {format_stats(train_stats)} | Validation: {format_stats(val_stats)}')
+
+    if args.online:
+        online_data.close()
+
+    checkpoints.close()
+    barrier()
 
     # Load the best nbody_model and test it
-    model.load_state_dict(torch.load(f'./{args.num_edges}_{args.zero_edges}_best_model.pth'))
-    test_loss = test_model(model, test_loader, criterion)
-    print(f'Test Loss: {test_loss}')
-    # Save the training and validation losses to a CSV file
-    save_losses_to_csv(args, train_losses, val_losses, test_loss)
+    load_model(model, best_model_path)
+    test_loss, test_stats = engine.evaluate(test_loader)
+    if is_main_process():
+        print(f'Test Loss: {test_loss}, {format_stats(test_stats)}')
+        # Save the training and validation losses to a CSV file
+        save_losses_to_csv(args, train_losses, val_losses, test_loss, horizon_losses=test_stats.get('horizon_loss'))
+    cleanup_distributed()
 
 
 if __name__ == '__main__':
@@ -1,3 +1,4 @@
 
 from .cliffordalgebra import *
 from .metric import *
+from .telemetry import *
@@ -10,6 +10,7 @@ import torch
 from torch import nn
 
 from .metric import ShortLexBasisBladeOrder, construct_gmt, gmt_element
+from .telemetry import AlgebraTelemetry
 
 
 class CliffordAlgebra(nn.Module):
@@ -46,6 +47,10 @@ class CliffordAlgebra(nn.Module):
         self.register_buffer("odd_grades", ~self.even_grades)
         self.register_buffer("cayley", cayley)
 
+    def telemetry(self, **kwargs):
+        """Opt-in operation counters and timers, active inside a with block."""
+        return AlgebraTelemetry(self, **kwargs)
+
     def geometric_product(self, a, b, blades=None):
         cayley = self.cayley
 
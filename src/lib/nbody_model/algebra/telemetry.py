@@ -0,0 +1,123 @@
+import collections
+import functools
+import time
+
+import torch
+
+# CliffordAlgebra operations that are counted, calls between them (norm -> q -> b -> geometric_product) are nested
+OPS = ("geometric_product", "b", "q", "norm", "norms", "qs", "embed", "embed_grade", "sandwich", "alpha", "beta",
+       "gamma", "get_grade", "inverse")
+
+
+def _tensors(values):
+    return [value for value in values if isinstance(value, torch.Tensor)]
+
+
+class OpStats:
+    def __init__(self):
+        self.calls = 0
+        self.blade_calls = 0
+        self.time = 0.0
+        self.self_time = 0.0
+        self.bytes = 0
+        self.shapes = collections.Counter()
+
+    def add(self, other):
+        self.calls += other.calls
+        self.blade_calls += other.blade_calls
+        self.time += other.time
+        self.self_time += other.self_time
+        self.bytes += other.bytes
+        self.shapes.update(other.shapes)
+
+
+class AlgebraTelemetry:
+    """Counts and times the operations of one CliffordAlgebra instance.
+
+    While active, the operations are replaced by timed wrappers on the instance, stop() removes them again so a
+    CliffordAlgebra without telemetry runs unchanged. For every operation the calls, the input shapes, the calls
+    with blades=, the inclusive and self time and the bytes of the outputs (allocated bytes on a GPU) are recorded,
+    per step when step() is called after every training step.
+    """
+
+    def __init__(self, algebra, ops=OPS, synchronize=None):
+        self.algebra = algebra
+        self.ops = ops
+        self.cuda = algebra.cayley.is_cuda
+        self.synchronize = self.cuda if synchronize is None else synchronize
+        self.current = collections.defaultdict(OpStats)
+        self.steps = []
+        self.stack = []
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def timed(*args, **kwargs):
+            # Time spent in nested operations is subtracted from the self time of the caller
+            self.stack.append(0.0)
+            allocated = torch.cuda.memory_allocated() if self.cuda else 0
+            start = self.now()
+            output = fn(*args, **kwargs)
+            elapsed = self.now() - start
+            nested = self.stack.pop()
+            if self.stack:
+                self.stack[-1] += elapsed
+
+            stats = self.current[name]
+            stats.calls += 1
+            stats.time += elapsed
+            stats.self_time += elapsed - nested
+            stats.blade_calls += kwargs.get("blades") is not None
+            stats.shapes[tuple(tuple(tensor.shape) for tensor in _tensors(args))] += 1
+            if self.cuda:
+                stats.bytes += torch.cuda.memory_allocated() - allocated
+            else:
+                outputs = output if isinstance(output, (list, tuple)) else [output]
+                stats.bytes += sum(tensor.numel() * tensor.element_size() for tensor in _tensors(outputs))
+            return output
+
+        return timed
+
+    def start(self):
+        for name in self.ops:
+            # Bound methods as instance attributes, they shadow the class methods for this instance only
+            object.__setattr__(self.algebra, name, self.wrap(name, getattr(type(self.algebra), name).__get__(
+                self.algebra)))
+        return self
+
+    def stop(self):
+        for name in self.ops:
+            self.algebra.__dict__.pop(name, None)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def step(self):
+        self.steps.append(dict(self.current))
+        self.current = collections.defaultdict(OpStats)
+
+    def totals(self):
+        totals = collections.defaultdict(OpStats)
+        for step in self.steps or [self.current]:
+            for name, stats in step.items():
+                totals[name].add(stats)
+        return totals
+
+    def summary(self, sort_by="self_time"):
+        """Per step averages of every operation, sorted by self time by default."""
+        steps = max(1, len(self.steps))
+        totals = self.totals()
+        lines = [f"{'operation':<18} {'calls':>8} {'blades=':>8} {'ms':>9} {'self ms':>9} {'MB':>9}  top input shapes"]
+        for name, stats in sorted(totals.items(), key=lambda item: getattr(item[1], sort_by), reverse=True):
+            shapes = ", ".join(f"{shape} x{count // steps}" for shape, count in stats.shapes.most_common(2))
+            lines.append(f"{name:<18} {stats.calls // steps:>8} {stats.blade_calls // steps:>8} "
+                         f"{1e3 * stats.time / steps:>9.3f} {1e3 * stats.self_time / steps:>9.3f} "
+                         f"{stats.bytes / steps / 2 ** 20:>9.2f}  {shapes}")
+        return "\n".join(lines)
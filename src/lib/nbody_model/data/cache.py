@@ -0,0 +1,188 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+
+from ..algebra import CliffordAlgebra
+
+MANIFEST = "manifest.json"
+CACHE_VERSION = 1
+DTYPES = {"fp32": torch.float32, "bf16": torch.bfloat16}
+
+# Positions, velocities and charges stay in fp32, they form the residual base and the target of the model.
+# Only the Clifford features (embedded nodes and edge attributes) are stored in the requested dtype.
+COMPACT_FIELDS = ("edge_attr", "nodes")
+
+
+def sha256sum(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def embed_nodes(clifford_algebra, loc, vel, charges):
+    # Same layout as NBodyGraphEmbedder: [charges | loc | vel] -> [batch, nodes, 3, 8]
+    invariants = clifford_algebra.embed(charges, (0,))
+    covariants = clifford_algebra.embed(torch.stack([loc, vel], dim=2), (1, 2, 3))
+    return torch.cat([invariants[:, :, None], covariants], dim=2)
+
+
+def to_numpy(tensor, dtype):
+    tensor = tensor.to(DTYPES[dtype]).contiguous()
+    if dtype == "bf16":
+        # numpy has no bfloat16, store the raw bits
+        tensor = tensor.view(torch.int16)
+    return tensor.numpy()
+
+
+def from_numpy(array, dtype):
+    tensor = torch.from_numpy(np.ascontiguousarray(array))
+    if dtype == "bf16":
+        tensor = tensor.view(torch.bfloat16)
+    return tensor
+
+
+def save_array(out_dir, name, array):
+    path = os.path.join(out_dir, name)
+    np.save(path, array)
+    return {"path": name, "sha256": sha256sum(path)}
+
+
+def preprocess_partition(dataset, clifford_algebra):
+    loc, vel, edge_attr, charges = dataset.data
+    # Center both frames on the mean of the input frame, the loss is translation invariant
+    loc = loc - loc[:, :1].mean(dim=2, keepdim=True)
+    nodes = embed_nodes(clifford_algebra, loc[:, 0], vel, charges)
+    return {"loc": loc, "vel": vel, "edge_attr": edge_attr, "charges": charges, "nodes": nodes}
+
+
+def write_cache(datasets, out_dir, shard_size=1000, dtype="fp32"):
+    """Writes preprocessed NBodyDataset partitions as sharded .npy files plus a json manifest."""
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown cache dtype {dtype}, expected one of {list(DTYPES)}")
+    os.makedirs(out_dir, exist_ok=True)
+    clifford_algebra = CliffordAlgebra([1, 1, 1])
+
+    first = next(iter(datasets.values()))
+    manifest = {
+        "version": CACHE_VERSION,
+        "suffix": first.suffix,
+        "frames": [first.frame_0, first.frame_T],
+        "dtype": dtype,
+        "n_nodes": first.get_n_nodes(),
+        "edges": save_array(out_dir, "edges.npy", first.edges.numpy()),
+        "partitions": {},
+    }
+
+    for partition, dataset in datasets.items():
+        fields = preprocess_partition(dataset, clifford_algebra)
+        shards = []
+        for shard, start in enumerate(range(0, len(dataset), shard_size)):
+            files = {}
+            for name, tensor in fields.items():
+                field_dtype = dtype if name in COMPACT_FIELDS else "fp32"
+                array = to_numpy(tensor[start:start + shard_size], field_dtype)
+                files[name] = save_array(out_dir, f"{partition}_{name}_{shard:04d}.npy", array)
+            shards.append({"num_samples": min(shard_size, len(dataset) - start), "files": files})
+        manifest["partitions"][partition] = {"num_samples": len(dataset), "shards": shards}
+
+    with open(os.path.join(out_dir, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+def read_manifest(cache_root):
+    with open(os.path.join(cache_root, MANIFEST)) as file:
+        manifest = json.load(file)
+    if manifest["version"] != CACHE_VERSION:
+        raise Exception("Unsupported cache version %s" % manifest["version"])
+    return manifest
+
+
+def load_array(cache_root, entry, verify=False):
+    path = os.path.join(cache_root, entry["path"])
+    if verify and sha256sum(path) != entry["sha256"]:
+        raise Exception("Checksum mismatch for cache file %s" % path)
+    return np.load(path, mmap_mode="r")
+
+
+class ShardedField:
+    """The memory-mapped shards of one cached field, indexed along the samples like the concatenated tensor.
+
+    Only the indexed samples are read and returned as a tensor, the shards themselves are never copied. Further
+    indices are applied to the gathered tensor, so field[indices, 0] works as for a tensor.
+    """
+
+    def __init__(self, arrays, dtype, num_samples):
+        self.arrays = arrays
+        self.dtype = dtype
+        self.offsets = np.cumsum([0] + [len(array) for array in arrays])
+        self.shape = torch.Size((num_samples, *arrays[0].shape[1:]))
+
+    def __len__(self):
+        return self.shape[0]
+
+    def size(self, dim=None):
+        return self.shape if dim is None else self.shape[dim]
+
+    def __getitem__(self, key):
+        index, rest = (key[0], key[1:]) if isinstance(key, tuple) else (key, ())
+        if isinstance(index, slice):
+            index = np.arange(*index.indices(len(self)))
+        elif torch.is_tensor(index):
+            index = index.cpu().numpy()
+        indices = np.asarray(index)
+        single = indices.ndim == 0
+        indices = np.atleast_1d(indices)
+        if len(indices) and (indices.min() < -len(self) or indices.max() >= len(self)):
+            raise IndexError("Index out of range for %d cached samples" % len(self))
+        indices = np.where(indices < 0, indices + len(self), indices)
+        shards = np.searchsorted(self.offsets, indices, side="right") - 1
+        gathered = np.empty((len(indices), *self.shape[1:]), dtype=self.arrays[0].dtype)
+        for shard in np.unique(shards):
+            mask = shards == shard
+            gathered[mask] = self.arrays[shard][indices[mask] - self.offsets[shard]]
+        tensor = from_numpy(gathered, self.dtype)
+        if single:
+            tensor = tensor[0]
+        return tensor[rest] if rest else tensor
+
+    def share_memory_(self):
+        # Memory maps are shared between data loader workers by the page cache
+        return self
+
+
+def load_cache(cache_root, partition, max_samples=None, verify=False):
+    """Opens the shards of one partition, returns the manifest, the fields as ShardedField and the edge topology.
+
+    The checksums of the manifest are computed from the files as written, verify re-hashes every opened shard
+    against them, which reads the whole partition.
+    """
+    manifest = read_manifest(cache_root)
+    if partition not in manifest["partitions"]:
+        raise Exception("Partition %s not found in cache %s" % (partition, cache_root))
+    shards = manifest["partitions"][partition]["shards"]
+    if max_samples is not None:
+        kept, total = [], 0
+        for shard in shards:
+            if total >= max_samples:
+                break
+            kept.append(shard)
+            total += shard["num_samples"]
+        shards = kept
+    num_samples = sum(shard["num_samples"] for shard in shards)
+    if max_samples is not None:
+        num_samples = min(num_samples, max_samples)
+
+    fields = {}
+    for name in shards[0]["files"]:
+        arrays = [load_array(cache_root, shard["files"][name], verify) for shard in shards]
+        field_dtype = manifest["dtype"] if name in COMPACT_FIELDS else "fp32"
+        fields[name] = ShardedField(arrays, field_dtype, num_samples)
+
+    edges = torch.from_numpy(np.array(load_array(cache_root, manifest["edges"], verify)))
+    return manifest, fields, edges
@@ -1,10 +1,18 @@
 # Taken from EGNN repo with minor changes made
+import functools
+import math
 import os
 
 import numpy as np
 import torch
 from torch.utils import data
 
+from .cache import load_cache
+
+DEFAULT_SUFFIX = '_charged5_initvel1small'
+# Input and target frame of the datasets we ship
+DEFAULT_FRAMES = {DEFAULT_SUFFIX: (30, 40)}
+
 
 def get_edges(adjacency_matrices):
     batch_size, n_nodes, _ = adjacency_matrices.shape
@@ -30,45 +38,92 @@ def get_edges(adjacency_matrices):
     return edges_tensor, edge_attr_tensor
 
 
+def to_tensor(array):
+    # Single float32 copy of the selected slice, wrapped without a further copy
+    return torch.from_numpy(np.ascontiguousarray(array, dtype=np.float32))
+
+
+def random_batch(batch_size, n_nodes=5, generator=None):
+    """A batch of random charged systems in the layout of NBodyDataset.get_batch, for measurements and tests."""
+    loc = torch.randn(batch_size, n_nodes, 3, generator=generator)
+    vel = torch.randn(batch_size, n_nodes, 3, generator=generator)
+    charges = torch.randint(0, 2, (batch_size, n_nodes, 1), generator=generator).float() * 2 - 1
+    edges, edge_attr = get_edges((charges @ charges.transpose(1, 2)).numpy())
+    loc_end = loc + 0.1 * torch.randn(batch_size, n_nodes, 3, generator=generator)
+    return [loc, vel, edge_attr, charges, loc_end, edges.expand(batch_size, *edges.shape)]
+
+
 class NBodyDataset:
-    def __init__(self, partition, data_root = "./nbody_dataset/", suffix='_charged5_initvel1small', max_samples=1000):
+    def __init__(self, partition, data_root = "./nbody_dataset/", suffix=DEFAULT_SUFFIX, max_samples=1000,
+                 cache_root=None, frame_0=None, frame_T=None, horizons=None):
 
         self.suffix = suffix  # '_charged5_initvel1small'
         self.data_root = data_root  # 'nbody_dataset/'
         self.max_samples = int(max_samples)
         self.partition = partition  # train, val, test
+        self.cache_root = cache_root  # directory written by preprocess_dataset.py
+        self.frame_0, self.frame_T = self.get_frames(frame_0, frame_T)
+        self.nodes = None  # pre-embedded Clifford node features, only available from a cache
+        # Frame offsets after frame_0 of the targets of a multi-horizon model, they replace frame_T
+        self.horizons = horizons
+        self.target = 1 if horizons is None else slice(1, None)
 
-        self.data, self.edges = self.load()
+        if self.cache_root is None:
+            self.data, self.edges = self.load()
+        else:
+            self.data, self.edges = self.load_cache()
+
+    def get_frames(self, frame_0=None, frame_T=None):
+        if frame_0 is not None and frame_T is not None:
+            return frame_0, frame_T
+        if self.suffix in DEFAULT_FRAMES:
+            return DEFAULT_FRAMES[self.suffix]
+        else:
+            raise Exception("No default frames for dataset %s, pass frame_0 and frame_T" % self.suffix)
 
     def load(self):
-       # Load the .npy files for loc, vel, edges, and charges
-        loc = np.load(self.data_root + "loc_" + self.partition + self.suffix + ".npy")
-        vel = np.load(self.data_root + "vel_" + self.partition + self.suffix + ".npy")
-        edges = np.load(self.data_root + "edges_" + self.partition + self.suffix + ".npy")
-        charges = np.load(self.data_root + "charges_" + self.partition + self.suffix + ".npy")
+        # Memory-map the .npy files so only the frames and samples we use are ever read from disk
+        loc = np.load(self.data_root + "loc_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+        vel = np.load(self.data_root + "vel_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+        edges = np.load(self.data_root + "edges_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+        charges = np.load(self.data_root + "charges_" + self.partition + self.suffix + ".npy", mmap_mode='r')
         # Preprocess the data
         loc, vel, edge_attr, edges, charges = self.preprocess(loc, vel, edges, charges)
 
         return (loc, vel, edge_attr, charges), edges
 
+    def load_cache(self):
+        if self.horizons is not None:
+            raise Exception("The cache only holds frame_0 and frame_T, load horizons from data_root")
+        manifest, fields, edges = load_cache(self.cache_root, self.partition, max_samples=self.max_samples)
+        if manifest["suffix"] != self.suffix or manifest["frames"] != [self.frame_0, self.frame_T]:
+            raise Exception("Cache %s was built for %s with frames %s" % (self.cache_root, manifest["suffix"],
+                                                                          manifest["frames"]))
+        self.nodes = fields["nodes"]
+        return (fields["loc"], fields["vel"], fields["edge_attr"], fields["charges"]), edges
+
     def preprocess(self, loc, vel, edges, charges):
-        #print("before",loc.shape, vel.shape, edges.shape, charges.shape)
-        # Convert arrays to tensors and adjust dimension ordering
-        loc = torch.tensor(loc).float().permute(0, 1, 3, 2)  # [batch, nodes, features, time_steps]
-        vel = torch.tensor(vel).float().permute(0, 1, 3, 2)  # [batch, nodes, features, time_steps]
-        charges = torch.tensor(charges).float()
-        #print("after", loc.shape, vel.shape, edges.shape, charges.shape)
-
-        # Limit the number of samples if max_samples is set
+        # Limit the number of samples if max_samples is set, this only slices the memory map
         if self.max_samples is not None:
             loc, vel, edges, charges = self.limit_samples(loc, vel, edges, charges)
 
+        # Gather the required frames and adjust dimension ordering
+        if self.horizons is None:
+            frames = [self.frame_0, self.frame_T]
+        else:
+            frames = [self.frame_0] + [self.frame_0 + horizon for horizon in self.horizons]
+            if frames[-1] >= loc.shape[1]:
+                raise Exception("Horizon frame %d does not exist in %d frames" % (frames[-1], loc.shape[1]))
+        loc = to_tensor(loc[:, frames].transpose(0, 1, 3, 2))  # [batch, frames, nodes, features]
+        vel = to_tensor(vel[:, self.frame_0].transpose(0, 2, 1))  # [batch, nodes, features]
+        charges = to_tensor(charges)
+
         # Handle edges
-        edges, edge_attr = get_edges(edges)
+        edges, edge_attr = get_edges(np.asarray(edges))
         return loc, vel, edge_attr, edges, charges
 
     def limit_samples(self, loc, vel, edges, charges):
-        min_size = min(loc.size(0), self.max_samples)
+        min_size = min(loc.shape[0], self.max_samples)
         loc = loc[:min_size]
         vel = vel[:min_size]
         charges = charges[:min_size]
@@ -77,47 +132,231 @@ class NBodyDataset:
 
     def __getitem__(self, i):
         loc, vel, edge_attr, charges = self.data
-        loc, vel, edge_attr, charges = loc[i], vel[i], edge_attr[i], charges[i]
+        if self.nodes is not None:
+            return loc[i, 0], vel[i], edge_attr[i], charges[i], loc[i, self.target], self.edges, self.nodes[i]
+        return loc[i, 0], vel[i], edge_attr[i], charges[i], loc[i, self.target], self.edges
 
-        if self.suffix == '_charged5_initvel1small':
-            frame_0, frame_T = 30, 40
-        else:
-            raise Exception("Wrong dataset partition %s" % self.suffix)
+    def get_batch(self, indices):
+        # One indexing op per tensor, the shared topology is broadcast instead of stacked per sample
+        loc, vel, edge_attr, charges = self.data
+        loc = loc[indices]
+        edges = self.edges.expand(len(indices), *self.edges.shape)
+        batch = [loc[:, 0], vel[indices], edge_attr[indices], charges[indices], loc[:, self.target], edges]
+        if self.nodes is not None:
+            batch.append(self.nodes[indices])
+        return batch
 
-        return loc[frame_0], vel[frame_0], edge_attr, charges, loc[frame_T], self.edges
+    def share_memory(self):
+        # Move the tensors to shared memory, so forked or spawned workers read them without a copy
+        for tensor in (*self.data, self.edges) + ((self.nodes,) if self.nodes is not None else ()):
+            tensor.share_memory_()
+        return self
 
     def __len__(self):
         return len(self.data[0])
 
     def get_n_nodes(self):
-        return self.data[0].size(1)
+        return self.data[0].size(2)
+
+
+class NBodyTrajectoryDataset:
+    """Every (t, t + delta) window of every simulation, gathered lazily from memory-mapped trajectories."""
+
+    def __init__(self, partition, data_root = "./nbody_dataset/", suffix=DEFAULT_SUFFIX, max_samples=1000,
+                 delta=10, stride=1, start_frame=0, horizons=None):
+
+        self.suffix = suffix
+        self.data_root = data_root
+        self.max_samples = int(max_samples)
+        self.partition = partition
+        self.delta = delta
+        self.stride = stride
+        # Multi-horizon targets t + horizon replace the single target t + delta
+        self.horizons = horizons
+        self.offsets = [delta] if horizons is None else list(horizons)
+
+        self.loc, self.vel, self.edge_attr, self.charges, self.edges = self.load()
+        # Valid start frames, the last target frame has to exist
+        self.starts = np.arange(start_frame, self.loc.shape[1] - max(self.offsets), stride)
+        if len(self.starts) == 0:
+            raise Exception("No window of length %d fits in %d frames" % (max(self.offsets), self.loc.shape[1]))
+
+    def load(self):
+        loc = np.load(self.data_root + "loc_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+        vel = np.load(self.data_root + "vel_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+        edges = np.load(self.data_root + "edges_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+        charges = np.load(self.data_root + "charges_" + self.partition + self.suffix + ".npy", mmap_mode='r')
+
+        # Trajectories stay on disk, only the small per-simulation attributes are read
+        loc, vel = loc[:self.max_samples], vel[:self.max_samples]
+        edges, edge_attr = get_edges(np.asarray(edges[:self.max_samples]))
+        charges = to_tensor(charges[:self.max_samples])
+        return loc, vel, edge_attr, charges, edges
+
+    def get_batch(self, indices):
+        sims, starts = np.divmod(np.asarray(indices), len(self.starts))
+        frames = self.starts[starts]
+        # Fancy indexing a memmap only reads the requested frames, [batch, features, nodes] -> [batch, nodes, features]
+        loc_0 = to_tensor(self.loc[sims, frames].transpose(0, 2, 1))
+        loc_T = [to_tensor(self.loc[sims, frames + offset].transpose(0, 2, 1)) for offset in self.offsets]
+        loc_T = loc_T[0] if self.horizons is None else torch.stack(loc_T, dim=1)
+        vel = to_tensor(self.vel[sims, frames].transpose(0, 2, 1))
+        sims = torch.from_numpy(sims)
+        edges = self.edges.expand(len(sims), *self.edges.shape)
+        return [loc_0, vel, self.edge_attr[sims], self.charges[sims], loc_T, edges]
+
+    def __getitem__(self, i):
+        loc, vel, edge_attr, charges, loc_end, edges = self.get_batch([i])
+        return loc[0], vel[0], edge_attr[0], charges[0], loc_end[0], self.edges
+
+    def share_memory(self):
+        # The trajectories are memory maps and already shared through the page cache
+        for tensor in (self.edge_attr, self.charges, self.edges):
+            tensor.share_memory_()
+        return self
+
+    def __len__(self):
+        return self.loc.shape[0] * len(self.starts)
+
+    def get_n_nodes(self):
+        return self.loc.shape[3]
+
+
+class NBodyBatchDataset(data.Dataset):
+    """Map-style view of an NBodyDataset whose items are whole batches, indexed by NBodyBatchSampler."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, indices):
+        return self.dataset.get_batch(indices)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class NBodyBatchSampler(data.Sampler):
+    """Yields index tensors of a full batch, so a batch is gathered without per-sample collation.
+
+    With num_replicas > 1 every rank shuffles with the same seed and epoch and takes every num_replicas-th sample.
+    """
+
+    def __init__(self, num_samples, batch_size, shuffle=False, drop_last=False, generator=None, num_replicas=1,
+                 rank=0, seed=0):
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.generator = generator
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.shuffle:
+            generator = self.generator
+            if self.num_replicas > 1:
+                generator = torch.Generator().manual_seed(self.seed + self.epoch)
+            order = torch.randperm(self.num_samples, generator=generator)
+        else:
+            order = torch.arange(self.num_samples)
+        if self.drop_last:
+            # Every rank has to take the same number of steps
+            order = order[:len(order) - len(order) % self.num_replicas]
+        order = order[self.rank::self.num_replicas]
+        stop = len(self) * self.batch_size if self.drop_last else len(order)
+        for start in range(0, stop, self.batch_size):
+            yield order[start:start + self.batch_size]
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.num_replicas // self.batch_size
+        return math.ceil(len(range(self.rank, self.num_samples, self.num_replicas)) / self.batch_size)
 
 
 class NBody:
-    def __init__(self, data_root = "./nbody_dataset/", num_samples=3000, batch_size=100):
-        self.train_dataset = NBodyDataset(
-            partition="train", data_root=data_root, max_samples=num_samples, suffix='_charged5_initvel1small'
+    def __init__(self, data_root = "./nbody_dataset/", num_samples=3000, batch_size=100, cache_root=None,
+                 num_workers=0, pin_memory=False, prefetch_factor=2, sliding_window=False, delta=10, stride=1,
+                 suffix=DEFAULT_SUFFIX, frame_0=None, frame_T=None, num_replicas=1, rank=0, horizons=None):
+        self.data_root = data_root
+        self.suffix = suffix
+        self.frame_0 = frame_0
+        self.frame_T = frame_T
+        self.cache_root = cache_root
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+        self.prefetch_factor = prefetch_factor
+        # Train on every (t, t + delta) window instead of the fixed frame pair, evaluation stays on the fixed pair
+        self.sliding_window = sliding_window
+        if sliding_window and cache_root is not None:
+            # Training would read the raw trajectories while evaluation reads the cache
+            raise Exception("Sliding windows read the raw trajectories, they do not work with a cache_root")
+        self.delta = delta
+        self.stride = stride
+        # Data parallel training, every rank iterates over its own share of each partition
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # Frame offsets of the targets of a multi-horizon model
+        self.horizons = horizons
+
+    # Partitions are only read from disk the first time they are used
+    @functools.cached_property
+    def train_dataset(self):
+        if self.sliding_window:
+            return NBodyTrajectoryDataset(
+                partition="train", data_root=self.data_root, max_samples=self.num_samples,
+                suffix=self.suffix, delta=self.delta, stride=self.stride, horizons=self.horizons
+            )
+        return NBodyDataset(
+            partition="train", data_root=self.data_root, max_samples=self.num_samples, suffix=self.suffix,
+            cache_root=self.cache_root, frame_0=self.frame_0, frame_T=self.frame_T, horizons=self.horizons
         )
-        self.valid_dataset = NBodyDataset(
-            partition="valid", data_root=data_root, max_samples=num_samples, suffix='_charged5_initvel1small'
+
+    @functools.cached_property
+    def valid_dataset(self):
+        return NBodyDataset(
+            partition="valid", data_root=self.data_root, max_samples=self.num_samples, suffix=self.suffix,
+            cache_root=self.cache_root, frame_0=self.frame_0, frame_T=self.frame_T, horizons=self.horizons
         )
-        self.test_dataset = NBodyDataset(
-            partition="test", data_root=data_root, max_samples=num_samples, suffix='_charged5_initvel1small'
+
+    @functools.cached_property
+    def test_dataset(self):
+        return NBodyDataset(
+            partition="test", data_root=self.data_root, max_samples=self.num_samples, suffix=self.suffix,
+            cache_root=self.cache_root, frame_0=self.frame_0, frame_T=self.frame_T, horizons=self.horizons
         )
 
-        self.batch_size = batch_size
+    def share_memory(self, partitions=("train", "valid", "test")):
+        datasets = {"train": self.train_dataset, "valid": self.valid_dataset, "test": self.test_dataset}
+        for partition in partitions:
+            datasets[partition].share_memory()
+        return self
 
-    def train_loader(self):
+    def get_loader(self, dataset, shuffle=False, drop_last=False, batch_size=None, num_samples=None):
+        batch_size = self.batch_size if batch_size is None else batch_size
+        # num_samples restricts the loader to the first samples of the partition
+        num_samples = len(dataset) if num_samples is None else min(num_samples, len(dataset))
+        sampler = NBodyBatchSampler(num_samples, batch_size, shuffle=shuffle, drop_last=drop_last,
+                                    num_replicas=self.num_replicas, rank=self.rank)
+        # batch_size=None disables automatic batching, every sampled index tensor is already a batch
         return data.DataLoader(
-            self.train_dataset, batch_size=self.batch_size, shuffle=True, drop_last=True
+            NBodyBatchDataset(dataset), sampler=sampler, batch_size=None, num_workers=self.num_workers,
+            pin_memory=self.pin_memory, prefetch_factor=self.prefetch_factor if self.num_workers > 0 else None,
+            persistent_workers=self.num_workers > 0
         )
 
-    def val_loader(self):
-        return data.DataLoader(
-            self.valid_dataset, batch_size=self.batch_size, shuffle=False
-        )
+    def train_loader(self, batch_size=None, num_samples=None):
+        return self.get_loader(self.train_dataset, shuffle=True, drop_last=True, batch_size=batch_size,
+                               num_samples=num_samples)
 
-    def test_loader(self):
-        return data.DataLoader(
-            self.test_dataset, batch_size=self.batch_size, shuffle=False
-        )
+    def val_loader(self, batch_size=None):
+        return self.get_loader(self.valid_dataset, batch_size=batch_size)
+
+    def test_loader(self, batch_size=None):
+        return self.get_loader(self.test_dataset, batch_size=batch_size)
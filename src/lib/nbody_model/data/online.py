@@ -0,0 +1,114 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from torch.utils import data
+
+from .nbody import get_edges, to_tensor
+from .simulate import ChargedParticlesSim
+
+
+def simulate_pairs(sim, num_sims, frame_0, frame_T, sample_freq, rng):
+    # Only integrate as far as the target frame, frame k is recorded at step (k + 1) * sample_freq
+    T = (frame_T + 2) * sample_freq
+    loc, vel, edges, charges = sim.sample_trajectories(num_sims, T=T, sample_freq=sample_freq, rng=rng)
+    edges, edge_attr = get_edges(edges)
+    return [
+        to_tensor(loc[:, frame_0].transpose(0, 2, 1)),
+        to_tensor(vel[:, frame_0].transpose(0, 2, 1)),
+        edge_attr,
+        to_tensor(charges),
+        to_tensor(loc[:, frame_T].transpose(0, 2, 1)),
+        edges,
+    ]
+
+
+def produce(queue, producer, seed, sim_kwargs, chunk_size, frame_0, frame_T, sample_freq, start_chunk=0):
+    """Simulator worker, fills its bounded queue with chunks and blocks when the trainer falls behind."""
+    sim = ChargedParticlesSim(**sim_kwargs)
+    chunk = start_chunk
+    while True:
+        # Chunk k of producer p always uses the same seed, independent of timing
+        rng = np.random.default_rng([seed, producer, chunk])
+        pairs = simulate_pairs(sim, chunk_size, frame_0, frame_T, sample_freq, rng)
+        queue.put([tensor.share_memory_() for tensor in pairs])
+        chunk += 1
+
+
+class OnlineNBodyDataset(data.IterableDataset):
+    """Trains on freshly simulated charged N-body systems streamed from simulator processes.
+
+    next_chunk is the first chunk index no producer has handed out yet, passing it as start_chunk continues the
+    stream with new systems, e.g. when resuming from a checkpoint.
+    """
+
+    def __init__(self, batch_size, steps_per_epoch, n_balls=5, frame_0=30, frame_T=40, sample_freq=100,
+                 num_producers=2, chunk_size=500, queue_size=4, seed=42, start_chunk=0, **sim_kwargs):
+        self.batch_size = batch_size
+        self.steps_per_epoch = steps_per_epoch
+        self.n_balls = n_balls
+        self.frame_0 = frame_0
+        self.frame_T = frame_T
+        self.sample_freq = sample_freq
+        self.num_producers = num_producers
+        self.chunk_size = chunk_size
+        self.queue_size = queue_size
+        self.seed = seed
+        self.start_chunk = start_chunk
+        self.next_chunk = start_chunk
+        self.sim_kwargs = dict(sim_kwargs, n_balls=n_balls)
+
+        self.queues = None
+        self.producers = []
+        # The stream continues across epochs, every epoch sees new systems
+        self.batches = self.batch_stream()
+
+    def start(self):
+        context = mp.get_context('fork')
+        # One bounded queue per producer: a full queue blocks its producer (backpressure) and reading the
+        # queues round-robin makes the order of samples reproducible for a given seed
+        self.queues = [context.Queue(maxsize=self.queue_size) for _ in range(self.num_producers)]
+        for producer, queue in enumerate(self.queues):
+            process = context.Process(
+                target=produce, daemon=True,
+                args=(queue, producer, self.seed, self.sim_kwargs, self.chunk_size, self.frame_0, self.frame_T,
+                      self.sample_freq, self.start_chunk)
+            )
+            process.start()
+            self.producers.append(process)
+
+    def chunk_stream(self):
+        if self.queues is None:
+            self.start()
+        chunk = self.start_chunk
+        while True:
+            self.next_chunk = chunk + 1
+            for queue in self.queues:
+                yield queue.get()
+            chunk += 1
+
+    def batch_stream(self):
+        leftover = None
+        for *fields, edges in self.chunk_stream():
+            if leftover is not None:
+                fields = [torch.cat(pair) for pair in zip(leftover, fields)]
+            num_batches = len(fields[0]) // self.batch_size
+            for start in range(0, num_batches * self.batch_size, self.batch_size):
+                batch = [field[start:start + self.batch_size] for field in fields]
+                yield batch + [edges.expand(self.batch_size, *edges.shape)]
+            leftover = [field[num_batches * self.batch_size:] for field in fields]
+
+    def __iter__(self):
+        for _ in range(self.steps_per_epoch):
+            yield next(self.batches)
+
+    def __len__(self):
+        return self.steps_per_epoch
+
+    def get_n_nodes(self):
+        return self.n_balls
+
+    def close(self):
+        for process in self.producers:
+            process.terminate()
+            process.join()
+        self.producers = []
@@ -1,3 +1,4 @@
 from .attention import *
 from .clifford_embedding import *
 from .block import *
+from .ensemble import *
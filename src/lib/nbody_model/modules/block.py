@@ -24,12 +24,12 @@ class GpLayer(nn.Module):
         return x
 
 class TransformerBlock(nn.Module):
-    def __init__(self, d_model, num_heads, clifford_algebra, num_edges=20):
+    def __init__(self, d_model, num_heads, clifford_algebra, num_edges=20, n_nodes=5):
         super(TransformerBlock, self).__init__()
 
         self.algebra = clifford_algebra
         self.mvlayernorm1 = MVLayerNorm(clifford_algebra, d_model)
-        self.self_attn = SelfAttentionClifford(d_model, 5, num_edges, clifford_algebra, num_heads)
+        self.self_attn = SelfAttentionClifford(d_model, n_nodes, num_edges, clifford_algebra, num_heads)
         self.mvlayernorm2 = MVLayerNorm(clifford_algebra, d_model)
         self.mvlayernorm3 = MVLayerNorm(clifford_algebra, d_model)
         self.mlp = nn.Sequential(
@@ -66,10 +66,11 @@ class TransformerBlock(nn.Module):
 
 
 class MainBody(nn.Module):
-    def __init__(self, num_layers, d_model, num_heads, clifford_algebra, num_edges=20):
+    def __init__(self, num_layers, d_model, num_heads, clifford_algebra, num_edges=20, n_nodes=5):
         super(MainBody, self).__init__()
         self.layers = nn.ModuleList(
-            [TransformerBlock(d_model, num_heads, clifford_algebra, num_edges=num_edges) for _ in range(num_layers)])
+            [TransformerBlock(d_model, num_heads, clifford_algebra, num_edges=num_edges, n_nodes=n_nodes)
+             for _ in range(num_layers)])
 
     def forward(self, src, src_mask=None):
         for layer in self.layers:
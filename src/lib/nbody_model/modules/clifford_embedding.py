@@ -1,8 +1,23 @@
 import torch
 from ..original_modules.linear import MVLinear
 
+
+def complete_graph(n_nodes, device=None):
+    # Every ordered pair of distinct nodes, in the order of get_edges in the dataset
+    rows, cols = torch.meshgrid(torch.arange(n_nodes, device=device), torch.arange(n_nodes, device=device),
+                                indexing='ij')
+    mask = rows != cols
+    return torch.stack([rows[mask], cols[mask]])
+
+
+def charge_products(charges, edges):
+    # Edge attributes of the dataset, the product of the charges of both nodes, edges is [2, edges]
+    products = charges @ charges.transpose(1, 2)
+    return products[:, edges[0], edges[1]].unsqueeze(-1)
+
+
 class NBodyGraphEmbedder:
-    def __init__(self, clifford_algebra, in_features, embed_dim, num_edges=10, zero_edges=True):
+    def __init__(self, clifford_algebra, in_features, embed_dim, num_edges=10, zero_edges=True, n_nodes=5):
         self.clifford_algebra = clifford_algebra
         self.node_projection = MVLinear(
             self.clifford_algebra, in_features, embed_dim, subspaces=False
@@ -13,24 +28,31 @@ class NBodyGraphEmbedder:
         self.embed_dim = embed_dim
         self.zero_edges = zero_edges
         self.num_edges = num_edges
-        if num_edges == 10:
-            self.unique_edges = True
-            self.with_edges = True
-        elif num_edges == 20:
+        self.n_nodes = n_nodes
+        # Either no edges, one edge per node pair or both directions of every pair (10 or 20 for 5 nodes)
+        if num_edges == 0:
             self.unique_edges = False
+            self.with_edges = False
+        elif num_edges == n_nodes * (n_nodes - 1) // 2:
+            self.unique_edges = True
             self.with_edges = True
         else:
-            assert num_edges == 0
+            assert num_edges == n_nodes * (n_nodes - 1)
             self.unique_edges = False
-            self.with_edges = False
+            self.with_edges = True
 
     def embed_nbody_graphs(self, batch):
-        loc_mean, vel, edge_attr, charges, edges = self.preprocess(batch)
-        # Embed data in Clifford space
-        invariants = self.clifford_algebra.embed(charges, (0,))
-        xv = torch.stack([loc_mean, vel], dim=1)
-        covariants = self.clifford_algebra.embed(xv, (1, 2, 3))
-        nodes_stack = torch.cat([invariants[:, None], covariants], dim=1)
+        if len(batch) > 6:
+            # Batch from a preprocessed cache, nodes are already centered and embedded
+            edge_attr, edges = batch[2].float(), batch[5]
+            nodes_stack = batch[6].float().view(-1, 3, 8)
+        else:
+            loc_mean, vel, edge_attr, charges, edges = self.preprocess(batch)
+            # Embed data in Clifford space
+            invariants = self.clifford_algebra.embed(charges, (0,))
+            xv = torch.stack([loc_mean, vel], dim=1)
+            covariants = self.clifford_algebra.embed(xv, (1, 2, 3))
+            nodes_stack = torch.cat([invariants[:, None], covariants], dim=1)
         # nodes_stack[:,1,0] += 1
         full_node_embedding = self.node_projection(nodes_stack)
         batch_size, n_nodes, _ = batch[0].size()
@@ -44,7 +66,73 @@ class NBodyGraphEmbedder:
         else:
             return full_node_embedding, None
 
+    def embed_features(self, batch):
+        """Node and edge multivectors of embed_nbody_graphs before the projections, with the attention mask.
 
+        They hold no weights, so models that share the edge configuration can share them. The edge features are
+        None without edges or with zero edges.
+        """
+        if len(batch) > 6:
+            edge_attr, edges = batch[2].float(), batch[5]
+            nodes_stack = batch[6].float().view(-1, 3, 8)
+        else:
+            loc_mean, vel, edge_attr, charges, edges = self.preprocess(batch)
+            invariants = self.clifford_algebra.embed(charges, (0,))
+            covariants = self.clifford_algebra.embed(torch.stack([loc_mean, vel], dim=1), (1, 2, 3))
+            nodes_stack = torch.cat([invariants[:, None], covariants], dim=1)
+        if not self.with_edges:
+            return nodes_stack, None, None
+        batch_size, n_nodes, _ = batch[0].size()
+        edges, indices = self.get_edge_nodes(edges, n_nodes, batch_size)
+        attention_mask = self.get_attention_mask(batch_size, n_nodes, edges)
+        if self.zero_edges:
+            return nodes_stack, None, attention_mask
+        if self.unique_edges:
+            edge_attr = edge_attr[:, indices, :]
+        edge_features = torch.cat((self.embed_edge_attr(edge_attr), self.make_edge_attr(nodes_stack, edges)), dim=1)
+        return nodes_stack, edge_features, attention_mask
+
+    def prepare_topology(self, edges, batch_size, n_nodes):
+        """Batched edge indices and attention mask, they only depend on the topology and the batch size."""
+        topology = {'batch_size': batch_size, 'n_nodes': n_nodes}
+        if self.with_edges:
+            edges, indices = self.get_edge_nodes(edges, n_nodes, batch_size)
+            topology['edges'] = edges
+            topology['indices'] = indices
+            topology['attention_mask'] = self.get_attention_mask(batch_size, n_nodes, edges)
+        return topology
+
+    def prepare_graph(self, edge_attr, charges, edges, batch_size, n_nodes, topology=None):
+        """The parts of the embedding that only depend on the charges and the topology, for embed_step.
+
+        A topology of prepare_topology for the same edges and batch size is reused instead of rebuilt.
+        """
+        graph = dict(topology or self.prepare_topology(edges, batch_size, n_nodes))
+        graph['invariants'] = self.clifford_algebra.embed(self.flatten_tensors(charges)[0], (0,))
+        if self.with_edges:
+            if self.unique_edges:
+                edge_attr = edge_attr[:, graph['indices'], :]
+            graph['edge_attr'] = self.embed_edge_attr(edge_attr)
+        return graph
+
+    def embed_step(self, loc, vel, graph):
+        """Embeds new positions and velocities of the systems of a prepared graph."""
+        batch_size, n_nodes = graph['batch_size'], graph['n_nodes']
+        loc_mean, vel = self.flatten_tensors(self.compute_mean_centered(loc), vel)
+        covariants = self.clifford_algebra.embed(torch.stack([loc_mean, vel], dim=1), (1, 2, 3))
+        nodes_stack = torch.cat([graph['invariants'][:, None], covariants], dim=1)
+        full_node_embedding = self.node_projection(nodes_stack)
+        if not self.with_edges:
+            return full_node_embedding, None
+        if self.zero_edges:
+            full_edge_embedding = torch.zeros((batch_size, self.num_edges, self.embed_dim, 8), device=loc.device)
+        else:
+            extra_edge_attr_clifford = self.make_edge_attr(nodes_stack, graph['edges'])
+            edge_attr_all = torch.cat((graph['edge_attr'], extra_edge_attr_clifford), dim=1)
+            full_edge_embedding = self.edge_projection(edge_attr_all)
+        full_embedding = torch.cat((full_node_embedding.reshape(batch_size, n_nodes, self.embed_dim, 8),
+                                    full_edge_embedding.reshape(batch_size, self.num_edges, self.embed_dim, 8)), dim=1)
+        return full_embedding, graph['attention_mask']
 
     def get_full_edge_embedding(self,edge_attr, nodes_stack, edges, n_nodes, batch_size):
         edges, indices = self.get_edge_nodes(edges, n_nodes, batch_size)
@@ -59,7 +147,7 @@ class NBodyGraphEmbedder:
             return full_edge_embedding, (start_nodes, end_nodes)
 
     def preprocess(self, batch):
-        loc, vel, edge_attr, charges, _, edges = batch
+        loc, vel, edge_attr, charges, _, edges = batch[:6]
         # print("before",loc.shape, vel.shape, edge_attr.shape, edges.shape, charges.shape)
         loc_mean = self.compute_mean_centered(loc)
         loc_mean, vel, charges = self.flatten_tensors(loc_mean, vel, charges, )
@@ -82,12 +170,14 @@ class NBodyGraphEmbedder:
         else:
             return tuple(edges.transpose(0, 1).flatten(1)), None
 
-    def get_edge_embedding(self, edge_attr, nodes_in_clifford, edges):
+    def embed_edge_attr(self, edge_attr):
         if self.unique_edges:
-            orig_edge_attr_clifford = self.clifford_algebra.embed(edge_attr[..., None], (0,)).view(-1, 1, 8)
-        else:
-            edge_attr = self.flatten_tensors(edge_attr)[0]  # [batch * edges, dim]
-            orig_edge_attr_clifford = self.clifford_algebra.embed(edge_attr[..., None], (0,))
+            return self.clifford_algebra.embed(edge_attr[..., None], (0,)).view(-1, 1, 8)
+        edge_attr = self.flatten_tensors(edge_attr)[0]  # [batch * edges, dim]
+        return self.clifford_algebra.embed(edge_attr[..., None], (0,))
+
+    def get_edge_embedding(self, edge_attr, nodes_in_clifford, edges):
+        orig_edge_attr_clifford = self.embed_edge_attr(edge_attr)
 
         extra_edge_attr_clifford = self.make_edge_attr(nodes_in_clifford, edges)
         edge_attr_all = torch.cat((orig_edge_attr_clifford, extra_edge_attr_clifford), dim=1)
@@ -0,0 +1,187 @@
+import math
+
+import torch
+
+from ..original_modules.mvlayernorm import EPS
+
+
+def stacked_linear(algebra, input, weight, bias=None):
+    """MVLinear of every member, input is [members, rows, in, 8] or [rows, in, 8] shared by all members.
+
+    weight is [members, out, in, subspaces] or [members, out, in] without subspaces and bias [members, 1, out, 1].
+    """
+    members = 'e' if input.dim() == 4 else ''
+    if weight.dim() == 4:
+        weight = weight.repeat_interleave(algebra.subspaces, dim=-1)
+        result = torch.einsum(f"{members}bmi,enmi->ebni", input, weight)
+    else:
+        result = torch.einsum(f"{members}bmi,enm->ebni", input.float(), weight)
+    if bias is not None:
+        result = result + algebra.embed(bias, (0,))
+    return result
+
+
+def stacked_layer_norm(algebra, input, a):
+    norm = algebra.norm(input)[..., :1].mean(dim=-2, keepdim=True) + EPS
+    return a[..., None] * input / norm
+
+
+def stacked_silu(algebra, input, a, b):
+    norms = torch.cat([input[..., :1], *algebra.qs(input, grades=algebra.grades[1:])], dim=-1)
+    norms = (a * norms + b).repeat_interleave(algebra.subspaces, dim=-1)
+    return torch.sigmoid(norms) * input
+
+
+def stacked_attention(algebra, input, attention_mask, params, prefix, num_heads, tokens):
+    members, rows, num_feat, _ = input.shape
+    batch_size, head_dim = rows // tokens, num_feat // num_heads
+
+    def split_heads(x):
+        # [members, batch * tokens, heads * head_dim, 8] -> [members, batch, heads, tokens, head_dim * 8]
+        x = x.view(members, batch_size, tokens, num_heads, head_dim, 8).transpose(2, 3)
+        return x.reshape(members, batch_size, num_heads, tokens, head_dim * 8)
+
+    q, k, v = (split_heads(stacked_linear(algebra, input, params[f'{prefix}{name}.weight']))
+               for name in ('q_linear', 'k_linear', 'v_linear'))
+    attn = (q / math.sqrt(head_dim * 8)) @ k.transpose(-2, -1)
+    if attention_mask is not None:
+        attn = attn + attention_mask[:, None]
+    output = torch.softmax(attn, dim=-1) @ v
+    output = output.view(members, batch_size, num_heads, tokens, head_dim, 8).transpose(2, 3)
+    output = output.reshape(members, rows, num_feat, 8)
+    return stacked_linear(algebra, output, params[f'{prefix}output_embedding.weight'],
+                          params[f'{prefix}output_embedding.bias'])
+
+
+def architecture(model):
+    return (model.d_model, model.transformer.layers[0].self_attn.num_heads, len(model.transformer.layers),
+            model.num_edges, model.embedding_layer.zero_edges, model.n_nodes)
+
+
+class NBodyEnsemble:
+    """Evaluates several NBodyTransformers on one batch with their parameters stacked per architecture.
+
+    Members of the same architecture run as one batched pass over a leading member dimension. The weight free
+    node and edge features of the embedder are computed once for all members with the same edge configuration,
+    only the projections are per member. The parameters are copied at construction, build a new ensemble after
+    further training. All members need the same number of nodes and horizons.
+    """
+
+    def __init__(self, models):
+        models = list(models)
+        if len({(model.n_nodes, tuple(model.horizons or ())) for model in models}) != 1:
+            raise ValueError("Ensemble members need the same number of nodes and horizons")
+        self.models = models
+        self.horizons = models[0].horizons
+        self.groups = {}
+        for index, model in enumerate(models):
+            self.groups.setdefault(architecture(model), []).append(index)
+        self.params = {key: self.stack([models[index] for index in indices]) for key, indices in self.groups.items()}
+
+    def __len__(self):
+        return len(self.models)
+
+    @staticmethod
+    def stack(models):
+        # The embedder is no nn.Module, its projections are added to the parameters under their own names
+        named = [dict(model.named_parameters(),
+                      **dict(model.embedding_layer.node_projection.named_parameters(prefix='node_projection')),
+                      **dict(model.embedding_layer.edge_projection.named_parameters(prefix='edge_projection')))
+                 for model in models]
+        with torch.no_grad():
+            return {name: torch.stack([params[name].detach() for params in named]) for name in named[0]}
+
+    def forward_group(self, key, features, loc_start):
+        model = self.models[self.groups[key][0]]
+        params = self.params[key]
+        algebra = model.clifford_algebra
+        d_model, num_heads, num_layers, num_edges, _, n_nodes = key
+        members, batch_size, tokens = len(self.groups[key]), loc_start.size(0), n_nodes + num_edges
+        nodes_stack, edge_features, attention_mask = features
+
+        nodes = stacked_linear(algebra, nodes_stack, params['node_projection.weight'], params['node_projection.bias'])
+        src = nodes.view(members, batch_size, n_nodes, d_model, 8)
+        if num_edges:
+            if edge_features is None:
+                edges = nodes.new_zeros(members, batch_size, num_edges, d_model, 8)
+            else:
+                edges = stacked_linear(algebra, edge_features, params['edge_projection.weight'],
+                                       params['edge_projection.bias'])
+            src = torch.cat((src, edges.view(members, batch_size, num_edges, d_model, 8)), dim=2)
+        src = src.view(members, batch_size * tokens, d_model, 8)
+
+        src = stacked_linear(algebra, src, params['combined_projection.layer.0.weight'],
+                             params['combined_projection.layer.0.bias'])
+        src = stacked_silu(algebra, src, params['combined_projection.layer.1.a'],
+                           params['combined_projection.layer.1.b'])
+        src = stacked_linear(algebra, src, params['combined_projection.layer.2.weight'],
+                             params['combined_projection.layer.2.bias'])
+
+        for layer in range(num_layers):
+            prefix = f'transformer.layers.{layer}.'
+            attended = stacked_attention(algebra, stacked_layer_norm(algebra, src, params[prefix + 'mvlayernorm1.a']),
+                                         attention_mask, params, prefix + 'self_attn.', num_heads, tokens)
+            src = stacked_layer_norm(algebra, src + attended, params[prefix + 'mvlayernorm2.a'])
+
+            x_l = stacked_linear(algebra, src, params[prefix + 'gp.first_layer.weight'],
+                                 params[prefix + 'gp.first_layer.bias'])
+            x_r = stacked_linear(algebra, src, params[prefix + 'gp.second_layer.weight'],
+                                 params[prefix + 'gp.second_layer.bias'])
+            gp = stacked_linear(algebra, algebra.geometric_product(x_l, x_r), params[prefix + 'gp.third_layer.weight'],
+                                params[prefix + 'gp.third_layer.bias'])
+            src = src + stacked_layer_norm(algebra, gp, params[prefix + 'gp.norm.a'])
+            src = stacked_layer_norm(algebra, src, params[prefix + 'mvlayernorm3.a'])
+
+            hidden = stacked_linear(algebra, src, params[prefix + 'mlp.0.weight'], params[prefix + 'mlp.0.bias'])
+            hidden = stacked_silu(algebra, hidden, params[prefix + 'mlp.1.a'], params[prefix + 'mlp.1.b'])
+            src = src + stacked_linear(algebra, hidden, params[prefix + 'mlp.2.weight'], params[prefix + 'mlp.2.bias'])
+
+        output = src.view(members, batch_size, tokens, d_model, 8)
+        if self.horizons is not None:
+            locations = output[:, :, :n_nodes, 1:1 + len(self.horizons), 1:4].transpose(2, 3)
+            return loc_start[None, :, None] + locations  # [members, batch, horizons, nodes, 3]
+        return loc_start[None] + output[:, :, :n_nodes, 1, 1:4]  # [members, batch, nodes, 3]
+
+    def forward(self, batch):
+        """Predictions of every member in the order of the models, [members, *model output], and the target."""
+        features = {}
+        outputs = [None] * len(self.models)
+        for key, indices in self.groups.items():
+            embedder = self.models[indices[0]].embedding_layer
+            edge_config = (embedder.num_edges, embedder.zero_edges)
+            if edge_config not in features:
+                features[edge_config] = embedder.embed_features(batch)
+            for index, output in zip(indices, self.forward_group(key, features[edge_config], batch[0])):
+                outputs[index] = output
+        return torch.stack(outputs), batch[4]
+
+    __call__ = forward
+
+    def predict(self, batch):
+        """Ensemble mean and spread, the standard deviation over the members, next to the member predictions."""
+        with torch.inference_mode():
+            outputs, target = self.forward(batch)
+        return {
+            'members': outputs,
+            'mean': outputs.mean(dim=0),
+            'std': outputs.std(dim=0, unbiased=False),
+            'target': target,
+        }
+
+    def evaluate(self, loader):
+        """Mean squared errors of every member and of the ensemble mean, and the mean spread over a loader."""
+        member_sse = torch.zeros(len(self.models), dtype=torch.float64)
+        mean_sse = spread = 0.0
+        elements = 0
+        for batch in loader:
+            prediction = self.predict(batch)
+            errors = (prediction['members'] - prediction['target']).double() ** 2
+            member_sse += errors.flatten(1).sum(dim=1)
+            mean_sse += ((prediction['mean'] - prediction['target']).double() ** 2).sum().item()
+            spread += prediction['std'].double().sum().item()
+            elements += prediction['target'].numel()
+        return {
+            'member_loss': (member_sse / elements).tolist(),
+            'ensemble_loss': mean_sse / elements,
+            'spread': spread / elements,
+        }
@@ -1,6 +1,7 @@
+import torch
 import torch.nn as nn
 from ..original_modules.linear import MVLinear
-from ..modules.clifford_embedding import NBodyGraphEmbedder
+from ..modules.clifford_embedding import NBodyGraphEmbedder, complete_graph, charge_products
 from ..original_modules.mvsilu import MVSiLU
 from ..modules.block import MainBody
 
@@ -19,25 +20,35 @@ class TwoLayerMLP(nn.Module):
 
 
 class NBodyTransformer(nn.Module):
-    def __init__(self, input_dim, d_model, num_heads, num_layers, clifford_algebra, num_edges=10, zero_edges=False):
+    def __init__(self, input_dim, d_model, num_heads, num_layers, clifford_algebra, num_edges=10, zero_edges=False,
+                 n_nodes=5, horizons=None):
         super().__init__()
         self.clifford_algebra = clifford_algebra
         self.num_edges = num_edges
+        self.n_nodes = n_nodes
         self.d_model = d_model
+        # Multi-horizon head, the displacement to horizon h is read from the vector part of channel 1 + h
+        self.horizons = horizons
+        if horizons is not None:
+            assert len(horizons) < d_model, "Every horizon needs its own channel"
 
         # Initialize embedding and transformer layers
-        self.embedding_layer = NBodyGraphEmbedder(clifford_algebra, input_dim, d_model, num_edges, zero_edges)
-        self.transformer = MainBody(num_layers, d_model, num_heads, clifford_algebra, num_edges)
+        self.embedding_layer = NBodyGraphEmbedder(clifford_algebra, input_dim, d_model, num_edges, zero_edges, n_nodes)
+        self.transformer = MainBody(num_layers, d_model, num_heads, clifford_algebra, num_edges, n_nodes)
         self.combined_projection = TwoLayerMLP(clifford_algebra, d_model, d_model * 4, d_model)
         self.x_left = MVLinear(clifford_algebra, d_model, d_model, subspaces=True)
 
     def forward(self, batch):
-        batch_size, n_nodes, _ = batch[0].size()
         loc_start, loc_end = batch[0], batch[4]
 
         # Generate embeddings and attention mask
         full_embeddings, attention_mask = self.embedding_layer.embed_nbody_graphs(batch)
 
+        return self.decode(full_embeddings, attention_mask, loc_start), loc_end
+
+    def decode(self, full_embeddings, attention_mask, loc_start):
+        batch_size, n_nodes, _ = loc_start.size()
+
         # Apply transformation to embeddings
         src = self.combined_projection(full_embeddings.view(batch_size * (n_nodes + self.num_edges), self.d_model, 8))
         #src_left = self.x_left(src)
@@ -45,10 +56,59 @@ class NBodyTransformer(nn.Module):
 
         # Pass through transformer layers
         output = self.transformer(src, attention_mask)
+        return self.positions(output, loc_start)
+
+    def positions(self, output, loc_start):
+        """Reads the predicted positions off the output multivectors [batch * tokens, d_model, 8]."""
+        batch_size, n_nodes, _ = loc_start.size()
         output = output.view(batch_size, n_nodes + self.num_edges, self.d_model, 8)
 
         # Compute new positions
+        if self.horizons is not None:
+            output_locations = output[:, :n_nodes, 1:1 + len(self.horizons), 1:4].transpose(1, 2)
+            return loc_start[:, None] + output_locations  # [batch, horizons, nodes, 3]
         output_locations = output[:, :n_nodes, 1, 1:4].squeeze(2)
         new_pos = loc_start + output_locations
 
-        return new_pos, loc_end
+        return new_pos
+
+    def step(self, loc, vel, graph):
+        """Predicts the next positions of systems whose graph was prepared by the embedder."""
+        full_embeddings, attention_mask = self.embedding_layer.embed_step(loc, vel, graph)
+        return self.decode(full_embeddings, attention_mask, loc)
+
+    def rollout(self, loc, vel, charges, steps, edges=None, edge_attr=None, dt=1.0, velocity='difference'):
+        """Predicts steps jumps ahead for a batch of systems by feeding the predictions back in.
+
+        loc and vel are [batch, nodes, 3] and charges [batch, nodes, 1]. edges defaults to the complete graph and
+        edge_attr to the products of the charges, as in the dataset. The topology, attention mask and charge
+        embeddings are prepared once for all steps. The next input velocity is derived from the predicted jump,
+        dt is its duration (10 frames of 0.1 time units for the shipped datasets). 'difference' takes the mean
+        velocity over the jump, 'trapezoid' the end velocity for which the jump is the mean of both. Gradients
+        are kept when enabled, wrap the call in torch.inference_mode() for plain simulation. Returns the
+        positions [steps, batch, nodes, 3].
+        """
+        if self.horizons is not None:
+            raise ValueError("A multi-horizon model predicts all its horizons in one pass, rollout needs a single one")
+        batch_size, n_nodes, _ = loc.size()
+        if edges is None:
+            edges = complete_graph(n_nodes, device=loc.device)
+        if edges.dim() == 2:
+            edges = edges.expand(batch_size, *edges.shape)
+        if edge_attr is None:
+            edge_attr = charge_products(charges, edges[0])
+        graph = self.embedding_layer.prepare_graph(edge_attr, charges, edges, batch_size, n_nodes)
+
+        trajectory = []
+        for _ in range(steps):
+            new_loc = self.step(loc, vel, graph)
+            mean_vel = (new_loc - loc) / dt
+            if velocity == 'difference':
+                vel = mean_vel
+            elif velocity == 'trapezoid':
+                vel = 2 * mean_vel - vel
+            else:
+                raise ValueError(f"Velocity {velocity} not recognized.")
+            loc = new_loc
+            trajectory.append(loc)
+        return torch.stack(trajectory)
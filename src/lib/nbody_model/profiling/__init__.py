@@ -0,0 +1,6 @@
+from .flops import *
+from .modules import *
+from .measure import *
+from .cost_model import *
+from .batch_size import *
+from .equivariance import *
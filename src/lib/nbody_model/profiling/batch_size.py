@@ -0,0 +1,65 @@
+import torch
+import torch.nn as nn
+
+from ..algebra import CliffordAlgebra
+from ..data.nbody import random_batch
+from ..modules.transformer import NBodyTransformer
+from .cost_model import CostModel
+from .measure import measure_cost
+
+BATCH_SIZES = (25, 50, 100, 150, 200, 300, 400, 600, 800)
+
+
+def build_model(d_model, num_heads, num_layers, num_edges, n_nodes=5, input_dim=3, zero_edges=False, **_):
+    return NBodyTransformer(input_dim, d_model, num_heads, num_layers, CliffordAlgebra([1, 1, 1]),
+                            num_edges=num_edges, zero_edges=zero_edges, n_nodes=n_nodes)
+
+
+def measure_config(config, repeats=3):
+    """Measures one training and inference step of a configuration on random systems."""
+    model = build_model(**config)
+    batch = random_batch(config['batch_size'], config.get('n_nodes', 5), generator=torch.Generator().manual_seed(0))
+    return measure_cost(model, batch, nn.MSELoss(), repeats=repeats)
+
+
+def calibrate(configs, repeats=3):
+    """Fits a CostModel to measured runs of configs, returns it with the relative errors of its predictions."""
+    measurements = [measure_config(config, repeats) for config in configs]
+    cost_model = CostModel().fit(configs, measurements)
+    return cost_model, cost_model.validate(configs, measurements)
+
+
+def is_out_of_memory(error):
+    return isinstance(error, torch.cuda.OutOfMemoryError) or 'out of memory' in str(error)
+
+
+def find_batch_size(config, memory_cap_mb, candidates=BATCH_SIZES, cost_model=None, measure=True, max_measured=3):
+    """Picks the batch size with the highest training throughput whose peak memory stays under memory_cap_mb.
+
+    The cost model discards the candidates predicted over the cap. When measure is set, the max_measured
+    largest remaining candidates are run once and the measured throughput and memory decide. Returns the batch
+    size and the predicted or measured costs per candidate.
+    """
+    cost_model = cost_model or CostModel()
+    predicted = {batch_size: cost_model.predict(**dict(config, batch_size=batch_size)) for batch_size in candidates}
+    fits = [batch_size for batch_size in candidates if predicted[batch_size]['peak_memory_mb'] <= memory_cap_mb]
+    if not fits:
+        raise ValueError(f"No batch size in {list(candidates)} is predicted to fit in {memory_cap_mb}MB.")
+    if not measure:
+        return max(fits, key=lambda batch_size: predicted[batch_size]['train_samples_per_sec']), predicted
+
+    measured = {}
+    for batch_size in sorted(fits, reverse=True)[:max_measured]:
+        try:
+            cost = measure_config(dict(config, batch_size=batch_size), repeats=1)
+        except RuntimeError as error:
+            if not is_out_of_memory(error):
+                raise
+            torch.cuda.empty_cache()
+            continue
+        if cost['peak_memory_mb'] <= memory_cap_mb:
+            measured[batch_size] = cost
+    if not measured:
+        # Every measured candidate was over the cap, the smallest predicted fit is the safest choice
+        return min(fits), predicted
+    return max(measured, key=lambda batch_size: measured[batch_size]['train_samples_per_sec']), measured
@@ -0,0 +1,148 @@
+import numpy as np
+
+from .flops import BLADES, attention_flops, geometric_product_flops, layer_norm_flops, mv_linear_flops, silu_flops
+
+FLOAT_BYTES = 4
+# Weights, gradients and the two Adam moments
+OPTIMIZER_COPIES = 4
+# Elements saved for the backward pass per multivector, read off the autograd graph of each layer type
+SAVED_PER_MV = {'linear': BLADES, 'silu': 4 * BLADES, 'layer_norm': 3 * BLADES + 2, 'gp': 2 * BLADES}
+
+
+def mv_linear_parameters(in_features, out_features, subspaces=True, bias=True):
+    return out_features * in_features * (4 if subspaces else 1) + (out_features if bias else 0)
+
+
+def layer_costs(d_model, num_heads, num_layers, num_edges, batch_size, n_nodes=5, input_dim=3, zero_edges=False):
+    """Forward FLOPs, saved activation elements and parameters per layer type of an NBodyTransformer.
+
+    Returns {layer type: [flops, activations, parameters]} summed over all layers of that type.
+    """
+    costs = {name: [0, 0, 0] for name in ('mv_linear', 'mv_linear_subspaces', 'geometric_product', 'attention',
+                                          'layer_norm', 'silu')}
+    tokens = n_nodes + num_edges
+    rows = batch_size * tokens
+
+    def linear(rows, in_features, out_features, subspaces=True, bias=True):
+        cost = costs['mv_linear_subspaces' if subspaces else 'mv_linear']
+        cost[0] += mv_linear_flops(rows, in_features, out_features, bias=bias)
+        cost[1] += rows * in_features * SAVED_PER_MV['linear']
+        cost[2] += mv_linear_parameters(in_features, out_features, subspaces, bias)
+
+    def silu(num_mvs, channels):
+        costs['silu'][0] += silu_flops(num_mvs)
+        costs['silu'][1] += num_mvs * SAVED_PER_MV['silu']
+        costs['silu'][2] += 2 * channels * 4
+
+    def layer_norm(num_mvs, channels):
+        costs['layer_norm'][0] += layer_norm_flops(num_mvs)
+        costs['layer_norm'][1] += num_mvs * SAVED_PER_MV['layer_norm']
+        costs['layer_norm'][2] += channels
+
+    def geometric_product(num_products):
+        costs['geometric_product'][0] += geometric_product_flops(num_products)
+        costs['geometric_product'][1] += num_products * SAVED_PER_MV['gp']
+
+    # Graph embedder, two products per edge for each of the three node features
+    linear(batch_size * n_nodes, input_dim, d_model, subspaces=False)
+    if num_edges:
+        linear(batch_size * num_edges, 7, d_model, subspaces=False)
+        if not zero_edges:
+            geometric_product(2 * batch_size * num_edges * input_dim)
+
+    # combined_projection
+    linear(rows, d_model, 4 * d_model)
+    silu(rows * 4 * d_model, 4 * d_model)
+    linear(rows, 4 * d_model, d_model)
+
+    for _ in range(num_layers):
+        # Attention, the q, k and v projections have no bias
+        for _ in range(3):
+            linear(rows, d_model, d_model, bias=False)
+        linear(rows, d_model, d_model)
+        costs['attention'][0] += attention_flops(batch_size, tokens, d_model, num_heads)
+        costs['attention'][1] += 3 * rows * d_model * BLADES + 2 * batch_size * num_heads * tokens * tokens
+
+        # GpLayer and its norm
+        linear(rows, d_model, 2 * d_model)
+        linear(rows, d_model, 2 * d_model)
+        geometric_product(rows * 2 * d_model)
+        linear(rows, 2 * d_model, d_model)
+        layer_norm(rows * d_model, d_model)
+
+        # The three block norms and the MLP
+        for _ in range(3):
+            layer_norm(rows * d_model, d_model)
+        linear(rows, d_model, 2 * d_model)
+        silu(rows * 2 * d_model, 2 * d_model)
+        linear(rows, 2 * d_model, d_model)
+    return costs
+
+
+def estimate_cost(d_model, num_heads, num_layers, num_edges, batch_size, n_nodes=5, input_dim=3, zero_edges=False):
+    """FLOPs per training step and peak training memory in bytes of an NBodyTransformer configuration."""
+    costs = layer_costs(d_model, num_heads, num_layers, num_edges, batch_size, n_nodes, input_dim, zero_edges)
+    forward_flops = sum(cost[0] for cost in costs.values())
+    activations = sum(cost[1] for cost in costs.values())
+    trained = sum(cost[2] for cost in costs.values())
+    # x_left is stored with the weights but unused in the forward pass, it has no gradient or Adam moments
+    unused = mv_linear_parameters(d_model, d_model)
+    return {
+        'forward_flops': forward_flops,
+        # The backward pass is about twice the forward pass
+        'train_flops': 3 * forward_flops,
+        'parameters': trained + unused,
+        'activation_bytes': FLOAT_BYTES * activations,
+        'peak_memory_bytes': FLOAT_BYTES * (activations + OPTIMIZER_COPIES * trained + unused),
+        'layers': costs,
+    }
+
+
+class CostModel:
+    """Predicts step time and peak memory from the analytic estimate.
+
+    The step time is overhead + train_flops / flops_per_sec and the memory is the estimate times memory_scale, fit()
+    calibrates the three constants against measured runs of the machine at hand.
+    """
+
+    def __init__(self, flops_per_sec=1e10, overhead=0.0, memory_scale=1.0):
+        self.flops_per_sec = flops_per_sec
+        self.overhead = overhead
+        self.memory_scale = memory_scale
+
+    def predict(self, **config):
+        cost = estimate_cost(**config)
+        step_time = self.overhead + cost['train_flops'] / self.flops_per_sec
+        return {
+            'step_time': step_time,
+            'train_samples_per_sec': config['batch_size'] / step_time,
+            'peak_memory_mb': self.memory_scale * cost['peak_memory_bytes'] / 2 ** 20,
+        }
+
+    def fit(self, configs, measurements):
+        """Least squares fit of the step time, measurements are dicts of profiling.measure.measure_cost."""
+        flops = np.array([estimate_cost(**config)['train_flops'] for config in configs], dtype=np.float64)
+        times = np.array([config['batch_size'] / measured['train_samples_per_sec']
+                          for config, measured in zip(configs, measurements)])
+        slope, overhead = np.polyfit(flops, times, 1) if len(configs) > 1 else (0.0, 0.0)
+        if slope <= 0 or overhead < 0:
+            # Too few or too noisy runs for an intercept, fall back to a rate through the origin
+            slope, overhead = np.sum(times * flops) / np.sum(flops ** 2), 0.0
+        self.overhead = float(overhead)
+        self.flops_per_sec = 1 / slope
+        predicted = np.array([estimate_cost(**config)['peak_memory_bytes'] / 2 ** 20 for config in configs])
+        measured = np.array([measured['peak_memory_mb'] for measured in measurements])
+        self.memory_scale = float(np.mean(measured / predicted))
+        return self
+
+    def validate(self, configs, measurements):
+        """Relative errors of the predictions against measured runs."""
+        errors = []
+        for config, measured in zip(configs, measurements):
+            predicted = self.predict(**config)
+            errors.append({
+                'config': config,
+                'samples_per_sec_error': predicted['train_samples_per_sec'] / measured['train_samples_per_sec'] - 1,
+                'peak_memory_error': predicted['peak_memory_mb'] / measured['peak_memory_mb'] - 1,
+            })
+        return errors
@@ -0,0 +1,154 @@
+import math
+import time
+
+import torch
+
+
+def random_versors(algebra, num_versors, reflections=True, generator=None):
+    """Normalized random versors, products of two unit vectors (rotations) and, every other one, of three
+    (rotoreflections) when reflections is set. Returns [num_versors, 8]."""
+    versors = []
+    for i in range(num_versors):
+        order = 3 if reflections and i % 2 else 2
+        vectors = torch.zeros(order, algebra.n_blades, device=algebra.cayley.device)
+        vectors[:, 1:4] = torch.randn(order, 3, generator=generator).to(vectors.device)
+        versor = vectors[0]
+        for vector in vectors[1:]:
+            versor = algebra.geometric_product(versor, vector)
+        versors.append(versor / algebra.norm(versor)[..., :1])
+    return torch.stack(versors)
+
+
+def versor_actions(algebra, versors):
+    """Matrices of the versor actions on multivectors, a multivector x is mapped to x @ actions[i]. [n, 8, 8]"""
+    basis = torch.eye(algebra.n_blades, device=versors.device)
+    return torch.stack([algebra.rho(versor, basis) for versor in versors])
+
+
+def equivariance_modules(model):
+    """The embedder projections, combined_projection and every transformer block and its sublayers."""
+    modules = {
+        'embedding_layer.node_projection': model.embedding_layer.node_projection,
+        'embedding_layer.edge_projection': model.embedding_layer.edge_projection,
+        'combined_projection': model.combined_projection,
+    }
+    for i, layer in enumerate(model.transformer.layers):
+        modules[f'transformer.layers.{i}.self_attn'] = layer.self_attn
+        modules[f'transformer.layers.{i}.gp'] = layer.gp
+        modules[f'transformer.layers.{i}.mlp'] = layer.mlp
+        modules[f'transformer.layers.{i}'] = layer
+    return modules
+
+
+def transform_batch(batch, actions):
+    """Every system of the batch under every action, [actions * batch] systems ordered action-major."""
+    vector_actions = actions[:, 1:4, 1:4].to(batch[0].dtype)
+    num_actions = len(actions)
+
+    def rotate(value):
+        return torch.einsum('b...i,rij->rb...j', value, vector_actions).flatten(0, 1)
+
+    def repeat(value):
+        return value.repeat(num_actions, *[1] * (value.dim() - 1))
+
+    loc, vel, edge_attr, charges, loc_end, edges = batch[:6]
+    transformed = [rotate(loc), rotate(vel), repeat(edge_attr), repeat(charges), rotate(loc_end), repeat(edges)]
+    if len(batch) > 6:
+        # Pre-embedded node multivectors of a cache batch
+        nodes = torch.einsum('b...i,rij->rb...j', batch[6].float(), actions).flatten(0, 1)
+        transformed.append(nodes.to(batch[6].dtype))
+    return transformed
+
+
+def relative_errors(reference, transformed, actions, batch_size):
+    """Max abs error per system and action of transformed against the acted on reference, relative to the
+    largest reference entry of the system. Multivectors are acted on by the full action, positions by its
+    vector block. Returns [actions, batch]."""
+    reference = reference.detach().double().reshape(batch_size, -1, reference.size(-1))
+    transformed = transformed.detach().double().reshape(len(actions), batch_size, -1, reference.size(-1))
+    action = actions.double() if reference.size(-1) == actions.size(-1) else actions[:, 1:4, 1:4].double()
+    expected = torch.einsum('bti,rij->rbtj', reference, action)
+    scale = reference.abs().flatten(1).amax(dim=1).clamp_min(1e-12)
+    return (transformed - expected).abs().flatten(2).amax(dim=2) / scale
+
+
+def summarize(errors, percentiles):
+    errors = torch.cat([error.flatten() for error in errors])
+    stats = {'max': errors.max().item()}
+    quantiles = torch.quantile(errors, torch.tensor([p / 100 for p in percentiles], dtype=errors.dtype,
+                                                   device=errors.device))
+    stats.update({f'p{p:g}': value.item() for p, value in zip(percentiles, quantiles)})
+    return stats
+
+
+def check_equivariance(model, batch, num_transforms=16, reflections=True, modules=None, max_batch_size=4096,
+                       percentiles=(50, 90, 99), generator=None):
+    """Equivariance errors of the model output and of intermediate layers under random O(3) transformations.
+
+    Every system of the batch is evaluated under num_transforms random rotations and rotoreflections in a few
+    batched forwards of at most max_batch_size systems. Forward hooks record the multivector outputs of
+    modules (equivariance_modules by default), which are compared to the versor action on the untransformed
+    outputs. Errors are the max abs deviation per system relative to the largest entry of its reference, so
+    they do not cancel and are comparable between layers. Returns the max and percentiles of these errors per
+    layer and for the predicted positions, and the throughput of the transformed forwards.
+
+    Models with one edge per node pair take the edges of every system from the first system of the batch
+    (NBodyGraphEmbedder.get_edge_nodes), which shows up here as errors of order one for more than one system.
+    """
+    algebra = model.clifford_algebra
+    modules = equivariance_modules(model) if modules is None else modules
+    batch_size = batch[0].size(0)
+    actions = versor_actions(algebra, random_versors(algebra, num_transforms, reflections, generator))
+
+    outputs = {}
+    hooks = []
+    for name, module in modules.items():
+        def hook(module, inputs, output, name=name):
+            outputs[name] = output
+        hooks.append(module.register_forward_hook(hook))
+
+    was_training = model.training
+    model.eval()
+    errors = {name: [] for name in modules}
+    errors['output'] = []
+    try:
+        with torch.inference_mode():
+            reference_output, _ = model(batch)
+            references = dict(outputs)
+            chunk = max(1, max_batch_size // batch_size)
+            elapsed = 0.0
+            for start in range(0, num_transforms, chunk):
+                chunk_actions = actions[start:start + chunk]
+                transformed = transform_batch(batch, chunk_actions)
+                outputs.clear()
+                forward_start = time.perf_counter()
+                output, _ = model(transformed)
+                elapsed += time.perf_counter() - forward_start
+                errors['output'].append(relative_errors(reference_output, output, chunk_actions, batch_size))
+                for name, reference in references.items():
+                    errors[name].append(relative_errors(reference, outputs[name], chunk_actions, batch_size))
+    finally:
+        for hook in hooks:
+            hook.remove()
+        model.train(was_training)
+
+    systems = batch_size * num_transforms
+    return {
+        'output': summarize(errors.pop('output'), percentiles),
+        # Modules that did not run, like the edge projection of a model without edges, are left out
+        'layers': {name: summarize(error, percentiles) for name, error in errors.items() if error},
+        'systems': systems,
+        'forwards': math.ceil(num_transforms / max(1, max_batch_size // batch_size)),
+        'seconds': elapsed,
+        'systems_per_sec': systems / elapsed if elapsed > 0 else 0.0,
+    }
+
+
+def format_equivariance(report):
+    lines = [f"{report['systems']} transformed systems in {report['forwards']} forwards, "
+             f"{report['systems_per_sec']:.1f} systems/s"]
+    keys = [key for key in report['output'] if key != 'max']
+    lines.append(f"{'':<40} {'max':>10} " + " ".join(f"{key:>10}" for key in keys))
+    for name, stats in [*report['layers'].items(), ('output', report['output'])]:
+        lines.append(f"{name:<40} {stats['max']:>10.2e} " + " ".join(f"{stats[key]:>10.2e}" for key in keys))
+    return "\n".join(lines)
@@ -0,0 +1,70 @@
+# Forward FLOP estimates of the layer types of NBodyTransformer, a multiply-add counts as two FLOPs. The backward
+# pass is usually estimated at twice the forward FLOPs.
+from ..modules.attention import SelfAttentionClifford
+from ..modules.block import GpLayer
+from ..original_modules.linear import MVLinear
+from ..original_modules.mvlayernorm import MVLayerNorm
+from ..original_modules.mvsilu import MVSiLU
+
+BLADES = 8
+GRADE_SIZES = (1, 3, 3, 1)
+
+
+def mv_linear_flops(rows, in_features, out_features, bias=True):
+    # The subspace weights are repeated to all blades, so both variants are a dense einsum over the blades
+    flops = 2 * rows * in_features * out_features * BLADES
+    if bias:
+        flops += rows * out_features * BLADES
+    return flops
+
+
+def geometric_product_flops(num_products):
+    # Dense einsum "...i,ijk,...k->...j" over the full Cayley table
+    return 2 * BLADES ** 3 * num_products
+
+
+def norm_flops(num_mvs):
+    # q(mv) contracts the Cayley table restricted to the scalar output, then a smooth square root
+    return num_mvs * (2 * BLADES * BLADES + 3)
+
+
+def layer_norm_flops(num_mvs):
+    # Norm, mean over the channels and a * input / norm
+    return norm_flops(num_mvs) + num_mvs + 2 * num_mvs * BLADES
+
+
+def silu_flops(num_mvs):
+    # A q per grade except the scalar, the affine map per grade and the sigmoid gate on every blade
+    qs = sum(2 * size * size for size in GRADE_SIZES[1:])
+    return num_mvs * (qs + 2 * len(GRADE_SIZES) + 4 * len(GRADE_SIZES) + BLADES)
+
+
+def attention_flops(batch_size, tokens, features, num_heads):
+    # The two batched matmuls over all tokens plus the mask and softmax, the q, k, v and output MVLinear layers
+    # are counted separately
+    matmuls = 2 * 2 * batch_size * tokens * tokens * features * BLADES
+    softmax = 5 * batch_size * num_heads * tokens * tokens
+    return matmuls + softmax
+
+
+def module_flops(module, inputs, output):
+    """Forward FLOPs spent in the module itself, excluding its submodules, from the shapes of one call."""
+    if not inputs or not hasattr(inputs[0], 'numel'):
+        return 0
+    x = inputs[0]
+    num_mvs = x.numel() // x.size(-1)
+    if isinstance(module, MVLinear):
+        return mv_linear_flops(num_mvs // module.in_features, module.in_features, module.out_features,
+                               bias=module.bias is not None)
+    if isinstance(module, SelfAttentionClifford):
+        tokens = module.num_nodes + module.num_edges
+        return attention_flops(x.size(0) // tokens, tokens, module.num_feat, module.num_heads)
+    if isinstance(module, GpLayer):
+        # One product per hidden channel, the hidden layers have out_features channels
+        hidden = module.first_layer.out_features
+        return geometric_product_flops(num_mvs // module.first_layer.in_features * hidden)
+    if isinstance(module, MVLayerNorm):
+        return layer_norm_flops(num_mvs)
+    if isinstance(module, MVSiLU):
+        return silu_flops(num_mvs)
+    return 0
@@ -0,0 +1,85 @@
+import time
+
+import torch
+
+
+def measure_peak_memory(model, batch, criterion):
+    """Peak training memory of one step in bytes.
+
+    On a GPU this is the allocator high-water mark. On the CPU it is estimated as the tensors saved for the
+    backward pass plus the weights, gradients and the two Adam moments.
+    """
+    if torch.cuda.is_available() and next(model.parameters()).is_cuda:
+        torch.cuda.reset_peak_memory_stats()
+        output, tgt = model(batch)
+        criterion(output, tgt).backward()
+        model.zero_grad(set_to_none=True)
+        return torch.cuda.max_memory_allocated()
+
+    saved_bytes = 0
+
+    def pack(tensor):
+        nonlocal saved_bytes
+        saved_bytes += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output, tgt = model(batch)
+        loss = criterion(output, tgt)
+    loss.backward()
+    model.zero_grad(set_to_none=True)
+    parameter_bytes = sum(p.numel() * p.element_size() for p in model.parameters())
+    return saved_bytes + 4 * parameter_bytes
+
+
+def measure_cost(model, batch, criterion, repeats=3, warmup=1):
+    """Times training and inference steps on one batch, the model parameters are left unchanged."""
+    batch_size = batch[0].size(0)
+    was_training = model.training
+
+    model.train()
+    train_times = []
+    for i in range(warmup + repeats):
+        start = time.perf_counter()
+        output, tgt = model(batch)
+        criterion(output, tgt).backward()
+        if i >= warmup:
+            train_times.append(time.perf_counter() - start)
+    model.zero_grad(set_to_none=True)
+
+    model.eval()
+    inference_times = []
+    with torch.inference_mode():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            model(batch)
+            if i >= warmup:
+                inference_times.append(time.perf_counter() - start)
+
+    model.train()
+    peak_memory = measure_peak_memory(model, batch, criterion)
+    model.train(was_training)
+
+    train_time = min(train_times)
+    inference_time = min(inference_times)
+    return {
+        'train_samples_per_sec': batch_size / train_time,
+        'inference_samples_per_sec': batch_size / inference_time,
+        'inference_latency_ms': 1e3 * inference_time,
+        'peak_memory_mb': peak_memory / 2 ** 20,
+    }
+
+
+def measure_latency(model, batch, repeats=10, warmup=2):
+    """Median inference time of one batch in milliseconds."""
+    was_training = model.training
+    model.eval()
+    times = []
+    with torch.inference_mode():
+        for i in range(warmup + repeats):
+            start = time.perf_counter()
+            model(batch)
+            if i >= warmup:
+                times.append(time.perf_counter() - start)
+    model.train(was_training)
+    return 1e3 * sorted(times)[len(times) // 2]
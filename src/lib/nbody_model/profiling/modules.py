@@ -0,0 +1,204 @@
+import collections
+import json
+import time
+
+import torch
+
+from .flops import module_flops
+
+# Chrome trace threads, the forward and backward calls are shown as separate rows
+THREADS = {'forward': 0, 'backward': 1}
+
+
+def tensors_of(value):
+    if isinstance(value, torch.Tensor):
+        return [value]
+    if isinstance(value, (tuple, list)):
+        return [tensor for item in value for tensor in tensors_of(item)]
+    return []
+
+
+def shapes_of(value):
+    return [tuple(tensor.shape) for tensor in tensors_of(value)]
+
+
+class ModuleStats:
+    def __init__(self, name, kind):
+        self.name = name
+        self.kind = kind
+        self.forward_calls = 0
+        self.backward_calls = 0
+        self.forward_time = 0.0
+        self.backward_time = 0.0
+        self.allocated = 0
+        self.flops = 0
+        self.shapes = None
+
+
+class ModuleProfiler:
+    """Per-module forward and backward timings of an NBodyTransformer, gathered with module hooks.
+
+    Nothing is registered on the model until start() or entering the context, and stop() removes every hook, so
+    a model that is not being profiled runs unchanged. Times are inclusive of submodules. Allocated bytes are
+    measured with the CUDA allocator on a GPU and are the size of the outputs on the CPU. The graph embedder is not
+    an nn.Module, its embed_nbody_graphs call is timed by wrapping the method and its projections are hooked.
+    """
+
+    def __init__(self, model, max_depth=None, backward=True, synchronize=None):
+        self.model = model
+        self.max_depth = max_depth
+        self.backward = backward
+        self.cuda = next(model.parameters()).is_cuda
+        self.synchronize = self.cuda if synchronize is None else synchronize
+        self.stats = {}
+        self.events = []
+        self.steps = 0
+        self.handles = []
+        self.stacks = collections.defaultdict(list)
+        self.origin = None
+
+    def modules(self):
+        modules = [(name, module) for name, module in self.model.named_modules() if name and
+                   (self.max_depth is None or name.count('.') < self.max_depth)]
+        embedder = self.model.embedding_layer
+        modules += [('embedding_layer.node_projection', embedder.node_projection),
+                    ('embedding_layer.edge_projection', embedder.edge_projection)]
+        # Modules without a forward of their own, e.g. the shared CliffordAlgebra, are never called
+        return [(name, module) for name, module in modules
+                if type(module).forward is not torch.nn.Module.forward]
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def allocated(self):
+        return torch.cuda.memory_allocated() if self.cuda else 0
+
+    def get_stats(self, name, kind):
+        if name not in self.stats:
+            self.stats[name] = ModuleStats(name, kind)
+        return self.stats[name]
+
+    def begin(self, name, phase):
+        self.stacks[name, phase].append((self.now(), self.allocated()))
+
+    def end(self, name, phase, kind, inputs=None, output=None, module=None):
+        start, allocated = self.stacks[name, phase].pop()
+        stop = self.now()
+        stats = self.get_stats(name, kind)
+        if phase == 'forward':
+            stats.forward_calls += 1
+            stats.forward_time += stop - start
+            if self.cuda:
+                stats.allocated += self.allocated() - allocated
+            else:
+                stats.allocated += sum(tensor.numel() * tensor.element_size() for tensor in tensors_of(output))
+            if module is not None:
+                stats.flops += module_flops(module, inputs, output)
+            if stats.shapes is None:
+                stats.shapes = shapes_of(inputs)
+        else:
+            stats.backward_calls += 1
+            stats.backward_time += stop - start
+        self.events.append({'name': name, 'cat': kind, 'ph': 'X', 'pid': 0, 'tid': THREADS[phase],
+                            'ts': 1e6 * (start - self.origin), 'dur': 1e6 * (stop - start),
+                            'args': {'step': self.steps}})
+
+    def hook(self, name, module):
+        kind = type(module).__name__
+        self.handles.append(module.register_forward_pre_hook(lambda module, inputs: self.begin(name, 'forward')))
+        self.handles.append(module.register_forward_hook(
+            lambda module, inputs, output: self.end(name, 'forward', kind, inputs, output, module)))
+        if self.backward:
+            self.handles.append(module.register_full_backward_pre_hook(
+                lambda module, grad_output: self.begin(name, 'backward')))
+            self.handles.append(module.register_full_backward_hook(
+                lambda module, grad_input, grad_output: self.end(name, 'backward', kind)))
+
+    def wrap_embedder(self):
+        embedder = self.model.embedding_layer
+        embed = embedder.embed_nbody_graphs
+
+        def timed_embed(batch):
+            self.begin('embedding_layer', 'forward')
+            output = embed(batch)
+            self.end('embedding_layer', 'forward', type(embedder).__name__, batch, output)
+            return output
+
+        embedder.embed_nbody_graphs = timed_embed
+
+    def start(self):
+        if self.origin is None:
+            self.origin = time.perf_counter()
+        for name, module in self.modules():
+            self.hook(name, module)
+        self.wrap_embedder()
+        return self
+
+    def stop(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+        # Drops the instance attribute, the class method is used again
+        self.model.embedding_layer.__dict__.pop('embed_nbody_graphs', None)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def step(self):
+        self.steps += 1
+        self.events.append({'name': f'step {self.steps}', 'ph': 'i', 's': 'g', 'pid': 0, 'tid': THREADS['forward'],
+                            'ts': 1e6 * (self.now() - self.origin)})
+
+    def table(self, sort_by='total', limit=None):
+        """Per step averages of every module, sorted by total, forward or backward time."""
+        steps = max(1, self.steps)
+        keys = {
+            'total': lambda stats: stats.forward_time + stats.backward_time,
+            'forward': lambda stats: stats.forward_time,
+            'backward': lambda stats: stats.backward_time,
+        }
+        rows = sorted(self.stats.values(), key=keys[sort_by], reverse=True)[:limit]
+        lines = [f"{'module':<48} {'type':<22} {'calls':>6} {'fwd ms':>9} {'bwd ms':>9} {'MB':>9} {'MFLOP':>10} "
+                 f"{'GFLOP/s':>8}  input shapes"]
+        for stats in rows:
+            # FLOPs are per module itself, add those of the submodules so they match the inclusive times
+            flops = sum(other.flops for other in self.stats.values()
+                        if other.name == stats.name or other.name.startswith(stats.name + '.'))
+            rate = flops / stats.forward_time / 1e9 if stats.forward_time > 0 else 0.0
+            lines.append(f"{stats.name:<48} {stats.kind:<22} {stats.forward_calls // steps:>6} "
+                         f"{1e3 * stats.forward_time / steps:>9.3f} {1e3 * stats.backward_time / steps:>9.3f} "
+                         f"{stats.allocated / steps / 2 ** 20:>9.2f} {flops / steps / 1e6:>10.1f} {rate:>8.2f}  "
+                         f"{stats.shapes}")
+        return "\n".join(lines)
+
+    def export_chrome_trace(self, path):
+        """Writes the recorded calls in the Chrome trace event format, for chrome://tracing or Perfetto."""
+        names = [{'name': 'thread_name', 'ph': 'M', 'pid': 0, 'tid': tid, 'args': {'name': phase}}
+                 for phase, tid in THREADS.items()]
+        with open(path, 'w') as file:
+            json.dump({'traceEvents': names + self.events, 'displayTimeUnit': 'ms'}, file)
+
+
+def profile_training(model, criterion, loader, steps, telemetry=None, **kwargs):
+    """Profiles steps forward and backward passes without updating the model, returns the profiler.
+
+    An active AlgebraTelemetry passed as telemetry is stepped along with the profiler.
+    """
+    profiler = ModuleProfiler(model, **kwargs)
+    model.train()
+    with profiler:
+        for step, batch in enumerate(loader):
+            if step == steps:
+                break
+            output, tgt = model(batch)
+            criterion(output, tgt).backward()
+            profiler.step()
+            if telemetry is not None:
+                telemetry.step()
+    model.zero_grad(set_to_none=True)
+    return profiler
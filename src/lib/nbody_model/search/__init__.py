@@ -0,0 +1,3 @@
+from .fidelity import *
+from .cost import *
+from .warm_start import *
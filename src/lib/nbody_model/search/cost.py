@@ -0,0 +1,12 @@
+from ..profiling.measure import measure_cost, measure_peak_memory
+
+
+def over_budget(cost, max_latency_ms=None, min_train_samples_per_sec=None, max_memory_mb=None):
+    """Returns the reason a measured configuration exceeds the budget, or None."""
+    if max_latency_ms is not None and cost['inference_latency_ms'] > max_latency_ms:
+        return f"inference latency {cost['inference_latency_ms']:.1f}ms > {max_latency_ms}ms"
+    if min_train_samples_per_sec is not None and cost['train_samples_per_sec'] < min_train_samples_per_sec:
+        return f"training throughput {cost['train_samples_per_sec']:.1f} < {min_train_samples_per_sec} samples/s"
+    if max_memory_mb is not None and cost['peak_memory_mb'] > max_memory_mb:
+        return f"peak memory {cost['peak_memory_mb']:.1f}MB > {max_memory_mb}MB"
+    return None
@@ -0,0 +1,72 @@
+import optuna
+
+
+class FidelitySchedule:
+    """Successive halving rungs over both training set size and epochs.
+
+    The budget of a rung is measured in sample-epochs. Rung k gets 1 / reduction_factor ** (num_rungs - 1 - k) of
+    the full budget num_samples * epochs, of which a data_share power goes to the training set size and the rest to
+    the epochs, so the last rung trains on the full set for the full number of epochs. Every rung trains for more
+    epochs than the one before, with too few epochs for num_rungs the schedule gets fewer rungs.
+    """
+
+    def __init__(self, num_samples, epochs, reduction_factor=3, num_rungs=4, data_share=0.5, min_samples=100):
+        self.num_samples = num_samples
+        self.epochs = epochs
+        self.reduction_factor = reduction_factor
+        self.num_rungs = num_rungs
+        self.rungs = []
+        for k in range(num_rungs):
+            fraction = reduction_factor ** -(num_rungs - 1 - k)
+            samples = min(num_samples, max(min_samples, round(num_samples * fraction ** data_share)))
+            epochs_k = max(1, round(epochs * fraction ** (1 - data_share)))
+            # Epochs are cumulative, a promoted trial continues where it stopped
+            if self.rungs:
+                epochs_k = min(epochs, max(epochs_k, self.rungs[-1][1] + 1))
+                if epochs_k == self.rungs[-1][1]:
+                    # Already at the full number of epochs, the larger training set replaces the previous rung
+                    self.rungs.pop()
+            self.rungs.append((samples, epochs_k))
+        self.num_rungs = len(self.rungs)
+
+    def step(self, rung):
+        # Optuna's successive halving places rung k at step min_resource * reduction_factor ** k
+        return self.reduction_factor ** rung
+
+    @property
+    def max_step(self):
+        return self.step(self.num_rungs - 1)
+
+    @property
+    def full_budget(self):
+        return self.num_samples * self.epochs
+
+    def make_pruner(self, name):
+        if name == 'asha':
+            return optuna.pruners.SuccessiveHalvingPruner(min_resource=1, reduction_factor=self.reduction_factor)
+        elif name == 'hyperband':
+            return optuna.pruners.HyperbandPruner(min_resource=1, max_resource=self.max_step,
+                                                  reduction_factor=self.reduction_factor)
+        raise ValueError(f"Pruner {name} not recognized.")
+
+
+def compute_savings(study, full_budget):
+    """Sample-epochs spent by the finished trials compared to training each of them on the full budget."""
+    # Trials transferred from prior studies were not trained in this study
+    trials = [trial for trial in study.trials if trial.state in (optuna.trial.TrialState.COMPLETE,
+                                                                 optuna.trial.TrialState.PRUNED)
+              and 'transferred_from' not in trial.user_attrs]
+    spent = sum(trial.user_attrs.get('sample_epochs', full_budget) for trial in trials)
+    total = len(trials) * full_budget
+    return {
+        'trials': len(trials),
+        'pruned': sum(trial.state == optuna.trial.TrialState.PRUNED for trial in trials),
+        'sample_epochs': spent,
+        'full_sample_epochs': total,
+        'saved_fraction': 1 - spent / total if total else 0.0,
+    }
+
+
+def rung_summary(schedule):
+    return ", ".join(f"rung {k}: {samples} samples x {epochs} epochs" for k, (samples, epochs)
+                     in enumerate(schedule.rungs))
@@ -0,0 +1,109 @@
+import math
+
+import joblib
+import optuna
+from optuna.distributions import CategoricalDistribution, FloatDistribution, IntDistribution
+from optuna.trial import TrialState
+
+
+def suggest(trial, space):
+    """Suggests every parameter of a {name: distribution} search space."""
+    params = {}
+    for name, distribution in space.items():
+        if isinstance(distribution, CategoricalDistribution):
+            params[name] = trial.suggest_categorical(name, distribution.choices)
+        elif isinstance(distribution, IntDistribution):
+            params[name] = trial.suggest_int(name, distribution.low, distribution.high, step=distribution.step,
+                                             log=distribution.log)
+        elif isinstance(distribution, FloatDistribution):
+            params[name] = trial.suggest_float(name, distribution.low, distribution.high, step=distribution.step,
+                                               log=distribution.log)
+        else:
+            raise ValueError(f"Distribution {distribution} not supported.")
+    return params
+
+
+def load_prior_trials(paths):
+    """Completed single-objective trials of pickled studies, best first, as (source, trial) pairs."""
+    trials = []
+    for path in paths:
+        study = joblib.load(path)
+        trials.extend((f"{path}#{trial.number}", trial) for trial in study.get_trials(deepcopy=False)
+                      if trial.state == TrialState.COMPLETE and len(trial.values) == 1)
+    return sorted(trials, key=lambda pair: pair[1].value)
+
+
+def in_space(params, space):
+    for name, distribution in space.items():
+        if name not in params:
+            return False
+        if isinstance(distribution, CategoricalDistribution):
+            if params[name] not in distribution.choices:
+                return False
+        elif not distribution.low <= params[name] <= distribution.high:
+            return False
+    return True
+
+
+def narrow_space(space, trials, top_k=5, margin=2.0):
+    """Shrinks the numeric ranges of a search space to the span of the top_k prior trials.
+
+    Log ranges are widened by a factor margin on both sides, linear ranges by margin - 1 times their span and int
+    ranges by at least one step, all clipped to the original bounds. Categorical choices are kept, Optuna does
+    not allow them to change within a study.
+    """
+    best = [trial.params for _, trial in trials[:top_k]]
+    narrowed = {}
+    for name, distribution in space.items():
+        values = [params[name] for params in best if name in params]
+        if not values or isinstance(distribution, CategoricalDistribution):
+            narrowed[name] = distribution
+            continue
+        low, high = min(values), max(values)
+        if distribution.log:
+            low, high = low / margin, high * margin
+        else:
+            width = (margin - 1) * (high - low)
+            low, high = low - width, high + width
+        low, high = max(distribution.low, low), min(distribution.high, high)
+        if isinstance(distribution, IntDistribution):
+            step = distribution.step
+            low = distribution.low + step * math.floor((low - distribution.low) / step - 1)
+            high = distribution.low + step * math.ceil((high - distribution.low) / step + 1)
+            narrowed[name] = IntDistribution(max(distribution.low, low), min(distribution.high, high),
+                                             log=distribution.log, step=step)
+        else:
+            narrowed[name] = FloatDistribution(low, high, log=distribution.log, step=distribution.step)
+    return narrowed
+
+
+def warm_start(study, trials, space, top_k=5, mode='both'):
+    """Seeds a study with prior trials, returns the number of transferred and enqueued trials.
+
+    transfer adds every prior trial inside the search space as a completed trial with its prior value, so the
+    sampler starts from their results. enqueue schedules the top_k prior configurations to be evaluated again
+    on this study's data. A study that was seeded before, e.g. when resuming, is left unchanged.
+    """
+    if any('transferred_from' in trial.user_attrs or 'enqueued_from' in trial.user_attrs
+           for trial in study.get_trials(deepcopy=False)):
+        return 0, 0
+    trials = [(source, trial) for source, trial in trials if in_space(trial.params, space)]
+
+    transferred = 0
+    if mode in ('transfer', 'both'):
+        if len(study.directions) != 1:
+            raise ValueError("Prior results can only be transferred into a single-objective study.")
+        study.add_trials([
+            optuna.trial.create_trial(params={name: trial.params[name] for name in space}, distributions=space,
+                                      value=trial.value, user_attrs={'transferred_from': source})
+            for source, trial in trials
+        ])
+        transferred = len(trials)
+
+    enqueued = 0
+    if mode in ('enqueue', 'both'):
+        for source, trial in trials[:top_k]:
+            study.enqueue_trial({name: trial.params[name] for name in space}, user_attrs={'enqueued_from': source},
+                                skip_if_exists=True)
+            enqueued += 1
+    return transferred, enqueued
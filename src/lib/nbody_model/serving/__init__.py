@@ -0,0 +1,4 @@
+from .batcher import *
+from .server import *
+from .bulk import *
+from .export import *
@@ -0,0 +1,167 @@
+import collections
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import torch
+
+from ..modules.clifford_embedding import charge_products, complete_graph
+
+
+class Request:
+    def __init__(self, loc, vel, charges):
+        self.loc = loc
+        self.vel = vel
+        self.charges = charges
+        self.future = Future()
+        self.arrival = time.perf_counter()
+
+    def __len__(self):
+        return len(self.loc)
+
+
+class MicroBatcher:
+    """Coalesces concurrent prediction requests into micro-batches for one model.
+
+    A batch is closed when it holds max_batch_size systems or when the oldest request has waited max_latency_ms.
+    The inputs are copied into preallocated buffers and the topology and attention mask of every batch size are
+    prepared once and reused. Requests are [systems, nodes, 3] positions and velocities and [systems, nodes, 1]
+    charges on the complete graph, as in the dataset.
+    """
+
+    def __init__(self, model, max_batch_size=256, max_latency_ms=5.0, window=10000):
+        self.model = model.eval()
+        self.n_nodes = model.n_nodes
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1e3
+        device = next(model.parameters()).device
+        self.edges = complete_graph(self.n_nodes, device=device)
+        self.loc = torch.empty(max_batch_size, self.n_nodes, 3, device=device)
+        self.vel = torch.empty(max_batch_size, self.n_nodes, 3, device=device)
+        self.charges = torch.empty(max_batch_size, self.n_nodes, 1, device=device)
+        self.topologies = {}
+
+        self.requests = queue.Queue()
+        self.latencies = collections.deque(maxlen=window)
+        self.batch_sizes = collections.deque(maxlen=window)
+        self.num_requests = 0
+        self.num_systems = 0
+        self.num_batches = 0
+        self.lock = threading.Lock()  # the metrics are read from the server threads
+        self.started = time.perf_counter()
+        self.running = True
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def submit(self, loc, vel, charges):
+        """Queues systems for prediction, returns a Future of the predicted positions as a numpy array."""
+        loc, vel, charges = (torch.as_tensor(np.asarray(value, dtype=np.float32)) for value in (loc, vel, charges))
+        if loc.dim() == 2:
+            loc, vel, charges = loc[None], vel[None], charges[None]
+        if charges.dim() == 2:
+            charges = charges[..., None]
+        expected = (len(loc), self.n_nodes)
+        if loc.shape != (*expected, 3) or vel.shape != loc.shape or charges.shape != (*expected, 1):
+            raise ValueError(f"Expected loc and vel [systems, {self.n_nodes}, 3] and charges "
+                             f"[systems, {self.n_nodes}, 1]")
+        if len(loc) > self.max_batch_size:
+            raise ValueError(f"At most {self.max_batch_size} systems per request")
+        request = Request(loc, vel, charges)
+        self.requests.put(request)
+        return request.future
+
+    def predict(self, loc, vel, charges, timeout=None):
+        return self.submit(loc, vel, charges).result(timeout)
+
+    def topology(self, batch_size):
+        if batch_size not in self.topologies:
+            edges = self.edges.expand(batch_size, *self.edges.shape)
+            self.topologies[batch_size] = self.model.embedding_layer.prepare_topology(edges, batch_size, self.n_nodes)
+        return self.topologies[batch_size]
+
+    def collect(self, carry):
+        # Blocks for the first request, then fills the batch until it is full or the first request's deadline
+        batch = [carry] if carry is not None else []
+        while not batch:
+            try:
+                batch.append(self.requests.get(timeout=0.1))
+            except queue.Empty:
+                if not self.running:
+                    return [], None
+        size = len(batch[0])
+        deadline = batch[0].arrival + self.max_latency
+        while size < self.max_batch_size:
+            try:
+                request = self.requests.get(timeout=max(0.0, deadline - time.perf_counter()))
+            except queue.Empty:
+                break
+            if size + len(request) > self.max_batch_size:
+                return batch, request
+            batch.append(request)
+            size += len(request)
+        return batch, None
+
+    def run(self):
+        carry = None
+        while self.running or carry is not None:
+            batch, carry = self.collect(carry)
+            if batch:
+                self.process(batch)
+
+    def process(self, batch):
+        start = 0
+        for request in batch:
+            stop = start + len(request)
+            self.loc[start:stop] = request.loc
+            self.vel[start:stop] = request.vel
+            self.charges[start:stop] = request.charges
+            start = stop
+        loc, vel, charges = self.loc[:start], self.vel[:start], self.charges[:start]
+        try:
+            with torch.inference_mode():
+                edges = self.edges.expand(start, *self.edges.shape)
+                graph = self.model.embedding_layer.prepare_graph(charge_products(charges, self.edges), charges,
+                                                                 edges, start, self.n_nodes, self.topology(start))
+                prediction = self.model.step(loc, vel, graph).cpu().numpy()
+        except Exception as error:
+            for request in batch:
+                request.future.set_exception(error)
+            return
+
+        done = time.perf_counter()
+        start = 0
+        for request in batch:
+            stop = start + len(request)
+            request.future.set_result(prediction[start:stop])
+            start = stop
+        with self.lock:
+            self.latencies.extend(done - request.arrival for request in batch)
+            self.num_requests += len(batch)
+            self.num_systems += start
+            self.num_batches += 1
+            self.batch_sizes.append(start)
+
+    def metrics(self):
+        with self.lock:
+            latencies = np.asarray(self.latencies) if self.latencies else np.zeros(1)
+            batch_sizes = np.asarray(self.batch_sizes) if self.batch_sizes else np.zeros(1)
+            num_requests, num_systems, num_batches = self.num_requests, self.num_systems, self.num_batches
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        elapsed = time.perf_counter() - self.started
+        return {
+            'requests': num_requests,
+            'systems': num_systems,
+            'batches': num_batches,
+            'mean_batch_size': float(batch_sizes.mean()),
+            'systems_per_sec': num_systems / elapsed,
+            'latency_p50_ms': 1e3 * p50,
+            'latency_p90_ms': 1e3 * p90,
+            'latency_p99_ms': 1e3 * p99,
+            'queued': self.requests.qsize(),
+        }
+
+    def close(self):
+        self.running = False
+        self.worker.join()
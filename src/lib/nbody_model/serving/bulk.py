@@ -0,0 +1,125 @@
+import json
+import math
+import os
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+MANIFEST = "manifest.json"
+PREDICTIONS = "predictions.npy"
+ERRORS = "errors.npy"
+# One row per chunk: done flag and sum of squared errors of the chunk
+PROGRESS = "progress.npy"
+
+
+def open_outputs(out_dir, manifest):
+    """Creates the output memory maps, or checks that existing ones were written for the same input and outputs."""
+    path = os.path.join(out_dir, MANIFEST)
+    if os.path.exists(path):
+        with open(path) as file:
+            existing = json.load(file)
+        if existing != manifest:
+            raise Exception("Output directory %s holds predictions of a different input or model" % out_dir)
+        return
+    os.makedirs(out_dir, exist_ok=True)
+    num_samples = manifest["num_samples"]
+    np.lib.format.open_memmap(os.path.join(out_dir, PREDICTIONS), mode="w+", dtype=np.float32,
+                              shape=(num_samples, *manifest["output_shape"])).flush()
+    if manifest["per_sample_error"]:
+        np.lib.format.open_memmap(os.path.join(out_dir, ERRORS), mode="w+", dtype=np.float64,
+                                  shape=(num_samples,)).flush()
+    np.lib.format.open_memmap(os.path.join(out_dir, PROGRESS), mode="w+", dtype=np.float64,
+                              shape=(manifest["num_chunks"], 2)).flush()
+    # The manifest is written last, an interrupted initialization starts over
+    with open(path, "w") as file:
+        json.dump(manifest, file, indent=2)
+
+
+def predict_chunks(rank, num_procs, build_model, dataset, out_dir, batch_size, chunk_size, threads):
+    """Predicts every num_procs-th chunk that is not done yet, in input order within the output files."""
+    torch.set_num_threads(threads)
+    model = build_model().eval()
+    predictions = np.load(os.path.join(out_dir, PREDICTIONS), mmap_mode="r+")
+    errors_path = os.path.join(out_dir, ERRORS)
+    errors = np.load(errors_path, mmap_mode="r+") if os.path.exists(errors_path) else None
+    progress = np.load(os.path.join(out_dir, PROGRESS), mmap_mode="r+")
+
+    for chunk in range(rank, len(progress), num_procs):
+        if progress[chunk, 0]:
+            continue
+        start, stop = chunk * chunk_size, min(len(predictions), (chunk + 1) * chunk_size)
+        sse = 0.0
+        for batch_start in range(start, stop, batch_size):
+            batch_stop = min(stop, batch_start + batch_size)
+            batch = dataset.get_batch(torch.arange(batch_start, batch_stop))
+            with torch.inference_mode():
+                output, tgt = model(batch)
+            predictions[batch_start:batch_stop] = output.numpy()
+            sample_sse = ((output.double() - tgt.double()) ** 2).flatten(1).sum(1)
+            if errors is not None:
+                errors[batch_start:batch_stop] = sample_sse.numpy()
+            sse += sample_sse.sum().item()
+
+        # Outputs reach the disk before the chunk is marked done, so an interruption only repeats the chunk
+        predictions.flush()
+        if errors is not None:
+            errors.flush()
+        progress[chunk, 1] = sse
+        progress[chunk, 0] = 1
+        progress.flush()
+
+
+def predict_dataset(build_model, dataset, out_dir, batch_size=500, chunk_size=5000, num_procs=1, threads=None,
+                    per_sample_error=False, description=None):
+    """Writes the predictions for every sample of an NBodyDataset compatible dataset to out_dir.
+
+    build_model is called in every process and returns the model. The samples are split in chunks that are
+    distributed over num_procs forked processes. Finished chunks are recorded, so calling this again with the
+    same arguments after an interruption only predicts the remaining chunks. Returns summary().
+    """
+    num_samples = len(dataset)
+    output_shape = list(dataset.get_batch(torch.arange(1))[4].shape[1:])
+    manifest = {
+        "num_samples": num_samples,
+        "output_shape": output_shape,
+        "chunk_size": chunk_size,
+        "num_chunks": math.ceil(num_samples / chunk_size),
+        # The errors file is only created with the outputs, chunks finished without it would lack their errors
+        "per_sample_error": per_sample_error,
+        "description": description,
+    }
+    open_outputs(out_dir, manifest)
+
+    threads = threads or max(1, os.cpu_count() // num_procs)
+    if num_procs == 1:
+        predict_chunks(0, 1, build_model, dataset, out_dir, batch_size, chunk_size, threads)
+    else:
+        context = mp.get_context("fork")
+        procs = [context.Process(target=predict_chunks, args=(rank, num_procs, build_model, dataset, out_dir,
+                                                              batch_size, chunk_size, threads))
+                 for rank in range(num_procs)]
+        for proc in procs:
+            proc.start()
+        for proc in procs:
+            proc.join()
+        if any(proc.exitcode != 0 for proc in procs):
+            raise Exception("A prediction process failed, run again to resume")
+    return summary(out_dir)
+
+
+def summary(out_dir):
+    """Mean squared error over all finished samples, from the summed squared errors of the chunks."""
+    with open(os.path.join(out_dir, MANIFEST)) as file:
+        manifest = json.load(file)
+    progress = np.load(os.path.join(out_dir, PROGRESS))
+    done = progress[:, 0] == 1
+    chunk_size, num_samples = manifest["chunk_size"], manifest["num_samples"]
+    samples = sum(min(chunk_size, num_samples - chunk * chunk_size) for chunk in np.flatnonzero(done))
+    elements = samples * int(np.prod(manifest["output_shape"]))
+    return {
+        "samples": samples,
+        "num_samples": num_samples,
+        "sse": float(progress[done, 1].sum()),
+        "mse": float(progress[done, 1].sum() / elements) if elements else float("nan"),
+    }
@@ -0,0 +1,33 @@
+import numpy as np
+import torch
+
+
+def export_numpy(model, path):
+    """Writes the weights of an NBodyTransformer and the algebra tables to a flat .npz for nbody_numpy.py.
+
+    The graph embedder projections are stored under node_projection and edge_projection, the Cayley table, the
+    reversion signs, the blade grades and the subspace sizes under algebra, and the architecture under config.
+    """
+    algebra = model.clifford_algebra
+    arrays = {}
+    with torch.no_grad():
+        parameters = dict(model.named_parameters())
+        parameters.update(model.embedding_layer.node_projection.named_parameters(prefix='node_projection'))
+        parameters.update(model.embedding_layer.edge_projection.named_parameters(prefix='edge_projection'))
+        for name, parameter in parameters.items():
+            arrays[name] = parameter.detach().cpu().numpy()
+        arrays['algebra.cayley'] = algebra.cayley.cpu().numpy()
+        arrays['algebra.beta_signs'] = algebra._beta_signs.cpu().numpy()
+        arrays['algebra.grades'] = algebra.bbo_grades.cpu().numpy().astype(np.int64)
+        arrays['algebra.subspaces'] = algebra.subspaces.cpu().numpy()
+    embedder = model.embedding_layer
+    arrays.update({
+        'config.d_model': np.array(model.d_model),
+        'config.num_heads': np.array(model.transformer.layers[0].self_attn.num_heads),
+        'config.num_layers': np.array(len(model.transformer.layers)),
+        'config.num_edges': np.array(model.num_edges),
+        'config.zero_edges': np.array(embedder.zero_edges),
+        'config.n_nodes': np.array(model.n_nodes),
+        'config.horizons': np.array(model.horizons if model.horizons is not None else [], dtype=np.int64),
+    })
+    np.savez(path, **arrays)
@@ -0,0 +1,91 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+
+from ..training.checkpoint import load_embedder_state_dict
+
+
+def load_model(model, path):
+    """Loads the model and graph embedder weights of a checkpoint, a full checkpoint of CheckpointManager or a
+    best model file of main.py.
+
+    A bare model state dict, as written by older versions of main.py, lacks the graph embedder projections and is
+    refused, predictions with randomly initialized projections are meaningless.
+    """
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    if 'model' not in state or 'embedder' not in state:
+        raise ValueError(f"{path} holds no graph embedder weights, retrain or use a full checkpoint of "
+                         f"--checkpoint_dir")
+    model.load_state_dict(state['model'])
+    load_embedder_state_dict(model, state['embedder'])
+
+
+class PredictionHandler(BaseHTTPRequestHandler):
+    # POST /predict with {"loc", "vel", "charges"} of one or more systems, GET /metrics
+    batcher = None
+    timeout = 30.0
+
+    def send_json(self, status, body):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/metrics':
+            self.send_json(200, self.batcher.metrics())
+        else:
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path != '/predict':
+            self.send_json(404, {'error': f'Unknown path {self.path}'})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+            future = self.batcher.submit(body['loc'], body['vel'], body['charges'])
+        except (KeyError, ValueError, TypeError) as error:
+            self.send_json(400, {'error': str(error)})
+            return
+        try:
+            loc = future.result(self.timeout)
+        except Exception as error:
+            self.send_json(500, {'error': str(error)})
+            return
+        self.send_json(200, {'loc': loc.tolist()})
+
+    def log_message(self, format, *args):
+        # Per request logging would dominate the latency at high request rates
+        pass
+
+
+class InferenceServer:
+    """Serves the predictions of a MicroBatcher over localhost HTTP, every connection in its own thread."""
+
+    def __init__(self, batcher, host='127.0.0.1', port=8000, timeout=30.0):
+        self.batcher = batcher
+        handler = type('Handler', (PredictionHandler,), {'batcher': batcher, 'timeout': timeout})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def address(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def serve_forever(self):
+        self.httpd.serve_forever()
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.batcher.close()
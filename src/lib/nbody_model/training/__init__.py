@@ -0,0 +1,5 @@
+from .engine import *
+from .checkpoint import *
+from .distributed import *
+from .feature_cache import *
+from .distillation import *
@@ -0,0 +1,150 @@
+import copy
+import glob
+import os
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+
+def get_rng_states():
+    states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        states['cuda'] = torch.cuda.get_rng_state_all()
+    return states
+
+
+def set_rng_states(states):
+    random.setstate(states['python'])
+    np.random.set_state(states['numpy'])
+    torch.set_rng_state(states['torch'])
+    if 'cuda' in states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(states['cuda'])
+
+
+def clone_state_dict(state_dict):
+    return {key: value.detach().clone() for key, value in state_dict.items()}
+
+
+def embedder_state_dict(model):
+    # The graph embedder is not an nn.Module, its projections are not part of model.state_dict()
+    embedder = model.embedding_layer
+    return {
+        'node_projection': clone_state_dict(embedder.node_projection.state_dict()),
+        'edge_projection': clone_state_dict(embedder.edge_projection.state_dict()),
+    }
+
+
+def load_embedder_state_dict(model, state_dict):
+    model.embedding_layer.node_projection.load_state_dict(state_dict['node_projection'])
+    model.embedding_layer.edge_projection.load_state_dict(state_dict['edge_projection'])
+
+
+def snapshot(model, optimizer, scheduler, epoch, **training_state):
+    """Copies the full training state, so it can be serialized while training continues."""
+    return {
+        'epoch': epoch,
+        'model': clone_state_dict(model.state_dict()),
+        'embedder': embedder_state_dict(model),
+        'optimizer': copy.deepcopy(optimizer.state_dict()),
+        'scheduler': copy.deepcopy(scheduler.state_dict()) if scheduler is not None else None,
+        'rng': get_rng_states(),
+        'training_state': copy.deepcopy(training_state),
+    }
+
+
+def restore(checkpoint, model, optimizer=None, scheduler=None):
+    model.load_state_dict(checkpoint['model'])
+    load_embedder_state_dict(model, checkpoint['embedder'])
+    if optimizer is not None:
+        optimizer.load_state_dict(checkpoint['optimizer'])
+    if scheduler is not None and checkpoint['scheduler'] is not None:
+        scheduler.load_state_dict(checkpoint['scheduler'])
+    set_rng_states(checkpoint['rng'])
+    return checkpoint['epoch'], checkpoint['training_state']
+
+
+def atomic_save(obj, path):
+    tmp_path = path + '.tmp'
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+class CheckpointManager:
+    """Writes full training checkpoints from a background thread.
+
+    Every save_every epochs a periodic checkpoint is written, of which the newest keep_last are kept, and on every
+    improvement of the validation loss the best checkpoint is overwritten. With keep_last=0 only the best
+    checkpoint is written.
+    """
+
+    def __init__(self, directory, prefix, save_every=10, keep_last=3):
+        self.directory = directory
+        self.prefix = prefix
+        self.save_every = save_every
+        self.keep_last = keep_last
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+        os.makedirs(directory, exist_ok=True)
+
+    @property
+    def best_path(self):
+        return os.path.join(self.directory, f'{self.prefix}_best.pt')
+
+    def periodic_path(self, epoch):
+        return os.path.join(self.directory, f'{self.prefix}_epoch{epoch:05d}.pt')
+
+    def periodic_checkpoints(self):
+        pattern = re.compile(re.escape(self.prefix) + r'_epoch(\d+)\.pt$')
+        paths = glob.glob(os.path.join(self.directory, f'{self.prefix}_epoch*.pt'))
+        return sorted((int(match.group(1)), path) for path in paths
+                      if (match := pattern.search(os.path.basename(path))))
+
+    def submit(self, fn, *args):
+        self.pending = [future for future in self.pending if not future.done()]
+        self.pending.append(self.executor.submit(fn, *args))
+
+    def is_periodic(self, epoch):
+        # keep_last=0 disables periodic checkpoints, only the best one is written
+        return self.keep_last > 0 and (epoch + 1) % self.save_every == 0
+
+    def save(self, state, is_best=False):
+        epoch = state['epoch']
+        if is_best:
+            self.submit(atomic_save, state, self.best_path)
+        if self.is_periodic(epoch):
+            self.submit(self.save_periodic, state, epoch)
+
+    def save_periodic(self, state, epoch):
+        atomic_save(state, self.periodic_path(epoch))
+        for _, path in self.periodic_checkpoints()[:-self.keep_last]:
+            os.remove(path)
+
+    def save_model(self, model, path):
+        # Model and graph embedder weights without the training state, as read by --test_only and load_model
+        state = {'model': clone_state_dict(model.state_dict()), 'embedder': embedder_state_dict(model)}
+        self.submit(atomic_save, state, path)
+
+    def latest(self):
+        """Loads the most recent checkpoint, periodic or best, or returns None."""
+        self.wait()
+        candidates = [path for _, path in self.periodic_checkpoints()[-1:]]
+        if os.path.exists(self.best_path):
+            candidates.append(self.best_path)
+        checkpoints = [torch.load(path, map_location='cpu', weights_only=False) for path in candidates]
+        return max(checkpoints, key=lambda checkpoint: checkpoint['epoch'], default=None)
+
+    def wait(self):
+        for future in self.pending:
+            future.result()
+        self.pending = []
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
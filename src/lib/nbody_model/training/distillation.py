@@ -0,0 +1,90 @@
+import torch
+import torch.nn as nn
+
+from ..original_modules.linear import MVLinear
+
+
+def layer_pairs(student_layers, teacher_layers):
+    # Every student block is matched to the teacher block at the same relative depth
+    return [(i, (i + 1) * teacher_layers // student_layers - 1) for i in range(student_layers)]
+
+
+class Distiller(nn.Module):
+    """Trains a student NBodyTransformer against a frozen teacher and the ground truth.
+
+    The loss mixes the error to the target, the error to the teacher prediction (weight alpha) and the error
+    between the node multivectors after matched transformer blocks (weight beta). The student features are mapped
+    to the teacher width by equivariant MVLinear adapters, which are trained with the student and dropped
+    afterwards. Only node tokens are compared, so students with fewer or no edge tokens work as well. Use
+    Distiller.loss as the criterion of Engine, in eval mode it is the plain error to the target.
+    """
+
+    def __init__(self, student, teacher, alpha=0.5, beta=0.1):
+        super().__init__()
+        self.student = student
+        self.teacher = teacher.eval().requires_grad_(False)
+        self.alpha = alpha
+        self.beta = beta
+        if student.n_nodes != teacher.n_nodes or student.horizons != teacher.horizons:
+            raise ValueError("Student and teacher need the same number of nodes and horizons")
+        self.pairs = layer_pairs(len(student.transformer.layers), len(teacher.transformer.layers))
+        self.adapters = nn.ModuleList([MVLinear(student.clifford_algebra, student.d_model, teacher.d_model)
+                                       for _ in self.pairs] if beta else [])
+        self.features = {}
+        self.hooks = []
+        self.teacher_output = None
+
+    def train(self, mode=True):
+        super().train(mode)
+        self.teacher.eval()
+        return self
+
+    def trainable_parameters(self):
+        return [*self.student.parameters(), *self.adapters.parameters()]
+
+    def capture(self, model, name):
+        for i, layer in enumerate(model.transformer.layers):
+            def hook(module, inputs, output, i=i):
+                self.features[name, i] = output
+            self.hooks.append(layer.register_forward_hook(hook))
+
+    def node_features(self, model, output, batch_size):
+        # [batch * tokens, d_model, 8] -> the node tokens [batch, nodes, d_model, 8]
+        return output.view(batch_size, model.n_nodes + model.num_edges, model.d_model, 8)[:, :model.n_nodes]
+
+    def forward(self, batch):
+        if not self.training:
+            return self.student(batch)
+        self.features.clear()
+        if self.beta:
+            self.capture(self.student, 'student')
+            self.capture(self.teacher, 'teacher')
+        try:
+            with torch.no_grad():
+                self.teacher_output, _ = self.teacher(batch)
+            output, tgt = self.student(batch)
+        finally:
+            for hook in self.hooks:
+                hook.remove()
+            self.hooks.clear()
+        return output, tgt
+
+    def feature_loss(self, batch_size):
+        losses = []
+        for adapter, (student_layer, teacher_layer) in zip(self.adapters, self.pairs):
+            student = self.features['student', student_layer]
+            student = adapter(student).view(batch_size, -1, self.teacher.d_model, 8)
+            student = student[:, :self.student.n_nodes]
+            teacher = self.node_features(self.teacher, self.features['teacher', teacher_layer], batch_size)
+            # Relative to the teacher's feature scale, which differs between blocks
+            losses.append(((student - teacher) ** 2).mean() / (teacher ** 2).mean().clamp_min(1e-12))
+        return torch.stack(losses).mean()
+
+    def loss(self, output, tgt):
+        target_loss = ((output - tgt) ** 2).mean()
+        if not self.training:
+            return target_loss
+        loss = (1 - self.alpha) * target_loss + self.alpha * ((output - self.teacher_output) ** 2).mean()
+        if self.beta:
+            loss = loss + self.beta * self.feature_loss(output.size(0))
+        return loss
@@ -0,0 +1,52 @@
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+
+
+def setup_distributed(rank, world_size, master_addr='127.0.0.1', master_port=29500, threads_per_rank=None):
+    """Joins a gloo process group of local CPU processes and pins this rank to its own cores."""
+    os.environ['MASTER_ADDR'] = master_addr
+    os.environ['MASTER_PORT'] = str(master_port)
+    dist.init_process_group('gloo', rank=rank, world_size=world_size)
+
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    if threads_per_rank is None:
+        threads_per_rank = max(1, len(cores) // world_size)
+    # Consecutive blocks of cores per rank, so the intra-op thread pools do not compete
+    rank_cores = cores[rank * threads_per_rank:(rank + 1) * threads_per_rank]
+    if rank_cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, rank_cores)
+    torch.set_num_threads(threads_per_rank)
+    return threads_per_rank
+
+
+def cleanup_distributed():
+    if dist.is_initialized():
+        dist.destroy_process_group()
+
+
+def is_main_process():
+    return not dist.is_initialized() or dist.get_rank() == 0
+
+
+def barrier():
+    if dist.is_initialized():
+        dist.barrier()
+
+
+def broadcast_embedder(model):
+    # The graph embedder is not an nn.Module, DistributedDataParallel does not synchronize its projections
+    embedder = model.embedding_layer
+    for tensor in [*embedder.node_projection.parameters(), *embedder.edge_projection.parameters()]:
+        dist.broadcast(tensor.data, src=0)
+
+
+def wrap_model(model, bucket_cap_mb=25):
+    """Wraps the model for data parallel training, gradients are all-reduced in buckets of bucket_cap_mb."""
+    broadcast_embedder(model)
+    # NBodyTransformer.x_left is not used in the forward pass, DistributedDataParallel skips frozen parameters
+    # instead of searching the autograd graph for unused ones on every step
+    model.x_left.requires_grad_(False)
+    return DistributedDataParallel(model, bucket_cap_mb=bucket_cap_mb, gradient_as_bucket_view=True)
@@ -0,0 +1,129 @@
+import contextlib
+import time
+
+import numpy as np
+import torch
+import torch.distributed as dist
+import torch.nn as nn
+
+
+def step_stats(step_times, num_samples, elapsed):
+    step_times = np.asarray(step_times) if step_times else np.zeros(1)
+    p50, p90, p99 = np.percentile(step_times, [50, 90, 99])
+    return {
+        'samples': num_samples,
+        'steps': len(step_times),
+        'samples_per_sec': num_samples / elapsed if elapsed > 0 else 0.0,
+        'step_time_p50': p50,
+        'step_time_p90': p90,
+        'step_time_p99': p99,
+    }
+
+
+def all_reduce_loss(running_loss, num_steps, num_samples):
+    # Sum of per-batch losses, steps and samples over all ranks, so every rank sees the same epoch loss
+    totals = torch.stack([running_loss.detach().double().cpu(), torch.tensor(float(num_steps), dtype=torch.float64),
+                          torch.tensor(float(num_samples), dtype=torch.float64)])
+    dist.all_reduce(totals)
+    return totals[0], int(totals[1].item()), int(totals[2].item())
+
+
+class Engine:
+    """Training and evaluation loop shared by main.py and the hyperparameter search.
+
+    Losses are accumulated on the device and only read back once per epoch. Step times are host wall times,
+    on a GPU they include the queueing of kernels but not their completion.
+    """
+
+    def __init__(self, model, criterion, optimizer=None, scheduler=None, accumulation_steps=1, max_norm=1.0):
+        self.model = model
+        self.criterion = criterion
+        self.optimizer = optimizer
+        self.scheduler = scheduler  # stepped after every optimizer step
+        self.accumulation_steps = accumulation_steps
+        self.max_norm = max_norm
+        self.distributed = dist.is_available() and dist.is_initialized()
+
+    def optimizer_step(self):
+        nn.utils.clip_grad_norm_(self.model.parameters(), max_norm=self.max_norm)  # Gradient clipping
+        self.optimizer.step()
+        self.optimizer.zero_grad()
+        if self.scheduler is not None:
+            self.scheduler.step()
+
+    def train_epoch(self, loader):
+        self.model.train()
+        running_loss = None
+        step_times = []
+        num_samples = 0
+        num_batches = len(loader)
+        self.optimizer.zero_grad()
+        start = time.perf_counter()
+        for i, batch in enumerate(loader):
+            step_start = time.perf_counter()
+            is_step = (i + 1) % self.accumulation_steps == 0 or i + 1 == num_batches
+            # DistributedDataParallel only has to all-reduce the gradients of the last accumulated batch
+            sync = contextlib.nullcontext() if is_step or not hasattr(self.model, 'no_sync') else self.model.no_sync()
+            with sync:
+                output, tgt = self.model(batch)
+                loss = self.criterion(output, tgt)
+                (loss / self.accumulation_steps).backward()
+            if is_step:
+                self.optimizer_step()
+            running_loss = loss.detach() if running_loss is None else running_loss + loss.detach()
+            num_samples += batch[0].size(0)
+            step_times.append(time.perf_counter() - step_start)
+        return self.epoch_result(running_loss, step_times, num_samples, time.perf_counter() - start)
+
+    def evaluate(self, loader):
+        self.model.eval()
+        running_loss = None
+        running_horizon_loss = None
+        step_times = []
+        num_samples = 0
+        start = time.perf_counter()
+        with torch.inference_mode():
+            for batch in loader:
+                step_start = time.perf_counter()
+                output, tgt = self.model(batch)
+                loss = self.criterion(output, tgt)
+                running_loss = loss if running_loss is None else running_loss + loss
+                if output.dim() == 4:
+                    # Multi-horizon predictions [batch, horizons, nodes, 3], the error of every horizon
+                    horizon_loss = ((output - tgt) ** 2).mean(dim=(0, 2, 3))
+                    if running_horizon_loss is not None:
+                        horizon_loss = running_horizon_loss + horizon_loss
+                    running_horizon_loss = horizon_loss
+                num_samples += batch[0].size(0)
+                step_times.append(time.perf_counter() - step_start)
+        loss, stats = self.epoch_result(running_loss, step_times, num_samples, time.perf_counter() - start)
+        if running_horizon_loss is not None:
+            stats['horizon_loss'] = self.reduce_mean(running_horizon_loss, len(step_times)).tolist()
+        return loss, stats
+
+    def reduce_mean(self, running, num_steps):
+        # Mean of per-batch values, summed over all ranks first
+        totals = torch.cat([running.detach().double().cpu(), torch.tensor([float(num_steps)], dtype=torch.float64)])
+        if self.distributed:
+            dist.all_reduce(totals)
+        return totals[:-1] / totals[-1]
+
+    def epoch_result(self, running_loss, step_times, num_samples, elapsed):
+        num_steps = len(step_times)
+        if running_loss is None:
+            running_loss = torch.zeros(())
+        if self.distributed:
+            running_loss, num_steps, num_samples = all_reduce_loss(running_loss, num_steps, num_samples)
+        if num_steps == 0:
+            # Checked after the reduction, so all ranks raise together
+            raise ValueError("The data loader yielded no batches, e.g. a training loader with drop_last and fewer "
+                             "samples than the batch size")
+        return running_loss.item() / num_steps, step_stats(step_times, num_samples, elapsed)
+
+
+def format_stats(stats):
+    line = (f"{stats['samples_per_sec']:.1f} samples/s, step time p50 {stats['step_time_p50'] * 1e3:.1f}ms "
+            f"p90 {stats['step_time_p90'] * 1e3:.1f}ms p99 {stats['step_time_p99'] * 1e3:.1f}ms")
+    if 'horizon_loss' in stats:
+        line += ", loss per horizon " + " ".join(f"{loss:.6f}" for loss in stats['horizon_loss'])
+    return line
@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn as nn
+
+from ..data.cache import DTYPES, from_numpy, to_numpy
+
+MANIFEST = "manifest.json"
+FEATURE_CACHE_VERSION = 2
+
+
+def prefix_modules(model, train_from):
+    """Modules of the frozen prefix, train_from is 'combined_projection' or the index of the first trained block."""
+    embedder = model.embedding_layer
+    modules = [embedder.node_projection, embedder.edge_projection]
+    if train_from != 'combined_projection':
+        modules += [model.combined_projection, *model.transformer.layers[:train_from]]
+    return modules
+
+
+def trained_modules(model, train_from):
+    layers = list(model.transformer.layers)
+    if train_from == 'combined_projection':
+        return [model.combined_projection, *layers]
+    return layers[train_from:]
+
+
+def check_train_from(model, train_from):
+    if train_from != 'combined_projection' and not 0 <= train_from < len(model.transformer.layers):
+        raise ValueError(f"train_from has to be 'combined_projection' or a block index below "
+                         f"{len(model.transformer.layers)}, got {train_from}")
+
+
+def prefix_checksum(model, train_from):
+    # Ties a cache to the frozen weights it was computed with
+    digest = hashlib.sha256()
+    for module in prefix_modules(model, train_from):
+        for parameter in module.parameters():
+            digest.update(parameter.detach().float().cpu().numpy().tobytes())
+    return digest.hexdigest()
+
+
+def dataset_identity(dataset):
+    """The settings of an NBodyDataset that determine its samples, a cache is only valid for the same ones."""
+    identity = {
+        "partition": dataset.partition,
+        "data_root": os.path.abspath(dataset.data_root),
+        "suffix": dataset.suffix,
+        "frame_0": getattr(dataset, "frame_0", None),
+        "frame_T": getattr(dataset, "frame_T", None),
+        "horizons": dataset.horizons,
+        "num_samples": len(dataset),
+    }
+    # As read back from the manifest
+    return json.loads(json.dumps(identity))
+
+
+def run_prefix(model, batch, train_from):
+    """Features [batch, tokens, d_model, 8] after the frozen prefix and the attention mask of the batch."""
+    embeddings, attention_mask = model.embedding_layer.embed_nbody_graphs(batch)
+    batch_size, n_nodes, _ = batch[0].size()
+    src = embeddings.reshape(batch_size * (n_nodes + model.num_edges), model.d_model, 8)
+    if train_from != 'combined_projection':
+        src = model.combined_projection(src)
+        for layer in model.transformer.layers[:train_from]:
+            src = layer(src, attention_mask)
+    return src.view(batch_size, n_nodes + model.num_edges, model.d_model, 8), attention_mask
+
+
+def build_feature_cache(model, dataset, out_dir, train_from, batch_size=500, dtype="fp32"):
+    """Runs the frozen prefix of the model once over a dataset and stores its features as memory-mapped .npy.
+
+    The features are stored in dtype, the input positions and the targets stay in fp32. The attention mask only
+    depends on the topology and is stored once.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown cache dtype {dtype}, expected one of {list(DTYPES)}")
+    check_train_from(model, train_from)
+    os.makedirs(out_dir, exist_ok=True)
+    num_samples = len(dataset)
+    features = loc_start = target = attention_mask = None
+    model.eval()
+    with torch.inference_mode():
+        for start in range(0, num_samples, batch_size):
+            indices = torch.arange(start, min(num_samples, start + batch_size))
+            batch = dataset.get_batch(indices)
+            batch_features, batch_mask = run_prefix(model, batch, train_from)
+            if features is None:
+                storage = to_numpy(batch_features[:1], dtype)
+                features = np.lib.format.open_memmap(os.path.join(out_dir, "features.npy"), mode="w+",
+                                                     dtype=storage.dtype, shape=(num_samples, *storage.shape[1:]))
+                loc_start = np.lib.format.open_memmap(os.path.join(out_dir, "loc_start.npy"), mode="w+",
+                                                      dtype=np.float32, shape=(num_samples, *batch[0].shape[1:]))
+                target = np.lib.format.open_memmap(os.path.join(out_dir, "target.npy"), mode="w+",
+                                                   dtype=np.float32, shape=(num_samples, *batch[4].shape[1:]))
+                if batch_mask is not None:
+                    attention_mask = batch_mask[0].cpu()
+                    np.save(os.path.join(out_dir, "attention_mask.npy"), attention_mask.numpy())
+            if batch_mask is not None and not torch.equal(batch_mask.cpu(), attention_mask.expand_as(batch_mask)):
+                raise Exception("Feature caches need the same topology for every sample")
+            features[start:start + len(indices)] = to_numpy(batch_features.cpu(), dtype)
+            loc_start[start:start + len(indices)] = batch[0].float().cpu().numpy()
+            target[start:start + len(indices)] = batch[4].float().cpu().numpy()
+    for array in (features, loc_start, target):
+        array.flush()
+
+    manifest = {
+        "version": FEATURE_CACHE_VERSION,
+        "train_from": train_from,
+        "dtype": dtype,
+        "num_samples": num_samples,
+        "dataset": dataset_identity(dataset),
+        "prefix_checksum": prefix_checksum(model, train_from),
+    }
+    # Written last, a directory without a manifest is an incomplete cache
+    with open(os.path.join(out_dir, MANIFEST), "w") as file:
+        json.dump(manifest, file, indent=2)
+    return manifest
+
+
+class CachedFeatureDataset:
+    """Frozen prefix features of build_feature_cache, batches are [loc_start, features, target].
+
+    Works with NBody.get_loader like the other datasets. The features are upcast to fp32 per batch. Given the
+    model and the dataset the cache is meant for, a cache of other prefix weights or other samples is rejected.
+    """
+
+    def __init__(self, cache_root, model=None, dataset=None):
+        with open(os.path.join(cache_root, MANIFEST)) as file:
+            self.manifest = json.load(file)
+        if self.manifest["version"] != FEATURE_CACHE_VERSION:
+            raise Exception("Unsupported feature cache version %s" % self.manifest["version"])
+        self.train_from = self.manifest["train_from"]
+        if model is not None and prefix_checksum(model, self.train_from) != self.manifest["prefix_checksum"]:
+            raise Exception("Feature cache %s was computed with other prefix weights" % cache_root)
+        if dataset is not None and dataset_identity(dataset) != self.manifest["dataset"]:
+            raise Exception("Feature cache %s was computed from another dataset" % cache_root)
+        self.features = np.load(os.path.join(cache_root, "features.npy"), mmap_mode="r")
+        self.loc_start = np.load(os.path.join(cache_root, "loc_start.npy"), mmap_mode="r")
+        self.target = np.load(os.path.join(cache_root, "target.npy"), mmap_mode="r")
+        mask_path = os.path.join(cache_root, "attention_mask.npy")
+        self.attention_mask = torch.from_numpy(np.load(mask_path)) if os.path.exists(mask_path) else None
+
+    def get_batch(self, indices):
+        indices = np.asarray(indices)
+        features = from_numpy(self.features[indices], self.manifest["dtype"]).float()
+        return [torch.from_numpy(self.loc_start[indices]), features, torch.from_numpy(self.target[indices])]
+
+    def __getitem__(self, i):
+        return self.get_batch([i])
+
+    def share_memory(self):
+        # Memory maps are shared between data loader workers by the page cache
+        return self
+
+    def __len__(self):
+        return self.manifest["num_samples"]
+
+
+class CachedHead(nn.Module):
+    """The layers of a model after its frozen prefix, trained on CachedFeatureDataset batches.
+
+    Freezes the prefix parameters of the wrapped model, pass trainable_parameters() to the optimizer. The model
+    itself is updated in place and predicts end to end as usual afterwards.
+    """
+
+    def __init__(self, model, train_from, attention_mask=None):
+        super().__init__()
+        check_train_from(model, train_from)
+        self.model = model
+        self.train_from = train_from
+        self.register_buffer("attention_mask", attention_mask, persistent=False)
+        for module in prefix_modules(model, train_from):
+            module.requires_grad_(False)
+
+    def trainable_parameters(self):
+        return [parameter for module in trained_modules(self.model, self.train_from)
+                for parameter in module.parameters()]
+
+    def forward(self, batch):
+        loc_start, features, target = batch
+        batch_size, tokens = features.shape[:2]
+        attention_mask = None
+        if self.attention_mask is not None:
+            attention_mask = self.attention_mask.expand(batch_size, tokens, tokens)
+        src = features.reshape(batch_size * tokens, self.model.d_model, 8)
+        layers = self.model.transformer.layers
+        if self.train_from == 'combined_projection':
+            src = self.model.combined_projection(src)
+        else:
+            layers = layers[self.train_from:]
+        for layer in layers:
+            src = layer(src, attention_mask)
+        return self.model.positions(src, loc_start), target
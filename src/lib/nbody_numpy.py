@@ -0,0 +1,177 @@
+"""NBodyTransformer forward pass in plain NumPy, for CPU consumers that only need predictions.
+
+This file only depends on NumPy and can be copied on its own. The weights come from
+nbody_model.serving.export.export_numpy or from export_model.py:
+
+    model = NumpyNBodyTransformer('model.npz')
+    loc_T = model.predict(loc, vel, charges)  # [systems, nodes, 3] each, charges [systems, nodes, 1]
+"""
+import numpy as np
+
+EPS = 1e-6
+
+
+class NumpyNBodyTransformer:
+    def __init__(self, path, dtype=np.float32):
+        with np.load(path) as arrays:
+            self.params = {name: arrays[name] for name in arrays.files}
+        self.dtype = dtype
+        config = {name[len('config.'):]: self.params.pop(name) for name in list(self.params)
+                  if name.startswith('config.')}
+        self.d_model = int(config['d_model'])
+        self.num_heads = int(config['num_heads'])
+        self.num_layers = int(config['num_layers'])
+        self.num_edges = int(config['num_edges'])
+        self.zero_edges = bool(config['zero_edges'])
+        self.n_nodes = int(config['n_nodes'])
+        self.horizons = config['horizons'].tolist() or None
+        self.unique_edges = self.num_edges == self.n_nodes * (self.n_nodes - 1) // 2
+
+        self.cayley = self.params.pop('algebra.cayley').astype(dtype)
+        self.subspaces = self.params.pop('algebra.subspaces')
+        grades = self.params.pop('algebra.grades')
+        # The quadratic form of a multivector is x^T Q x with the scalar part of the reversed product
+        self.quadratic = self.params.pop('algebra.beta_signs').astype(dtype)[:, None] * self.cayley[:, 0, :]
+        self.grade_blades = [np.flatnonzero(grades == grade) for grade in np.unique(grades)]
+        # Weights are expanded from subspaces to blades once instead of on every call
+        for name, value in self.params.items():
+            if value.ndim == 3 and name.endswith('weight'):
+                value = np.repeat(value, self.subspaces, axis=-1)
+            self.params[name] = value.astype(dtype)
+        self.topologies = {}
+
+    def linear(self, name, x):
+        weight = self.params[name + '.weight']
+        if weight.ndim == 3:
+            result = np.einsum('bmi,nmi->bni', x, weight, optimize=True)
+        else:
+            result = np.einsum('bmi,nm->bni', x, weight, optimize=True)
+        bias = self.params.get(name + '.bias')
+        if bias is not None:
+            result[..., 0] += bias[0, :, 0]
+        return result
+
+    def geometric_product(self, a, b):
+        return np.einsum('...i,ijk,...k->...j', a, self.cayley, b, optimize=True)
+
+    def q(self, x, blades=None):
+        quadratic = self.quadratic if blades is None else self.quadratic[np.ix_(blades, blades)]
+        if blades is not None:
+            x = x[..., blades]
+        return np.einsum('...i,ik,...k->...', x, quadratic, x, optimize=True)[..., None]
+
+    def layer_norm(self, name, x):
+        norm = (self.q(x) ** 2 + 1e-16) ** 0.25
+        norm = norm.mean(axis=1, keepdims=True) + EPS
+        return self.params[name + '.a'][..., None] * x / norm
+
+    def silu(self, name, x):
+        norms = np.concatenate([x[..., :1]] + [self.q(x, blades) for blades in self.grade_blades[1:]], axis=-1)
+        norms = self.params[name + '.a'] * norms + self.params[name + '.b']
+        return x / (1 + np.exp(-np.repeat(norms, self.subspaces, axis=-1)))
+
+    def attention(self, name, x, attention_mask):
+        tokens = self.n_nodes + self.num_edges
+        batch_size, heads = x.shape[0] // tokens, self.num_heads
+        head_dim = self.d_model // heads
+
+        def split_heads(y):
+            # [batch * tokens, heads * head_dim, 8] -> [batch, heads, tokens, head_dim * 8]
+            y = y.reshape(batch_size, tokens, heads, head_dim, 8).transpose(0, 2, 1, 3, 4)
+            return y.reshape(batch_size, heads, tokens, head_dim * 8)
+
+        q, k, v = (split_heads(self.linear(f'{name}.{projection}', x)) for projection in ('q_linear', 'k_linear',
+                                                                                          'v_linear'))
+        scores = (q / np.sqrt(head_dim * 8)) @ k.transpose(0, 1, 3, 2)
+        if attention_mask is not None:
+            scores = scores + attention_mask
+        scores = np.exp(scores - scores.max(axis=-1, keepdims=True))
+        output = (scores / scores.sum(axis=-1, keepdims=True)) @ v
+        output = output.reshape(batch_size, heads, tokens, head_dim, 8).transpose(0, 2, 1, 3, 4)
+        return self.linear(f'{name}.output_embedding', output.reshape(batch_size * tokens, self.d_model, 8))
+
+    def topology(self, edges):
+        """Edges used by the model and the attention mask of one system, as prepared by NBodyGraphEmbedder."""
+        key = edges.tobytes()
+        if key not in self.topologies:
+            indices = np.arange(edges.shape[1])
+            if self.unique_edges:
+                # The first occurrence of every node pair
+                pairs = [tuple(sorted(edge)) for edge in edges.T.tolist()]
+                indices = np.array([i for i, pair in enumerate(pairs) if pair not in pairs[:i]])
+                edges = np.array([pairs[i] for i in indices]).T
+            tokens = self.n_nodes + edges.shape[1]
+            allowed = np.zeros((tokens, tokens), dtype=bool)
+            allowed[:self.n_nodes, :self.n_nodes] = True
+            edge_tokens = self.n_nodes + np.arange(edges.shape[1])
+            for nodes in edges:
+                allowed[edge_tokens, nodes] = True
+                allowed[nodes, edge_tokens] = True
+            np.fill_diagonal(allowed, True)
+            mask = np.where(allowed, 0.0, -np.inf).astype(self.dtype)
+            self.topologies[key] = edges, indices, mask
+        return self.topologies[key]
+
+    def embed(self, loc, vel, charges, edges, edge_attr):
+        batch_size, n_nodes, _ = loc.shape
+        nodes = np.zeros((batch_size * n_nodes, 3, 8), dtype=self.dtype)
+        nodes[:, 0, 0] = charges.reshape(-1)
+        nodes[:, 1, 1:4] = (loc - loc.mean(axis=1, keepdims=True)).reshape(-1, 3)
+        nodes[:, 2, 1:4] = vel.reshape(-1, 3)
+        embedding = self.linear('node_projection', nodes).reshape(batch_size, n_nodes, self.d_model, 8)
+        if not self.num_edges:
+            return embedding.reshape(-1, self.d_model, 8), None
+
+        edges, indices, mask = self.topology(edges)
+        if self.zero_edges:
+            edge_embedding = np.zeros((batch_size, self.num_edges, self.d_model, 8), dtype=self.dtype)
+        else:
+            # Endpoints of every edge of every system in the flattened node array. NBodyGraphEmbedder takes the
+            # unique edges of the first system for all systems, which the trained weights expect
+            offsets = n_nodes * np.arange(batch_size)[:, None] * (not self.unique_edges)
+            first, second = nodes[(edges[0] + offsets).reshape(-1)], nodes[(edges[1] + offsets).reshape(-1)]
+            products = self.geometric_product(first, second) + self.geometric_product(second, first)
+            attributes = np.zeros((batch_size * self.num_edges, 1, 8), dtype=self.dtype)
+            attributes[:, 0, 0] = edge_attr[:, indices].reshape(-1)
+            features = np.concatenate([attributes, first + second, products], axis=1)
+            edge_embedding = self.linear('edge_projection', features).reshape(batch_size, self.num_edges,
+                                                                              self.d_model, 8)
+        embedding = np.concatenate([embedding, edge_embedding], axis=1)
+        return embedding.reshape(-1, self.d_model, 8), mask
+
+    def predict(self, loc, vel, charges, edges=None, edge_attr=None):
+        """Positions after the trained horizon, [systems, nodes, 3], or [systems, horizons, nodes, 3].
+
+        edges are [2, edges] node pairs shared by all systems and default to the complete graph, edge_attr is
+        [systems, edges, 1] and defaults to the products of the charges, as in the dataset.
+        """
+        loc, vel, charges = (np.asarray(value, dtype=self.dtype) for value in (loc, vel, charges))
+        batch_size, n_nodes, _ = loc.shape
+        charges = charges.reshape(batch_size, n_nodes, 1)
+        if edges is None:
+            rows, cols = np.nonzero(~np.eye(n_nodes, dtype=bool))
+            edges = np.stack([rows, cols])
+        edges = np.asarray(edges, dtype=np.int64)
+        if edge_attr is None:
+            edge_attr = (charges[:, edges[0]] * charges[:, edges[1]])
+        edge_attr = np.asarray(edge_attr, dtype=self.dtype)
+
+        src, mask = self.embed(loc, vel, charges, edges, edge_attr)
+        src = self.linear('combined_projection.layer.0', src)
+        src = self.silu('combined_projection.layer.1', src)
+        src = self.linear('combined_projection.layer.2', src)
+        for layer in range(self.num_layers):
+            prefix = f'transformer.layers.{layer}.'
+            attended = self.attention(prefix + 'self_attn', self.layer_norm(prefix + 'mvlayernorm1', src), mask)
+            src = self.layer_norm(prefix + 'mvlayernorm2', src + attended)
+            products = self.geometric_product(self.linear(prefix + 'gp.first_layer', src),
+                                              self.linear(prefix + 'gp.second_layer', src))
+            gp = self.layer_norm(prefix + 'gp.norm', self.linear(prefix + 'gp.third_layer', products))
+            src = self.layer_norm(prefix + 'mvlayernorm3', src + gp)
+            hidden = self.silu(prefix + 'mlp.1', self.linear(prefix + 'mlp.0', src))
+            src = src + self.linear(prefix + 'mlp.2', hidden)
+
+        output = src.reshape(batch_size, n_nodes + self.num_edges, self.d_model, 8)
+        if self.horizons is not None:
+            return loc[:, None] + output[:, :n_nodes, 1:1 + len(self.horizons), 1:4].transpose(0, 2, 1, 3)
+        return loc + output[:, :n_nodes, 1, 1:4]
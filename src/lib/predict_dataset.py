@@ -0,0 +1,88 @@
+from nbody_model.modules.transformer import NBodyTransformer
+from nbody_model.algebra import CliffordAlgebra
+from nbody_model.data.nbody import NBodyDataset, NBodyTrajectoryDataset
+from nbody_model.serving.bulk import predict_dataset
+from nbody_model.serving.server import load_model
+import argparse
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Write NBodyTransformer predictions of a dataset partition to .npy.")
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Full checkpoint from --checkpoint_dir, or a best_model.pth of main.py')
+    parser.add_argument('--out_dir', type=str, required=True,
+                        help='Directory of predictions.npy, rerun with the same arguments to resume')
+    parser.add_argument('--d_model', type=int, default=128, help='Dimension of the nbody_model')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--num_layers', type=int, default=5, help='Number of layers')
+    parser.add_argument('--num_edges', type=int, default=10, help='Number of edges')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
+    parser.add_argument('--partition', type=str, default='test', choices=['train', 'valid', 'test'],
+                        help='Dataset partition to predict')
+    parser.add_argument('--data_root', type=str, default='./nbody_dataset/', help='Directory of the dataset')
+    parser.add_argument('--suffix', type=str, default='_charged5_initvel1small', help='Dataset suffix')
+    parser.add_argument('--cache_root', type=str, default=None, help='Preprocessed dataset cache to load from')
+    parser.add_argument('--num_samples', type=int, default=3000, help='Number of samples')
+    parser.add_argument('--frame_0', type=int, default=None, help='Input frame, defaults to the dataset default')
+    parser.add_argument('--frame_T', type=int, default=None, help='Target frame, defaults to the dataset default')
+    parser.add_argument('--sliding_window', action='store_true', help='Flag to predict every (t, t + delta) window')
+    parser.add_argument('--delta', type=int, default=10, help='Frames between input and target for sliding windows')
+    parser.add_argument('--stride', type=int, default=1, help='Frames between consecutive sliding window starts')
+    parser.add_argument('--horizons', type=int, nargs='+', default=None,
+                        help='Frames after frame_0 predicted by a multi-horizon model')
+    parser.add_argument('--batch_size', type=int, default=500, help='Systems per forward pass')
+    parser.add_argument('--chunk_size', type=int, default=5000, help='Systems between progress records')
+    parser.add_argument('--num_procs', type=int, default=1, help='Number of prediction processes')
+    parser.add_argument('--threads_per_proc', type=int, default=None, help='CPU threads per process')
+    parser.add_argument('--per_sample_error', action='store_true',
+                        help='Also write the squared error of every sample to errors.npy')
+    args = parser.parse_args()
+    if args.horizons is not None and args.cache_root is not None:
+        parser.error('--horizons needs the raw dataset, it does not work with --cache_root')
+    if args.sliding_window and args.cache_root is not None:
+        parser.error('--sliding_window reads the raw trajectories, it does not work with --cache_root')
+    return args
+
+
+def main():
+    args = parse_arguments()
+    if args.sliding_window:
+        dataset = NBodyTrajectoryDataset(partition=args.partition, data_root=args.data_root, suffix=args.suffix,
+                                         max_samples=args.num_samples, delta=args.delta, stride=args.stride,
+                                         horizons=args.horizons)
+    else:
+        dataset = NBodyDataset(partition=args.partition, data_root=args.data_root, suffix=args.suffix,
+                               max_samples=args.num_samples, cache_root=args.cache_root, frame_0=args.frame_0,
+                               frame_T=args.frame_T, horizons=args.horizons)
+
+    def build_model():
+        model = NBodyTransformer(
+            input_dim=3,
+            d_model=args.d_model,
+            num_heads=args.num_heads,
+            num_layers=args.num_layers,
+            clifford_algebra=CliffordAlgebra([1, 1, 1]),
+            num_edges=args.num_edges,
+            zero_edges=args.zero_edges,
+            n_nodes=args.n_nodes,
+            horizons=args.horizons
+        )
+        load_model(model, args.checkpoint)
+        return model
+
+    # Fails early on an unusable checkpoint, before any output is written
+    build_model()
+
+    # The manifest ties the outputs to their input, a rerun with other arguments is refused instead of mixed in
+    description = {key: value for key, value in vars(args).items()
+                   if key not in ('out_dir', 'batch_size', 'num_procs', 'threads_per_proc', 'per_sample_error')}
+    result = predict_dataset(build_model, dataset, args.out_dir, batch_size=args.batch_size,
+                             chunk_size=args.chunk_size, num_procs=args.num_procs, threads=args.threads_per_proc,
+                             per_sample_error=args.per_sample_error, description=description)
+    print(f"Predicted {result['samples']} of {result['num_samples']} samples to {args.out_dir}, "
+          f"MSE {result['mse']:.6f}")
+
+
+if __name__ == '__main__':
+    main()
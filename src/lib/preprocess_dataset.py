@@ -0,0 +1,36 @@
+from nbody_model.data.nbody import NBodyDataset
+from nbody_model.data.cache import write_cache, DTYPES
+import argparse
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Preprocess the nbody dataset into a sharded cache.")
+    parser.add_argument('--data_root', type=str, default='./nbody_dataset/', help='Directory with the raw .npy files')
+    parser.add_argument('--out_dir', type=str, default='./nbody_cache/', help='Directory to write the cache to')
+    parser.add_argument('--suffix', type=str, default='_charged5_initvel1small', help='Dataset suffix')
+    parser.add_argument('--frame_0', type=int, default=None, help='Input frame, defaults to the dataset default')
+    parser.add_argument('--frame_T', type=int, default=None, help='Target frame, defaults to the dataset default')
+    parser.add_argument('--num_samples', type=int, default=3000, help='Number of samples per partition')
+    parser.add_argument('--shard_size', type=int, default=1000, help='Number of samples per shard')
+    parser.add_argument('--dtype', type=str, choices=list(DTYPES), default='fp32',
+                        help='Storage dtype of the embedded features')
+    parser.add_argument('--partitions', type=str, nargs='+', default=['train', 'valid', 'test'],
+                        help='Partitions to preprocess')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    datasets = {
+        partition: NBodyDataset(partition=partition, data_root=args.data_root, suffix=args.suffix,
+                                max_samples=args.num_samples, frame_0=args.frame_0, frame_T=args.frame_T)
+        for partition in args.partitions
+    }
+    manifest = write_cache(datasets, args.out_dir, shard_size=args.shard_size, dtype=args.dtype)
+    for partition, info in manifest['partitions'].items():
+        print(f'{partition}: {info["num_samples"]} samples in {len(info["shards"])} shards')
+    print(f'Cache written to {args.out_dir}')
+
+
+if __name__ == '__main__':
+    main()
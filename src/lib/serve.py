@@ -0,0 +1,56 @@
+import torch
+from nbody_model.modules.transformer import NBodyTransformer
+from nbody_model.algebra import CliffordAlgebra
+from nbody_model.serving.batcher import MicroBatcher
+from nbody_model.serving.server import InferenceServer, load_model
+import argparse
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Serve NBodyTransformer predictions over localhost HTTP.")
+    parser.add_argument('--checkpoint', type=str, required=True,
+                        help='Full checkpoint from --checkpoint_dir, or a best_model.pth of main.py')
+    parser.add_argument('--d_model', type=int, default=128, help='Dimension of the nbody_model')
+    parser.add_argument('--num_heads', type=int, default=4, help='Number of attention heads')
+    parser.add_argument('--num_layers', type=int, default=5, help='Number of layers')
+    parser.add_argument('--num_edges', type=int, default=10, help='Number of edges')
+    parser.add_argument('--n_nodes', type=int, default=5, help='Number of bodies per system')
+    parser.add_argument('--zero_edges', action='store_true', help='Flag to indicate zero edges')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000, help='Port to listen on')
+    parser.add_argument('--max_batch_size', type=int, default=256, help='Maximum number of systems per micro-batch')
+    parser.add_argument('--max_latency_ms', type=float, default=5.0,
+                        help='Maximum time a request waits for its micro-batch to fill')
+    parser.add_argument('--threads', type=int, default=None, help='CPU threads of the model')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = NBodyTransformer(
+        input_dim=3,
+        d_model=args.d_model,
+        num_heads=args.num_heads,
+        num_layers=args.num_layers,
+        clifford_algebra=CliffordAlgebra([1, 1, 1]),
+        num_edges=args.num_edges,
+        zero_edges=args.zero_edges,
+        n_nodes=args.n_nodes
+    )
+    load_model(model, args.checkpoint)
+
+    server = InferenceServer(MicroBatcher(model, max_batch_size=args.max_batch_size,
+                                          max_latency_ms=args.max_latency_ms), host=args.host, port=args.port)
+    print(f'Serving on {server.address}, POST /predict, GET /metrics')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if __name__ == '__main__':
+    main()
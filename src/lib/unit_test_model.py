@@ -1,8 +1,16 @@
+import os
+import tempfile
 import unittest
+import numpy as np
 import torch
 from nbody_model.modules.attention import SelfAttentionClifford
 from src.lib.nbody_model.algebra import CliffordAlgebra
 from src.lib.nbody_model.modules.transformer import NBodyTransformer
+from src.lib.nbody_model.modules.ensemble import NBodyEnsemble
+from src.lib.nbody_model.data.nbody import random_batch
+from src.lib.nbody_model.serving.export import export_numpy
+from src.lib.nbody_model.profiling.equivariance import check_equivariance
+from src.lib.nbody_numpy import NumpyNBodyTransformer
 
 
 # Assuming MVLinear and MVLayerNorm are defined elsewhere, import them as well
@@ -92,6 +100,60 @@ class TestModules(unittest.TestCase):
         self.assertTrue(abs(difference_sum) < 1e-5,
                         f"Equivariance test failed: difference sum {difference_sum} is not close to 0")
 
+    def test_rollout_matches_forward(self):
+        model = NBodyTransformer(3, 16, 4, 2, CliffordAlgebra([1, 1, 1]))
+        batch = random_batch(3, generator=torch.Generator().manual_seed(0))
+        with torch.no_grad():
+            expected, _ = model(batch)
+            trajectory = model.rollout(batch[0], batch[1], batch[3], steps=2)
+
+        # The first step sees the same inputs as forward, the topology and edge attributes are derived
+        self.assertEqual(trajectory.shape, (2, 3, 5, 3))
+        self.assertTrue(torch.allclose(trajectory[0], expected, atol=1e-5), "Rollout step differs from forward")
+
+    def test_multi_horizon_output_shape(self):
+        model = NBodyTransformer(3, 16, 4, 2, CliffordAlgebra([1, 1, 1]), horizons=[10, 20, 30])
+        batch = random_batch(3)
+        output, _ = model(batch)
+        self.assertEqual(output.shape, (3, 3, 5, 3), "Expected [batch, horizons, nodes, 3]")
+
+    def test_ensemble_matches_members(self):
+        algebra = CliffordAlgebra([1, 1, 1])
+        models = [NBodyTransformer(3, 16, 4, 2, algebra, num_edges=num_edges, zero_edges=zero_edges).eval()
+                  for num_edges, zero_edges in ((10, False), (0, False), (10, False), (20, True))]
+        batch = random_batch(3)
+        with torch.no_grad():
+            expected = torch.stack([model(batch)[0] for model in models])
+            outputs, _ = NBodyEnsemble(models)(batch)
+        self.assertTrue(torch.allclose(outputs, expected, atol=1e-4), "Ensemble differs from its members")
+
+    def test_numpy_runtime_matches_model(self):
+        # Unique edges (taken from the first system like the model does), all directed edges and no edges
+        for num_edges, zero_edges in ((10, False), (20, True), (0, False)):
+            with self.subTest(num_edges=num_edges, zero_edges=zero_edges):
+                model = NBodyTransformer(3, 16, 4, 2, CliffordAlgebra([1, 1, 1]), num_edges=num_edges,
+                                         zero_edges=zero_edges).eval()
+                batch = random_batch(3)
+                with tempfile.TemporaryDirectory() as directory:
+                    export_numpy(model, os.path.join(directory, 'model.npz'))
+                    runtime = NumpyNBodyTransformer(os.path.join(directory, 'model.npz'))
+                with torch.no_grad():
+                    expected, _ = model(batch)
+                output = runtime.predict(batch[0].numpy(), batch[1].numpy(), batch[3].numpy())
+                self.assertTrue(np.allclose(output, expected.numpy(), atol=1e-4),
+                                "NumPy runtime differs from the model")
+
+    def test_batched_equivariance(self):
+        model = NBodyTransformer(3, 16, 4, 2, CliffordAlgebra([1, 1, 1]), num_edges=20)
+        generator = torch.Generator().manual_seed(0)
+        report = check_equivariance(model, random_batch(8, generator=generator), num_transforms=8,
+                                    max_batch_size=32, generator=generator)
+
+        # Max relative errors over 8 systems x 8 rotations and reflections, so errors cannot cancel
+        self.assertLess(report['output']['max'], 1e-4, "Predicted positions are not equivariant")
+        for name, stats in report['layers'].items():
+            self.assertLess(stats['max'], 1e-3, f"{name} is not equivariant")
+
 
 if __name__ == '__main__':
     unittest.main()
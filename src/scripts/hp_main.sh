@@ -15,4 +15,4 @@ module load Anaconda3/2022.05
 # Activate your environment
 source activate cgest_env
 cd ..
-srun python hyperparameter_testing.py --num_edges 10
+srun python hyperparameter_testing.py --num_edges 10 --n_workers 6 --threads_per_worker 3
@@ -16,4 +16,4 @@ module load Anaconda3/2022.05
 # Activate your environment
 source activate cgest_env
 cd ..
-srun python hyperparameter_testing.py --num_edges 0
+srun python hyperparameter_testing.py --num_edges 0 --n_workers 6 --threads_per_worker 3
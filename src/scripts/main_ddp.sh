@@ -0,0 +1,21 @@
+#!/bin/bash
+#SBATCH --partition=gpu
+#SBATCH --gpus=1
+#SBATCH --job-name=our_gatr_ddp
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=18
+#SBATCH --time=08:10:10
+#SBATCH --output=fin_model_ddp_%A.out
+
+module purge
+module load 2022
+module load Anaconda3/2022.05
+
+# Your job starts in the directory where you call sbatch
+# Activate your environment
+source activate cgest_env
+
+cd ..
+
+# 6 local data parallel processes with 3 pinned cores each, the global batch size is 6 * 50
+srun python main.py --world_size 6 --threads_per_rank 3 --batch_size 50
@@ -0,0 +1,19 @@
+#!/bin/bash
+#SBATCH --partition=gpu
+#SBATCH --gpus=1
+#SBATCH --job-name=preprocess
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=18
+#SBATCH --time=00:30:00
+#SBATCH --output=preprocess_%A.out
+
+
+module purge
+module load 2022
+module load Anaconda3/2022.05
+
+# Your job starts in the directory where you call sbatch
+# Activate your environment
+source activate cgest_env
+cd ..
+srun python preprocess_dataset.py --out_dir ./nbody_cache/